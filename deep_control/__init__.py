@@ -1,4 +1,3 @@
-from deep_control import data, vis, nn, integrate
-
-__all__ = ['data', 'vis', 'nn', 'integrate']
+from deep_control import data, vis, nn, integrate, inference
 
+__all__ = ['data', 'vis', 'nn', 'integrate', 'inference']
@@ -8,6 +8,9 @@ import shutil
 import os
 import threading
 import glob
+import json
+import hashlib
+import multiprocessing
 import pandas
 try:
     from tqdm import tqdm
@@ -196,56 +199,193 @@ def load_trajectory(data_file, cols=None, col_names=None):
     return df
 
 
-def create_training_data(trajs, train_p=0.7, n_outputs=1, first_node=True, last_node=True):
-
-    nodes = trajs[0].shape[0]
-    init = 0
+def _parse_trajectory(data_file):
+    # Whitespace separated numbers, the first line gives the number of columns
+    with open(data_file, 'rb') as f:
+        text = f.read()
+    n_cols = len(text[:text.find(b'\n')].split())
+    values = np.fromstring(text.decode('ascii'), sep=' ')
+    if n_cols == 0 or len(values) % n_cols:
+        return None
+    return values.reshape(-1, n_cols)
 
-    if not last_node:
-        nodes -= 1
 
-    if not first_node:
-        nodes -= 1
-        init = 1
+def _parse_trajectories(data_files):
+    return [_parse_trajectory(f) for f in data_files]
 
-    n_vars = trajs[0].shape[1] - n_outputs - 1
 
-    n_trajs = len(trajs)
+def load_trajectories_array(data_dir, cols=None, col_names=None, n=None,
+                            processes=None, cache=True):
+    """ Loads all the .data files of a directory into a single array
 
-    trajs_train = trajs[:int(n_trajs*train_p)]
-    trajs_test = trajs[int(n_trajs*train_p):]
+    :param data_dir: directory with the (fixed layout) .data files
+    :param cols: columns to keep (all by default)
+    :param col_names: names of the columns (kept ones)
+    :param n: load only the first n files
+    :param processes: size of the process pool used to parse the files
+    :param cache: stores the result in data_dir/.cache, keyed on the file
+     names, sizes and modification times
+    :return: array (trajectory x node x column), column names
+    """
 
-    train_samples = nodes * len(trajs_train)
-    test_samples = nodes * len(trajs_test)
+    traj_files = sorted(glob.glob(data_dir + '/*.data'))
+    if n:
+        traj_files = traj_files[:n]
 
-    x_train = np.zeros((train_samples, n_vars))
-    x_test = np.zeros((test_samples, n_vars))
+    key = hashlib.sha1(repr(cols).encode())
+    for f in traj_files:
+        st = os.stat(f)
+        key.update('{} {} {}\n'.format(os.path.basename(f), st.st_size,
+                                        st.st_mtime).encode())
+    cache_file = os.path.join(data_dir, '.cache', key.hexdigest() + '.npy')
 
-    y_train = np.zeros((train_samples, n_outputs))
-    y_test = np.zeros((test_samples, n_outputs))
+    if cache and os.path.isfile(cache_file):
+        trajs = np.load(cache_file)
+    else:
+        chunks = [traj_files[i:i + 256] for i in range(0, len(traj_files), 256)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            parsed = [t for chunk in tqdm(pool.imap(_parse_trajectories, chunks),
+                                          'Loading trajectories', leave=True)
+                      for t in chunk]
+        finally:
+            pool.close()
+            pool.join()
+
+        shape = next((t.shape for t in parsed if t is not None), (0, 0))
+        good = [t for t in parsed if t is not None and t.shape == shape]
+        if len(good) < len(parsed):
+            print('{} of {} files skipped (unexpected layout)'
+                  .format(len(parsed) - len(good), len(parsed)))
+
+        trajs = np.empty((len(good),) + shape)
+        for i, t in enumerate(good):
+            trajs[i] = t
+        del parsed, good
+
+        if cols is not None:
+            trajs = np.ascontiguousarray(trajs[:, :, cols])
+
+        if cache:
+            if not os.path.exists(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            tmp = cache_file[:-4] + '.tmp' + str(os.getpid()) + '.npy'
+            np.save(tmp, trajs)
+            os.rename(tmp, cache_file)
+
+    if col_names is None:
+        col_names = list(cols) if cols is not None else list(range(trajs.shape[2]))
+
+    return trajs, col_names
+
+
+class TrajectoryStore(object):
+    """Read-only view of a trajectory store written by
+    indirect_method/generate_data (store.json manifest, <shard>.bin blocks
+    and <shard>.idx index records).
+
+    The shards are memory-mapped: store[i] is a (nodes x columns) view of the
+    i-th trajectory, no data is copied until it is used.
+    """
 
-    j = 0
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest = json.load(open(os.path.join(directory, 'store.json')))
+        self.columns = self.manifest['columns']
+        n_columns = self.manifest['n_columns']
+        index_dtype = np.dtype([('offset', '<i8'), ('nodes', '<i8'),
+                                ('walk', '<i8'),
+                                ('x', '<f8', (self.manifest['n_x'],))])
+
+        self.shards = []
+        indices = []
+        for idx_file in sorted(glob.glob(os.path.join(directory, '*.idx'))):
+            n = os.path.getsize(idx_file) // index_dtype.itemsize
+            if n == 0:
+                continue
+            index = np.memmap(idx_file, dtype=index_dtype, mode='r', shape=(n,))
+            rows = int(index['offset'][-1] + index['nodes'][-1])
+            values = np.memmap(idx_file[:-4] + '.bin', dtype='<f8', mode='r',
+                               shape=(rows, n_columns))
+            indices.append(index)
+            self.shards.append(values)
+
+        # Global trajectory number -> (shard, record)
+        self._shard = np.concatenate([np.full(len(index), i, dtype=int)
+                                      for i, index in enumerate(indices)] +
+                                     [np.zeros(0, dtype=int)])
+        self._record = np.concatenate([np.arange(len(index))
+                                       for index in indices] +
+                                      [np.zeros(0, dtype=int)])
+        self._indices = indices
+
+    def __len__(self):
+        return len(self._shard)
+
+    def __getitem__(self, i):
+        index = self._indices[self._shard[i]][self._record[i]]
+        return self.shards[self._shard[i]][index['offset']:
+                                           index['offset'] + index['nodes']]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def field(self, name):
+        """Per trajectory index field ('nodes', 'walk' or 'x')"""
+        return np.concatenate([index[name] for index in self._indices])
+
+    def state(self, i):
+        return self[i][:, :self.manifest['n_state']]
+
+    def control(self, i):
+        return self[i][:, self.manifest['n_state']:]
+
+    def dataframes(self):
+        """Trajectories as DataFrames, as returned by load_trajectories"""
+        for traj in self:
+            yield pandas.DataFrame(traj, columns=self.columns)
+
+
+def load_store(directory):
+    return TrajectoryStore(directory)
 
-    for t in tqdm(trajs_train, 'Creating training data', leave=True):
-        # From 1 to 1+n_vars (0 is always time)
-        data_in = t.values[init:init+nodes, 1:1+n_vars]
-        data_out = t.values[init:init+nodes, -n_outputs:]
-        for i in range(data_in.shape[0]):
-            x_train[j, :] = data_in[i, :]
-            y_train[j, :] = data_out[i, :]
-            j += 1
 
-    j = 0
-    for t in tqdm(trajs_test, 'Creating test data', leave=True):
-        # From 1 to 1+n_vars (0 is always time)
-        data_in = t.values[init:init+nodes, 1:1+n_vars]
-        data_out = t.values[init:init+nodes, -n_outputs:]
-        for i in range(data_in.shape[0]):
-            x_test[j, :] = data_in[i, :]
-            y_test[j, :] = data_out[i, :]
-            j += 1
+def create_training_data(trajs, train_p=0.7, n_outputs=1, first_node=True, last_node=True):
+    """ Stacks the nodes of the trajectories into inputs (all the columns but
+    time and the outputs) and outputs (the last n_outputs columns)
+
+    :param trajs: iterable (list, generator, TrajectoryStore) of DataFrames or
+     arrays, the number of nodes may differ between trajectories
+    :param train_p: fraction of the trajectories used for training (the first ones)
+    :return: x_train, y_train, x_test, y_test (views of a single array for x
+     and y) and the shuffled training indices
+    """
 
-    idx_train = list(range(x_train.shape[0]))
-    np.random.shuffle(idx_train)
+    init = 0 if first_node else 1
+    end = None if last_node else -1
+
+    xs = []
+    ys = []
+    nodes = []
+    for t in tqdm(trajs, 'Creating training data', leave=True):
+        values = getattr(t, 'values', t)
+        # From 1 to 1+n_vars (0 is always time), copies so that t can be freed
+        n_vars = values.shape[1] - n_outputs - 1
+        xs.append(np.array(values[init:end, 1:1+n_vars], dtype=np.float64))
+        ys.append(np.array(values[init:end, -n_outputs:], dtype=np.float64))
+        nodes.append(xs[-1].shape[0])
+
+    x = np.concatenate(xs)
+    del xs
+    y = np.concatenate(ys)
+    del ys
+
+    # Split by trajectory
+    split = int(np.sum(nodes[:int(len(nodes)*train_p)]))
+    x_train, x_test = x[:split], x[split:]
+    y_train, y_test = y[:split], y[split:]
+
+    idx_train = np.random.permutation(split).tolist()
 
     return x_train, y_train, x_test, y_test, idx_train
@@ -0,0 +1,176 @@
+"""Evaluation of the trained networks with plain numpy.
+
+The weights of the Lasagne network are copied into contiguous arrays, the
+input normalisation is folded into the first layer and the output
+post-processing into the last one, so a call is a few dot products on
+preallocated buffers. The dropout layers are not applied (deterministic
+evaluation).
+"""
+import pickle
+import time
+
+import numpy as np
+
+from deep_control.nn import OUTPUT_LOG, get_name, preprocess, postprocess
+
+
+class MLP(object):
+    """One network (one control) of nn.get_network
+
+    :param model: model description, with the normalisation values
+    :param params: [W1, b1, W2, b2, ...] as in layers.get_all_param_values
+    :param input_cols: columns of the state used as network input (all)
+    """
+
+    def __init__(self, model, params, input_cols=None):
+        self.input_cols = input_cols
+        self.relu = model['hidden_nonlinearity'] == 'ReLu'
+        self.log_output = model['output_mode'] == OUTPUT_LOG
+        self.Ws = [np.array(W, dtype=np.float64) for W in params[0::2]]
+        self.bs = [np.array(b, dtype=np.float64).ravel() for b in params[1::2]]
+
+        # Input normalisation in the first layer
+        xmean = np.asarray(model['X_norm'][0], dtype=np.float64)
+        xstd = np.asarray(model['X_norm'][1], dtype=np.float64)
+        self.bs[0] = self.bs[0] - np.dot(xmean / xstd, self.Ws[0])
+        self.Ws[0] = self.Ws[0] / xstd.reshape(-1, 1)
+
+        # Output postprocessing
+        control = model['control']
+        ymean = model['Y_norm'][0][control]
+        ystd = model['Y_norm'][1][control]
+        data_min, data_max = model['maxmin'][control]
+        if self.log_output:
+            # tanh output mapped from [-1, 1] to [data_min, data_max]
+            self.scale = (data_max - data_min) / 2. * ystd
+            self.offset = (data_max + data_min) / 2. * ystd + ymean
+        else:
+            # Linear output, clipped to [data_min, data_max]
+            self.Ws[-1] = self.Ws[-1] * ystd
+            self.bs[-1] = self.bs[-1] * ystd + ymean
+            self.bounds = (data_min * ystd + ymean, data_max * ystd + ymean)
+
+        self.Ws = [np.ascontiguousarray(W) for W in self.Ws]
+        self._buffers = {}
+
+    @classmethod
+    def from_network(cls, model, network, input_cols=None):
+        """From a network returned by nn.get_network / nn.load_network"""
+        from lasagne import layers
+        return cls(model, layers.get_all_param_values(network['layers']),
+                   input_cols)
+
+    @classmethod
+    def from_file(cls, model, base_dir='./', netfolder='nets', input_cols=None):
+        """From the weights saved by nn.train (Theano is not used)"""
+        params = pickle.load(open(base_dir + get_name(model, netfolder), 'rb'))
+        return cls(model, params, input_cols)
+
+    def _get_buffers(self, n):
+        buffers = self._buffers.get(n)
+        if buffers is None:
+            shape = (lambda m: (m,)) if n is None else (lambda m: (n, m))
+            buffers = [np.empty(shape(W.shape[1])) for W in self.Ws]
+            if len(self._buffers) > 8:
+                self._buffers.clear()
+            self._buffers[n] = buffers
+        return buffers
+
+    def __call__(self, x):
+        """Control for a state (float) or for a batch of states (1-d array)"""
+        x = np.asarray(x, dtype=np.float64)
+        if self.input_cols is not None:
+            x = x[..., self.input_cols]
+        x = np.ascontiguousarray(x)
+        buffers = self._get_buffers(None if x.ndim == 1 else x.shape[0])
+
+        h = x
+        for W, b, out in zip(self.Ws[:-1], self.bs[:-1], buffers):
+            np.dot(h, W, out=out)
+            out += b
+            if self.relu:
+                np.maximum(out, 0., out=out)
+            else:
+                np.tanh(out, out=out)
+            h = out
+
+        out = buffers[-1]
+        np.dot(h, self.Ws[-1], out=out)
+        out += self.bs[-1]
+        if self.log_output:
+            np.tanh(out, out=out)
+            out *= self.scale
+            out += self.offset
+        else:
+            np.clip(out, self.bounds[0], self.bounds[1], out=out)
+
+        if x.ndim == 1:
+            return float(out[0])
+        return out[:, 0].copy()
+
+
+class NetworkController(object):
+    """All the controls of a state, one MLP per control. Can be passed as the
+    compute_control function of integrate.integrate_landing (the networks
+    argument is then ignored).
+
+    :param networks: list of (model, params) or of MLP
+    """
+
+    def __init__(self, networks, input_cols=None):
+        self.mlps = [n if isinstance(n, MLP) else MLP(n[0], n[1], input_cols)
+                     for n in networks]
+
+    def __call__(self, state, networks=None):
+        u = [mlp(state) for mlp in self.mlps]
+        if np.ndim(state) == 1:
+            return np.asarray(u)
+        return np.column_stack(u)
+
+
+def benchmark(model, network, x, n=10000, batch_size=None):
+    """Time per evaluation of the Theano network (with preprocess and
+    postprocess, as in the examples) and of the numpy MLP.
+
+    :param x: inputs (rows), evaluated one at a time
+    :param batch_size: if given, also times batched evaluations of that size
+     (must be the batch size the Theano network was compiled for)
+    :return: dict with the times (s) and the maximum absolute difference
+    """
+    mlp = MLP.from_network(model, network)
+    control = model['control']
+    n_outputs = len(model['maxmin'])
+    x = np.asarray(x, dtype=np.float64)
+    n = min(n, x.shape[0])
+
+    def theano_control(xi):
+        xi = preprocess(model, xi.copy())
+        u = np.zeros((xi.reshape(-1, x.shape[1]).shape[0], n_outputs))
+        u[:, control] = network['pred'](xi.reshape(-1, x.shape[1]))[:, 0]
+        return postprocess(model, u)[:, control]
+
+    t0 = time.time()
+    ref = [theano_control(x[i])[0] for i in range(n)]
+    t_theano = (time.time() - t0) / n
+
+    t0 = time.time()
+    fast = [mlp(x[i]) for i in range(n)]
+    t_numpy = (time.time() - t0) / n
+
+    results = {'theano': t_theano, 'numpy': t_numpy,
+               'error': np.max(np.abs(np.asarray(ref) - np.asarray(fast)))}
+
+    if batch_size:
+        batches = [x[i:i + batch_size]
+                   for i in range(0, n - batch_size + 1, batch_size)]
+        t0 = time.time()
+        ref = [theano_control(b) for b in batches]
+        results['theano_batch'] = (time.time() - t0) / max(len(batches), 1)
+        t0 = time.time()
+        fast = [mlp(b) for b in batches]
+        results['numpy_batch'] = (time.time() - t0) / max(len(batches), 1)
+        if batches:
+            results['error_batch'] = np.max(np.abs(np.concatenate(ref) -
+                                                   np.concatenate(fast)))
+
+    return results
@@ -48,6 +48,90 @@ def integrate_landing(dy, networks, compute_control, initial_state,
     return state_history, check
 
 
+OUTCOME_NONE = 0
+OUTCOME_DONE = 1
+OUTCOME_CRASH = 2
+
+
+def _rk4_step(dynamics, states, controls, dt):
+    k1 = dynamics(states, controls)
+    k2 = dynamics(states + dt / 2. * k1, controls)
+    k3 = dynamics(states + dt / 2. * k2, controls)
+    k4 = dynamics(states + dt * k3, controls)
+    return states + dt / 6. * (k1 + 2 * k2 + 2 * k3 + k4)
+
+
+def integrate_landing_batch(dynamics, controller, initial_states, final_check,
+                            dt=0.01, max_time=10, stop_if_done=True,
+                            stop_if_crash=True, history=False):
+    """Simulates M landings at once with a fixed step (RK4) integrator.
+
+    The controls are evaluated once per step for all the active
+    trajectories (and held during the step); trajectories stop when they are
+    done or crash (see stop_if_*).
+
+    :param dynamics: dynamics(states, controls) -> derivatives, (M x n)
+    :param controller: controller(states) -> controls (M x k), e.g.
+     inference.NetworkController
+    :param initial_states: M x n
+    :param final_check: final_check(states) -> (crash, done) boolean arrays
+    :return: dict of per trajectory arrays: 'outcome' (first event,
+     OUTCOME_*), 't_event' (time of the first event, nan if none),
+     't_final', 'final_state' and, if history, 'states' (steps+1 x M x n,
+     nan once stopped) and 'controls' (steps x M x k)
+    """
+    states = np.array(initial_states, dtype=np.float64)
+    n_trajs = states.shape[0]
+    n_steps = int(max_time/dt)
+
+    outcome = np.full(n_trajs, OUTCOME_NONE)
+    t_event = np.full(n_trajs, np.nan)
+    t_final = np.full(n_trajs, n_steps * dt)
+    active = np.ones(n_trajs, dtype=bool)
+    if history:
+        states_history = np.full((n_steps + 1, ) + states.shape, np.nan)
+        states_history[0] = states
+        controls_history = []
+
+    steps = 0
+    for i in range(n_steps):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        steps += 1
+
+        controls = np.asarray(controller(states[idx]), dtype=np.float64)
+        controls = controls.reshape(len(idx), -1)
+        states[idx] = _rk4_step(dynamics, states[idx], controls, dt)
+        t = (i + 1) * dt
+
+        if history:
+            states_history[i + 1, idx] = states[idx]
+            step_controls = np.full((n_trajs, controls.shape[1]), np.nan)
+            step_controls[idx] = controls
+            controls_history.append(step_controls)
+
+        crash, done = final_check(states[idx])
+        crash = np.asarray(crash, dtype=bool)
+        done = np.asarray(done, dtype=bool) & ~crash
+
+        first = outcome[idx] == OUTCOME_NONE
+        outcome[idx[first & crash]] = OUTCOME_CRASH
+        outcome[idx[first & done]] = OUTCOME_DONE
+        t_event[idx[first & (crash | done)]] = t
+
+        stop = (crash & stop_if_crash) | (done & stop_if_done)
+        t_final[idx[stop]] = t
+        active[idx[stop]] = False
+
+    results = {'outcome': outcome, 't_event': t_event, 't_final': t_final,
+               'final_state': states}
+    if history:
+        results['states'] = states_history[:steps + 1]
+        results['controls'] = np.asarray(controls_history)
+    return results
+
+
 def evaluate_traj(nn_traj, opt_traj, value_err, targets=None,
                   norms=None, ):
     """Evaluate the NN-driven trajectory.
@@ -13,6 +13,7 @@ except:
         return kwargs.get('iterable', None)
 
 import os
+import shutil
 
 import json
 
@@ -48,7 +49,7 @@ def get_name(model, netfolder='nets'):
 
 def load_minibatch(x, y, index, batch_size, random_idx=None):
 
-    if not random_idx:
+    if random_idx is None:
         random_idx = range(y.shape[0])
 
     index %= (len(random_idx)/batch_size)
@@ -272,12 +273,119 @@ def postprocess(model, y):
     return y
 
 
+def preprocess_minibatch(model, x, y):
+    """Normalises a minibatch (returns copies), as preprocess_dataset does
+    for the whole dataset"""
+
+    x = (x - np.asarray(model['X_norm'][0])) / np.asarray(model['X_norm'][1])
+    y = (y - np.asarray(model['Y_norm'][0])) / np.asarray(model['Y_norm'][1])
+
+    if model['output_mode'] == OUTPUT_LOG:
+        maxmin = np.asarray(model['maxmin'])
+        y = ((y - maxmin[:, 0])/(maxmin[:, 1] - maxmin[:, 0]) - 0.5) * 2
+
+    return x, y
+
+
+DATASET_KEYS = ['X_train', 'Y_train', 'X_test', 'Y_test', 'idx_train']
+
+
+def _write_dataset(data, directory, replace=False):
+    # Written aside and renamed, several training processes may race here.
+    # replace: an existing directory (and its norm.json) is replaced, else
+    # the one another process wrote first is kept
+    tmp = directory + '.tmp' + str(os.getpid())
+    os.makedirs(tmp)
+    for key, values in zip(DATASET_KEYS, data):
+        dtype = np.int64 if key == 'idx_train' else np.float64
+        np.save(tmp + '/' + key + '.npy', np.asarray(values, dtype=dtype))
+    old = None
+    if replace and os.path.isdir(directory):
+        old = directory + '.old' + str(os.getpid())
+        os.rename(directory, old)
+    try:
+        os.rename(tmp, directory)
+    except OSError:
+        shutil.rmtree(tmp)
+        if old is not None:
+            # The previous dataset is put back
+            os.rename(old, directory)
+        if replace or not os.path.isdir(directory):
+            raise
+    if old is not None:
+        shutil.rmtree(old)
+
+
 def save_training_data(data, dataname):
+    """Saves [x_train, y_train, x_test, y_test, idx_train] as .npy files in
+    traj/<dataname>/, replacing a previous dataset of that name (and its
+    cached normalisation)"""
 
     if not os.path.exists('traj'):
         os.makedirs('traj')
 
-    pickle.dump(data, open('traj/' + dataname + '.pic', 'wb'))
+    _write_dataset(data, 'traj/' + dataname, replace=True)
+
+
+def open_training_data(dataname, base_dir='./'):
+    """Memory-maps the dataset traj/<dataname>/ (read-only, the pages are
+    shared by all the processes training on it). A traj/<dataname>.pic file
+    from older versions is converted on first use."""
+
+    directory = base_dir + 'traj/' + dataname
+    if not os.path.isdir(directory):
+        _write_dataset(pickle.load(open(directory + '.pic', 'rb')), directory)
+
+    return {key: np.load(directory + '/' + key + '.npy', mmap_mode='r')
+            for key in DATASET_KEYS}
+
+
+def _column_stats(data, chunk_size=1000000):
+    """Column means, standard deviations, minima and maxima, in chunks"""
+
+    n = 0
+    mean = np.zeros(data.shape[1])
+    m2 = np.zeros(data.shape[1])
+    data_min = np.full(data.shape[1], np.inf)
+    data_max = np.full(data.shape[1], -np.inf)
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size], dtype=np.float64)
+        k = chunk.shape[0]
+        chunk_mean = chunk.mean(axis=0)
+        delta = chunk_mean - mean
+        mean = mean + delta * k / (n + k)
+        m2 = m2 + ((chunk - chunk_mean)**2).sum(axis=0) + delta**2 * n * k / (n + k)
+        n += k
+        data_min = np.minimum(data_min, chunk.min(axis=0))
+        data_max = np.maximum(data_max, chunk.max(axis=0))
+
+    return mean, np.sqrt(m2 / n), data_min, data_max
+
+
+def training_normalization(model, data, dataname, base_dir='./'):
+    """Sets the X_norm, Y_norm and maxmin of model (unless already there)
+    from the training set statistics, cached in traj/<dataname>/norm.json"""
+
+    norm_file = base_dir + 'traj/' + dataname + '/norm.json'
+    if os.path.isfile(norm_file):
+        norm = json.load(open(norm_file))
+    else:
+        xmean, xstd, _, _ = _column_stats(data['X_train'])
+        ymean, ystd, ymin, ymax = _column_stats(data['Y_train'])
+        # maxmin is taken on the normalised outputs
+        maxmin = np.column_stack(((ymin - ymean) / ystd, (ymax - ymean) / ystd))
+        norm = {'X_norm': [xmean.tolist(), xstd.tolist()],
+                'Y_norm': [ymean.tolist(), ystd.tolist()],
+                'maxmin': maxmin.tolist()}
+        tmp = norm_file + '.tmp' + str(os.getpid())
+        json.dump(norm, open(tmp, 'w'))
+        os.rename(tmp, norm_file)
+
+    for key, value in norm.items():
+        if key not in model:
+            model[key] = value
+
+    return model
 
 
 def load_model(modelfile):
@@ -294,13 +402,9 @@ def load_network(model, base_dir='./', netfolder='nets'):
     
 def load_training_data(model, base_dir='./'):
 
-    [x_train, y_train, x_test, y_test, idx_train] = pickle.load(open(base_dir +'traj/' + model['data'] + '.pic', 'rb'))
-
-    data = {'X_train': x_train,
-            'Y_train': y_train,
-            'X_test': x_test,
-            'Y_test': y_test,
-            'idx_train': idx_train}
+    data = open_training_data(model['data'], base_dir)
+    data = {key: np.array(value) for key, value in data.items()}
+    data['idx_train'] = list(data['idx_train'])
 
     model, data = preprocess_dataset(model, data)
     return data
@@ -314,19 +418,17 @@ def train(model):
 
     print('========================')
     print('Loading data...')
-    print('traj/' + model['data'] + '.pic')
-
-    [x_train, y_train, x_test, y_test, idx_train] = pickle.load(open('traj/' + model['data'] + '.pic', 'rb'))
+    print('traj/' + model['data'])
 
-    data = {'X_train': x_train,
-            'Y_train': y_train,
-            'X_test': x_test,
-            'Y_test': y_test,
-            'idx_train': idx_train}
+    # Memory-mapped, normalised minibatch by minibatch
+    data = open_training_data(model['data'])
+    y_train = data['Y_train']
+    y_test = data['Y_test']
+    idx_train = data['idx_train']
 
     print('=======================')
     print('Preprocessing...')
-    model, data = preprocess_dataset(model, data)
+    model = training_normalization(model, data, model['data'])
 
     network = get_network(model)
 
@@ -346,14 +448,14 @@ def train(model):
     minErr = np.Inf
     minEpoch = 0
     tmp_nns = []
-    print(np.min(data['Y_train']))
-    print(np.max(data['Y_train']))
-    print(np.any(np.isnan(data['Y_train'])))
+    print(model['maxmin'])
+    print(np.any(np.isnan(model['Y_norm'][0])))
     try:
         for epoch in range(model['epochs']):
             epoch_loss = []
             for i in tqdm(range(int(y_train.shape[0]/model['batch_size'])), 'Training, epoch ' + str(epoch), leave=True):
                 xt, yt = load_minibatch(data['X_train'], data['Y_train'], i, model['batch_size'], idx_train)
+                xt, yt = preprocess_minibatch(model, xt, yt)
                 yt = yt.take([take_control], 1)
                 pred = network['pred'](xt)
                 if  np.isnan(pred[0]) or np.any(np.isnan(pred)) or                                  np.any(np.isnan(lasagne.layers.get_all_param_values(network['layers'])[0])):
@@ -369,6 +471,7 @@ def train(model):
             epoch_loss = []
             for i in tqdm(range(int(y_train.shape[0]/model['batch_size'])), 'Training, epoch ' + str(epoch), leave=True):
                 xt, yt = load_minibatch(data['X_train'], data['Y_train'], i, model['batch_size'], idx_train)
+                xt, yt = preprocess_minibatch(model, xt, yt)
                 yt = yt.take([take_control], 1)
                 loss = network['eval'](xt, yt)
                 epoch_loss.append(loss)
@@ -384,6 +487,7 @@ def train(model):
             loss = []
             for i in tqdm(range(int(data['Y_test'].shape[0]/model['batch_size'])), 'Training, epoch ' + str(epoch), leave=True):
                 xt, yt = load_minibatch(data['X_test'], data['Y_test'], i, model['batch_size'], range(data['Y_test'].shape[0]))
+                xt, yt = preprocess_minibatch(model, xt, yt)
                 yt = yt.take([take_control], 1)
                 l = network['eval'](xt, yt)
                 loss.append(l)
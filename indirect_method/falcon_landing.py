@@ -16,6 +16,137 @@ from copy import deepcopy
 import sys
 import numpy as np
 
+from shooting import njit, shoot_many, variational_shoot, hamiltonian_gradient
+from shooting import keep_shot, dense_shot, switched_shoot, reduced_odeint
+from shooting import multiple_shoot, multiple_shoot_gradient, multiple_shoot_trajectory
+from shooting import counters, ShotCache, memoised_constraints
+
+
+@njit(cache=True, error_model='numpy')
+def _rhs_kernel(full_state, c1, c2, c3, g, homotopy, throttle):
+    """Compiled state + costate right hand side (same as tv_landing._eom).
+    A throttle >= 0 replaces the bang-bang switching (homotopy == 1) on a known arc."""
+    x, y, vx, vy, theta, omega, m, lx, ly, lvx, lvy, ltheta, lomega, lm = full_state
+    st = np.sin(theta)
+    ct = np.cos(theta)
+
+    # Pontryagin minimum principle
+    lauxx = lvx - lomega / c3 * ct
+    lauxy = lvy + lomega / c3 * st
+    laux = np.sqrt(lauxx**2 + lauxy**2)
+    ut0 = - lauxx / laux
+    ut1 = - lauxy / laux
+
+    if homotopy == 1:
+        S = 1. - lm - laux * c2 / m
+        u = 0. if S >= 0 else 1.
+        if throttle >= 0:
+            u = throttle
+    else:
+        u = 1. / 2. / c1 / (1. - homotopy) * (lm + laux * c2 / m - homotopy)
+        u = min(max(u, 0.), 1.)
+
+    tdotit = ut0 * ct - ut1 * st
+    tdotitheta = ut0 * st + ut1 * ct
+    lvdott = lvx * ut0 + lvy * ut1
+
+    dy = np.empty(14)
+    dy[0] = vx
+    dy[1] = vy
+    dy[2] = c1 * u / m * ut0
+    dy[3] = c1 * u / m * ut1 - g
+    dy[4] = omega
+    dy[5] = - c1 / c3 * u / m * tdotit
+    dy[6] = - c1 / c2 * u
+    dy[7] = 0.
+    dy[8] = 0.
+    dy[9] = - lx
+    dy[10] = - ly
+    dy[11] = - lomega / c3 * c1 * u / m * tdotitheta
+    dy[12] = - ltheta
+    dy[13] = c1 / m**2 * u * (lvdott - lomega / c3 * tdotit)
+    return dy
+
+
+@njit(cache=True, error_model='numpy')
+def _jac_kernel(full_state, c1, c2, c3, g, homotopy, throttle):
+    """Analytic Jacobian of _rhs_kernel w.r.t. the full state"""
+    x, y, vx, vy, theta, omega, m, lx, ly, lvx, lvy, ltheta, lomega, lm = full_state
+    st = np.sin(theta)
+    ct = np.cos(theta)
+
+    lauxx = lvx - lomega / c3 * ct
+    lauxy = lvy + lomega / c3 * st
+    laux = np.sqrt(lauxx**2 + lauxy**2)
+    dlauxx = np.zeros(14)
+    dlauxx[4] = lomega / c3 * st
+    dlauxx[9] = 1.
+    dlauxx[12] = - ct / c3
+    dlauxy = np.zeros(14)
+    dlauxy[4] = lomega / c3 * ct
+    dlauxy[10] = 1.
+    dlauxy[12] = st / c3
+    dlaux = (lauxx * dlauxx + lauxy * dlauxy) / laux
+
+    # Derivatives of the thrust direction
+    ut0 = - lauxx / laux
+    ut1 = - lauxy / laux
+    dtt = (lauxy * dlauxx - lauxx * dlauxy) / laux**2
+    dut0 = ut1 * dtt
+    dut1 = - ut0 * dtt
+
+    # Throttle and its derivatives (zero when saturated or bang-bang)
+    du = np.zeros(14)
+    if homotopy == 1:
+        S = 1. - lm - laux * c2 / m
+        u = 0. if S >= 0 else 1.
+        if throttle >= 0:
+            u = throttle
+    else:
+        k = 1. / 2. / c1 / (1. - homotopy)
+        u = k * (lm + laux * c2 / m - homotopy)
+        if u > 0. and u < 1.:
+            du = k * c2 / m * dlaux
+            du[6] -= k * laux * c2 / m**2
+            du[13] += k
+        u = min(max(u, 0.), 1.)
+
+    tdotit = ut0 * ct - ut1 * st
+    tdotitheta = ut0 * st + ut1 * ct
+    lvdott = lvx * ut0 + lvy * ut1
+    dtdotit = dut0 * ct - dut1 * st
+    dtdotit[4] -= tdotitheta
+    dtdotitheta = dut0 * st + dut1 * ct
+    dtdotitheta[4] += tdotit
+    dlvdott = lvx * dut0 + lvy * dut1
+    dlvdott[9] += ut0
+    dlvdott[10] += ut1
+    w = lvdott - lomega / c3 * tdotit
+    dw = dlvdott - lomega / c3 * dtdotit
+    dw[12] -= tdotit / c3
+
+    J = np.zeros((14, 14))
+    J[0, 2] = 1.
+    J[1, 3] = 1.
+    J[2] = c1 / m * (du * ut0 + u * dut0)
+    J[2, 6] -= c1 * u / m**2 * ut0
+    J[3] = c1 / m * (du * ut1 + u * dut1)
+    J[3, 6] -= c1 * u / m**2 * ut1
+    J[4, 5] = 1.
+    J[5] = - c1 / c3 / m * (du * tdotit + u * dtdotit)
+    J[5, 6] += c1 / c3 * u / m**2 * tdotit
+    J[6] = - c1 / c2 * du
+    J[9, 7] = -1.
+    J[10, 8] = -1.
+    J[11] = - lomega / c3 * c1 / m * (du * tdotitheta + u * dtdotitheta)
+    J[11, 6] += lomega / c3 * c1 * u / m**2 * tdotitheta
+    J[11, 12] -= c1 / c3 * u / m * tdotitheta
+    J[12, 11] = -1.
+    J[13] = c1 / m**2 * (du * w + u * dw)
+    J[13, 6] -= 2. * c1 / m**3 * u * w
+    return J
+
+
 class tv_landing(base):
     def __init__(
             self,
@@ -27,7 +158,11 @@ class tv_landing(base):
             g = 9.81,
             homotopy = 0.,
             pinpoint = False,
-            normas = 80000.
+            normas = 80000.,
+            compiled = False,
+            switch_events = False,
+            segments = 1,
+            reduced = False
             ):
         """
         USAGE: tv_landing(self, start, end, Isp, Tmax, mu):
@@ -40,9 +175,16 @@ class tv_landing(base):
         * g: planet gravity [m/s**2]
         * homotopy: homotopy parameter, 0->QC, 1->MOC
         * pinpoint: if True toggles the final constraint on the landing x
+        * compiled: if True integrates with the compiled right hand side and its analytic Jacobian
+        * switch_events: if True the bang-bang trajectories (homotopy 1) are integrated arc by arc, the switches being located as events
+        * segments: number of multiple shooting segments (1: single shooting), the decision vector is [costates0, full states at the start of the segments 1..K-1, tf]
+        * reduced: if True only the costates without a closed form are integrated (lx, ly are constant, lvx, lvy linear in time)
         """
 
-        super(tv_landing, self).__init__(8, 0, 1, 8, 0, 1e-3)
+        # Multiple shooting adds the segment starts to x and the defects to ceq
+        n_segment = 14 * (segments - 1)
+        super(tv_landing, self).__init__(8 + n_segment, 0, 1, 8 + n_segment, 0, 1e-3)
+        self.segments = segments
         # We store the raw inputs for convenience
         self.state0_input = state0
         self.statet_input = statet
@@ -64,12 +206,15 @@ class tv_landing(base):
         self.g = g / self.A
       
         print(self.c1)
+        # Scales of the state variables (state / scales is non dimensional)
+        self._state_scales = np.array([self.R, self.R, self.V, self.V, self.RAD, 1. / (self.RAD * self.T), self.M])
+
         # We compute the initial and final state in the new units
         self.state0 = self._non_dim(self.state0_input)
         self.statet = self._non_dim(self.statet_input)
         
         # We set the bounds (these will only be used to initialize the population)
-        self.set_bounds([-1] * 7 + [1. / self.T], [1] * 7 + [100. / self.T])
+        self.set_bounds([-1] * 7 + [-10] * n_segment + [1. / self.T], [1] * 7 + [10] * n_segment + [100. / self.T])
 
         # Activates a pinpoint landing
         self.pinpoint = pinpoint
@@ -77,38 +222,101 @@ class tv_landing(base):
         # Selects the homotopy parameter, 0->QC, 1->MOC
         self.homotopy = homotopy
 
+        # Selects the compiled right hand side (the Python one is the reference)
+        self.compiled = compiled
+
+        # Integrates the bang-bang arcs separately (see shooting.switched_shoot)
+        self.switch_events = switch_events
+
+        # Integrates the costates lx, ly, lvx, lvy (indices below) in closed
+        # form (see shooting.reduced_odeint)
+        self.reduced = reduced
+        self._linear_costates = (7, 8, 9, 10)
+
+        # Last shots (constraints and trajectories), repeated x are not shot again
+        self.shot_cache = ShotCache()
+
+        # Integration tolerance while the constraints violation is above each
+        # threshold, 1e-5 below them (see shooting.tolerance_for)
+        self.tolerance_schedule = []  # the reference is already loose
+        # Tolerance of the current tier, None for the reference 1e-5
+        self.shoot_tol = None
+
+    def set_parameters(self, state0=None, homotopy=None):
+        """
+        Re-parameterises the problem in place, cheaper than building a new one
+
+        * state0: initial state, dimensional as in the constructor
+        * homotopy: homotopy parameter, 0->QC, 1->MOC
+        """
+        if state0 is not None:
+            self.state0_input = state0
+            self.state0 = self._non_dim(state0)
+        if homotopy is not None:
+            self.homotopy = homotopy
+        # The last shot (dense output) belongs to the old parameters
+        self._last_shot = None
+
     def _objfun_impl(self, x):
         return(1.,) # constraint satisfaction, no objfun
 
+    @memoised_constraints
     def _compute_constraints_impl(self, x):
         # Perform one forward shooting
+        counters['shoots'] += 1
+        if self.segments > 1:
+            return multiple_shoot(self, x, self.segments, rtol=self.shoot_tol or 1e-5, atol=self.shoot_tol or 1e-5, max_step=0.01)
         xf, info = self._shoot(x)
+        return self._final_constraints(xf[-1])
 
+    def _final_constraints(self, full_state):
         # Assembling the equality constraint vector
         ceq = list([0]*8)
 
         # Final conditions
         if self.pinpoint:
             #Pinpoint landing x is fixed lx is free
-            ceq[0] = (xf[-1][0] - self.statet[0] ) * 1
+            ceq[0] = (full_state[0] - self.statet[0] ) * 1
         else:
             #Transversality condition: x is free lx is 0
-            ceq[0] = xf[-1][7] * 1
+            ceq[0] = full_state[7] * 1
 
-        ceq[1] = (xf[-1][1] - self.statet[1] ) * 1
-        ceq[2] = (xf[-1][2] - self.statet[2] ) * 1
-        ceq[3] = (xf[-1][3] - self.statet[3] ) * 1
-        ceq[4] = (xf[-1][4] - self.statet[4] ) * 1
+        ceq[1] = (full_state[1] - self.statet[1] ) * 1
+        ceq[2] = (full_state[2] - self.statet[2] ) * 1
+        ceq[3] = (full_state[3] - self.statet[3] ) * 1
+        ceq[4] = (full_state[4] - self.statet[4] ) * 1
 
         
         # Transversality condition on omega and mass (free)
-        ceq[5] = xf[-1][12] * 1
-        ceq[6] = xf[-1][13] * 1
+        ceq[5] = full_state[12] * 1
+        ceq[6] = full_state[13] * 1
 
         # Free time problem, Hamiltonian must be 0
-        ceq[7] = self._hamiltonian(xf[-1]) * 1
+        ceq[7] = self._hamiltonian(full_state) * 1
         return ceq
 
+    def _final_constraints_jacobian(self, full_state):
+        # Derivatives of _final_constraints w.r.t. the final full state
+        dceq = np.zeros((8, 14))
+        if self.pinpoint:
+            dceq[0, 0] = 1
+        else:
+            dceq[0, 7] = 1
+        for i in range(1, 5):
+            dceq[i, i] = 1
+        dceq[5, 12] = 1
+        dceq[6, 13] = 1
+        dceq[7] = hamiltonian_gradient(self, full_state)
+        return dceq
+
+    def _compute_constraints_gradient_impl(self, x):
+        counters['gradients'] += 1
+        if self.segments > 1:
+            return multiple_shoot_gradient(self, x, self.segments, rtol=self.shoot_tol or 1e-5, atol=self.shoot_tol or 1e-5, max_step=0.01)
+        # One integration of the trajectory and of its variational equations
+        xf, dxf = variational_shoot(self, x, rtol=self.shoot_tol or 1e-5, atol=self.shoot_tol or 1e-5, max_step=0.01)
+        return np.dot(self._final_constraints_jacobian(xf), dxf)
+
     def _hamiltonian(self, full_state):
         state = full_state[:7]
         costate = full_state[7:]
@@ -214,6 +422,12 @@ class tv_landing(base):
             u = max(u,0.)
         return u, ut
 
+    def _switching_function(self, full_state):
+        # Switching function of the mass optimal throttle (u = 1 where S < 0)
+        x,y,vx,vy,theta,omega,m,lx,ly,lvx,lvy,ltheta,lomega,lm = full_state
+        laux = sqrt((lvx - lomega / self.c3 * cos(theta))**2 + (lvy + lomega / self.c3 * sin(theta))**2)
+        return 1. - lm - laux * self.c2 / m
+
     def _eom(self, full_state, t):
         # Applying Pontryagin minimum principle
         state = full_state[:7]
@@ -224,31 +438,110 @@ class tv_landing(base):
         dcostate = self._eom_costate(full_state, controls)
         return dstate + dcostate
 
+    def _eom_compiled(self, full_state, t, throttle=-1.):
+        return _rhs_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.c3, self.g, float(self.homotopy), throttle)
+
+    def _eom_jacobian(self, full_state, t, throttle=-1.):
+        return _jac_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.c3, self.g, float(self.homotopy), throttle)
+
+    def _rhs(self):
+        # Right hand side and Jacobian handed to the integrator
+        if self.compiled:
+            return self._eom_compiled, self._eom_jacobian
+        return lambda a,b: self._eom(a,b), None
+
+    def _pontryagin_minimum_principle_many(self, full_states):
+        # Vectorized _pontryagin_minimum_principle, columns u, ut[0], ut[1]
+        x,y,vx,vy,theta,omega,m,lx,ly,lvx,lvy,ltheta,lomega,lm = full_states.T
+        c1 = self.c1
+        c2 = self.c2
+        c3 = self.c3
+
+        lauxx = lvx - lomega / c3 * np.cos(theta)
+        lauxy = lvy + lomega / c3 * np.sin(theta)
+        laux = np.sqrt(lauxx**2 + lauxy**2)
+        ut0 = - lauxx / laux
+        ut1 = - lauxy / laux
+
+        if self.homotopy == 1:
+            u = np.where(1. - lm - laux * c2 / m >= 0, 0., 1.)
+        else:
+            u = 1. / 2. / c1 / (1. - self.homotopy) * (lm + laux * c2 / m - self.homotopy)
+            u = np.clip(u, 0., 1.)
+        return np.column_stack((u, ut0, ut1))
+
+    def _switching_function_many(self, full_states):
+        # Vectorized _switching_function
+        x,y,vx,vy,theta,omega,m,lx,ly,lvx,lvy,ltheta,lomega,lm = full_states.T
+        laux = np.sqrt((lvx - lomega / self.c3 * np.cos(theta))**2 + (lvy + lomega / self.c3 * np.sin(theta))**2)
+        return 1. - lm - laux * self.c2 / m
+
+    def _hamiltonian_many(self, full_states):
+        # Vectorized _hamiltonian
+        c1 = self.c1
+        c2 = self.c2
+        u = self._pontryagin_minimum_principle_many(full_states)[:, 0]
+        f_vett = self._eom_many(full_states)[:, :7]
+        cost = self.homotopy * c1 / c2 * u + (1 - self.homotopy) * c1**2 / c2 * u**2
+        return np.sum(full_states[:, 7:] * f_vett, axis=1) + cost
+
+    def _eom_many(self, full_states):
+        # Vectorized _eom, one full state per row
+        x,y,vx,vy,theta,omega,m,lx,ly,lvx,lvy,ltheta,lomega,lm = full_states.T
+        g = self.g
+        c1 = self.c1
+        c2 = self.c2
+        c3 = self.c3
+        st = np.sin(theta)
+        ct = np.cos(theta)
+        u, ut0, ut1 = self._pontryagin_minimum_principle_many(full_states).T
+
+        tdotit = ut0 * ct - ut1 * st
+        tdotitheta = ut0 * st + ut1 * ct
+        lvdott = lvx * ut0 + lvy * ut1
+        dm = - c1 / c2 * u
+
+        zero = np.zeros_like(x)
+        return np.column_stack((vx, vy, c1 * u / m * ut0, c1 * u / m * ut1 - g, omega, - c1 / c3 * u / m * tdotit, dm,
+                                zero, zero, - lx, - ly, - lomega / c3 * c1 * u / m * tdotitheta, - ltheta,
+                                c1 / m**2 * u * (lvdott - lomega / c3 * tdotit)))
+
+    def shoot_many(self, X):
+        # Integrates all the decision vectors (rows of X) at once, returns the constraints
+        if self.segments > 1:
+            return np.array([self._compute_constraints_impl(x) for x in X])
+        tol = self.shoot_tol or 1e-5
+        return shoot_many(self, X, rtol=tol, atol=tol, max_step=0.01)
+
     def _shoot(self, x):
         # Numerical Integration
-        xf, info = odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), linspace(0, x[-1],1000), rtol=1e-5, atol=1e-5, 
-            full_output=1, 
-            mxstep=5000, hmax=0.01, hmin=1e-12, printmessg=False)
+        eom, jac = self._rhs()
+        tol = self.shoot_tol or 1e-5
+        tspan = linspace(0, x[-1],1000)
+        if self.segments > 1:
+            xf, info = multiple_shoot_trajectory(self, x, tspan, self.segments, rtol=tol, atol=tol, mxstep=5000, hmax=0.01, hmin=1e-12), {}
+        elif self.homotopy == 1 and self.switch_events:
+            xf, info = switched_shoot(self, x, tspan, rtol=tol, atol=tol, mxstep=5000, hmax=0.01, hmin=1e-12)
+        elif self.reduced:
+            xf, info = reduced_odeint(self, self.state0 + list(x[:-1]), tspan, rtol=tol, atol=tol, full_output=1, mxstep=5000, hmax=0.01, hmin=1e-12, printmessg=False)
+        else:
+            xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=tol, atol=tol, 
+                full_output=1, 
+                mxstep=5000, hmax=0.01, hmin=1e-12, printmessg=False)
+        keep_shot(self, x, tspan, xf, info)
         return xf, info
 
     def _simulate(self, x, tspan):
         # Numerical Integration
         print('simulate')
-        xf= odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), tspan, rtol=1e-6, atol=1e-6, full_output=0, 
+        eom, jac = self._rhs()
+        xf= odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=1e-6, atol=1e-6, full_output=0, 
             mxstep=5000,hmax=0.01, hmin=1e-8, printmessg=False)
         info = []
         return xf, info
 
     def _non_dim(self, state):
-        xnd = deepcopy(state)
-        xnd[0] /= self.R
-        xnd[1] /= self.R
-        xnd[2] /= self.V
-        xnd[3] /= self.V
-        xnd[4] /= self.RAD
-        xnd[5] *= (self.RAD*self.T)
-        xnd[6] /= self.M
-        return xnd
+        return (np.asarray(state, dtype=float) / self._state_scales).tolist()
 
     def _dim_back(self, state):
         xd = deepcopy(state)
@@ -270,30 +563,12 @@ class tv_landing(base):
         # Producing the data
         tspan = linspace(0, x[-1], 300)
         full_state, info = self._simulate(x, tspan)
+        controls = self._pontryagin_minimum_principle_many(full_state)
+        ux = controls[:, 0] * controls[:, 1]
+        uy = controls[:, 0] * controls[:, 2]
         # Putting dimensions back
-        res = list()
-        controls = list()
-        ux = list(); uy=list()
-        for line in full_state:
-            res.append(self._dim_back(line[:7]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            ux.append(controls[-1][0] * controls[-1][1][0])
-            uy.append(controls[-1][0] * controls[-1][1][1])
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        theta = list()
-        omega = list()
-        m = list()
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            theta.append(state[4])
-            omega.append(state[5])
-            m.append(state[6])
+        x, y, vx, vy, theta, omega, m = self._dim_back(full_state[:, :7].T)
+        tspan = tspan * self.T
 
         fig = plt.figure()
         ax = fig.gca()
@@ -312,10 +587,10 @@ class tv_landing(base):
         axarr[2,0].plot(tspan, theta)
         axarr[2,0].set_xlabel('t'); axarr[2,0].set_ylabel('theta');
 
-        axarr[0,1].plot(tspan, [controls[ix][0] for ix in range(len(controls))],'r')
+        axarr[0,1].plot(tspan, controls[:, 0],'r')
         axarr[0,1].set_ylabel('u')
         axarr[0,1].set_xlabel('t')
-        axarr[1,1].plot(tspan, [controls[ix][1][0] for ix in range(len(controls))],'k')
+        axarr[1,1].plot(tspan, controls[:, 1],'k')
         axarr[1,1].set_ylabel('sin(ut)')
         axarr[1,1].set_xlabel('t')
 
@@ -348,46 +623,14 @@ class tv_landing(base):
 
     def produce_data(self, x, npoints):
 
-        # Producing the data
+        # Producing the data (dense output of the shot, no new integration)
         tspan = linspace(0, x[-1], npoints)
-        full_state, info = self._simulate(x, tspan)
+        full_state = dense_shot(self, x, tspan, tol=1e-5, rtol=1e-6, atol=1e-6)
+        controls = self._pontryagin_minimum_principle_many(full_state)
         # Putting dimensions back
-        res = list()
-        controls = list()
-        u1 = list(); u2 = list()
-        for line in full_state:
-            res.append(self._dim_back(line[:7]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            u1.append(controls[-1][0])
-            u2.append(controls[-1][1])
-        u1 = vstack(u1)
-        u2 = vstack(u2)
-
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        theta = list(); omega = list()
-        m = list()
-
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            theta.append(state[4])
-            omega.append(state[5])
-            m.append(state[6])
-
-        tspan = vstack(tspan)
-        x = vstack(x)
-        y = vstack(y)
-        vx = vstack(vx)
-        vy = vstack(vy)
-        theta =vstack(theta)
-        omega = vstack(omega)
-        m = vstack(m)
-        return (hstack((tspan, x, y, vx, vy, theta, omega, m)), hstack((u1, u2)))
+        state = self._dim_back(full_state[:, :7].T).T
+        return (hstack((vstack(tspan * self.T), state)), controls)
+
 
 
 
@@ -0,0 +1,284 @@
+"""Benchmarks of the shooting and of the data generation.
+
+Every benchmark starts from a fixed initial state and guess of each model,
+with fixed seeds:
+
+ - shoot: a single _shoot at homotopy 0 and 1
+ - constraints: 20 _compute_constraints_impl around the QC guess and the
+   solution at homotopy 1 (throughput)
+ - qc: full solve at homotopy 0 (quadratic control)
+ - homotopy: homotopy path from the QC solution to homotopy 1 (mass optimal)
+ - walk: 50 steps of a random walk at homotopy 1 (its start is not timed)
+
+The median and 10/90 percentiles of the wall time and of the right hand side
+evaluations (shooting.counters) over the repetitions are printed, and can be
+saved and compared with a previous run:
+
+    python benchmark.py -m simple rw -b shoot qc --save before.json
+    python benchmark.py -m simple rw -b shoot qc --compare before.json
+
+"""
+from __future__ import print_function
+import argparse
+import json
+import random as rnd
+import sys
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+import numpy as np
+from numpy import pi
+
+from PyGMO import algorithm
+
+import generate_data
+from shooting import counters as shooting_counters
+
+BENCHMARKS = ['shoot', 'constraints', 'qc', 'homotopy', 'walk']
+
+# Initial state, guess of the QC solution, solution at homotopy 1 and walk
+# bounds of each model (the initial state is far enough from the bounds for
+# the walk of seed 0)
+MODELS = {
+    'simple': {
+        'problem': ('simple_landing', 'simple_landing'),
+        'state0': [10., 1000., 5., -5., 10000.],
+        'x_qc': [0.001, 0.002, 0.005, 0.012, 0.05, 3.],
+        'x_moc': [0.009802428243877, 0.011181634278009, 0.032485139587915,
+                  -0.002660915623558, 0.030750110380701, 4.135105417318235],
+        'bounds': [(-200, 200), (500, 2000), (-10, 10), (-30, 10),
+                   (8000, 12000)]},
+    'rw': {
+        'problem': ('rw_landing', 'rw_landing'),
+        'state0': [10., 1000., 5., -5., 0.05, 10000.],
+        'x_qc': [0.001, 0.002, 0.005, -0.012, 0.003, 0.1, 3.],
+        'x_moc': [0.026117003662585, 0.009764665760111, 0.087816358425879,
+                  0.000515016374942, 0.004424281147199, 0.031939684405784,
+                  4.696429591632608],
+        'bounds': [(-200, 200), (500, 2000), (-10, 10), (-30, 10),
+                   (-pi/20, pi/20), (8000, 12000)]},
+    'tv': {
+        'problem': ('tv_landing', 'tv_landing'),
+        'state0': [0., 1000., 0., -20., 0., 0., 10000.],
+        'x_qc': [0., 0., 0., -0.015, 0., 0., 0., 5.],
+        'x_moc': [0., 0.010715841987389, 0., -0.013205794549739, 0., 0.,
+                  0.031341347270739, 3.42850868426962],
+        'bounds': [(-20, 20), (500, 2000), (-1, 1), (-40, 5),
+                   (-0.1/360*2*pi, 0.1/360*2*pi),
+                   (-0.01/360*2*pi, 0.01/360*2*pi), (8000, 12000)]},
+    'falcon': {
+        'problem': ('falcon_landing', 'tv_landing'),
+        'state0': [0., 1500., 0., -200., 0., 0., 60000.],
+        'x_qc': [0.0004063623657985068, -0.015166893186127163,
+                 0.00047398741968363283, -0.0815609687198395,
+                 0.0005701909839526759, 0.00020132959190827737,
+                 0.35180899558417034, 1.6036558613069618],
+        'x_moc': [-1.818181633874e-06, 0.009785246295776, -1.23123213339e-06,
+                  -0.019949455286312, -1.07334984546e-06, -4.99487375855e-07,
+                  0.119670832345705, 1.197327173394352],
+        'bounds': [(-0.1, 0.1), (500, 2000), (-0.01, 0.01), (-300, -100),
+                   (-0.001/360*2*pi, 0.001/360*2*pi),
+                   (-0.001/360*2*pi, 0.001/360*2*pi), (50000, 90000)]},
+}
+
+WALK_STEPS = 50
+
+
+def _case(model):
+    # Problem class, initial state, QC guess, homotopy 1 solution and bounds
+    case = MODELS[model]
+    module, name = case['problem']
+    return (getattr(__import__(module), name), case['state0'], case['x_qc'],
+            case['x_moc'], case['bounds'])
+
+
+def default_algo():
+    """SLSQP, as used by the random walks of generate_data"""
+    return algorithm.scipy_slsqp(max_iter=30, acc=1E-8, epsilon=1.49e-08,
+                                 screen_output=False)
+
+
+@contextmanager
+def _quiet():
+    # The solvers print every solve
+    stdout = sys.stdout
+    sys.stdout = open('/dev/null', 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def _seed(seed):
+    rnd.seed(seed)
+    np.random.seed(seed)
+
+
+def _cold():
+    # A repetition must not reuse the cached shots of the previous one
+    for prob in generate_data._problems.values():
+        if getattr(prob, 'shot_cache', None) is not None:
+            prob.shot_cache.clear()
+
+
+def _measure(run):
+    """Wall time, right hand side evaluations and success of run()"""
+    rhs = shooting_counters['rhs']
+    t0 = timer()
+    ok = run()
+    return timer() - t0, shooting_counters['rhs'] - rhs, bool(ok)
+
+
+def _bench_shoot(model, algo, seed):
+    cls, state0, x_qc, x_moc, _ = _case(model)
+    runs = []
+    for homotopy, x in ((0, x_qc), (1, x_moc)):
+        prob = cls(state0=state0, homotopy=homotopy, pinpoint=True)
+        runs.append(_measure(lambda: prob._shoot(x) is not None))
+    return runs
+
+
+def _bench_constraints(model, algo, seed, n=20):
+    cls, state0, x_qc, x_moc, _ = _case(model)
+    _seed(seed)
+    runs = []
+    for homotopy, x in ((0, x_qc), (1, x_moc)):
+        prob = cls(state0=state0, homotopy=homotopy, pinpoint=True)
+        # Distinct points, no evaluation can be reused
+        xs = [list(np.asarray(x) * (1 + 1e-3 * np.random.randn(len(x))))
+              for _ in range(n)]
+        runs.append(_measure(lambda: [prob._compute_constraints_impl(xi)
+                                      for xi in xs]))
+    return runs
+
+
+def _bench_qc(model, algo, seed):
+    cls, state0, x_qc, _, _ = _case(model)
+    _seed(seed)
+    return _measure(lambda: generate_data.solve(cls, state0, 0, algo, x=x_qc,
+                                                display=False)['feasible'])
+
+
+def _bench_homotopy(model, algo, seed):
+    cls, state0, x_qc, _, _ = _case(model)
+    _seed(seed)
+    sol = generate_data.solve(cls, state0, 0, algo, x=x_qc, display=False)
+    if not sol['feasible']:
+        return float('nan'), float('nan'), False
+    x = list(sol['x'])
+    return _measure(lambda: generate_data.homotopy_path(
+        cls, state0, algo, start=(0, x), display=False)[1] == 1)
+
+
+def _bench_walk(model, algo, seed):
+    cls, state0, x_qc, _, bounds = _case(model)
+    _seed(seed)
+    # Timed from the first trajectory, the start of the walk
+    start = []
+
+    def checkpoint(state, control, x):
+        if not start:
+            start.append((timer(), shooting_counters['rhs']))
+
+    walk = generate_data.random_walk(cls, state0, bounds,
+                                     walk_length=WALK_STEPS + 1, algo=algo,
+                                     initial_x=[algo, 'homotopy', x_qc],
+                                     display=False, checkpoint=checkpoint)
+    if not start:
+        return float('nan'), float('nan'), False
+    return (timer() - start[0][0], shooting_counters['rhs'] - start[0][1],
+            len(walk) == WALK_STEPS + 1)
+
+
+def run(models, benchmarks, repeat=5, walk_repeat=1, algo=None, seed=0):
+    """Runs the benchmarks of each model.
+
+    :return: {model: {benchmark: {'wall': [...], 'rhs': [...], 'ok': [...]}}}
+     with a value per repetition (shoot and constraints have a row per
+     homotopy, e.g. 'shoot h=0' and 'shoot h=1')
+    """
+    algo = algo or default_algo()
+    results = {}
+    for model in models:
+        results[model] = {}
+        for bench in benchmarks:
+            n = walk_repeat if bench in ('homotopy', 'walk') else repeat
+            for i in range(n):
+                _cold()
+                with _quiet():
+                    r = globals()['_bench_' + bench](model, algo, seed + i)
+                rows = ([(bench + ' h=0', r[0]), (bench + ' h=1', r[1])]
+                        if bench in ('shoot', 'constraints')
+                        else [(bench, r)])
+                for name, (wall, rhs, ok) in rows:
+                    res = results[model].setdefault(name, {'wall': [],
+                                                           'rhs': [],
+                                                           'ok': []})
+                    res['wall'].append(float(wall))
+                    res['rhs'].append(float(rhs))
+                    res['ok'].append(bool(ok))
+    return results
+
+
+def _percentiles(values):
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return float('nan'), float('nan'), float('nan')
+    return tuple(np.percentile(values, [50, 10, 90]))
+
+
+def print_results(results, baseline=None):
+    """Median [10%, 90%] of the wall time and of the rhs evaluations, and the
+    ratio of the median wall time to the baseline"""
+    print('{:<8} {:<16} {:>3} {:>28} {:>26} {:>8}'.format(
+        'model', 'benchmark', 'ok', 'wall [s] median [p10, p90]',
+        'rhs median [p10, p90]', 'vs base'))
+    for model in sorted(results):
+        for bench in sorted(results[model]):
+            res = results[model][bench]
+            wall = _percentiles(res['wall'])
+            rhs = _percentiles(res['rhs'])
+            ratio = ''
+            try:
+                base = _percentiles(baseline[model][bench]['wall'])[0]
+                ratio = '{:.2f}x'.format(wall[0] / base)
+            except (TypeError, KeyError, ZeroDivisionError):
+                pass
+            print('{:<8} {:<16} {:>3} {:>10.4f} [{:.4f}, {:.4f}] '
+                  '{:>10.0f} [{:.0f}, {:.0f}] {:>8}'.format(
+                      model, bench,
+                      '{}/{}'.format(sum(res['ok']), len(res['ok'])),
+                      wall[0], wall[1], wall[2], rhs[0], rhs[1], rhs[2],
+                      ratio))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('-m', '--models', nargs='+', default=sorted(MODELS),
+                        choices=sorted(MODELS))
+    parser.add_argument('-b', '--benchmarks', nargs='+', default=BENCHMARKS,
+                        choices=BENCHMARKS)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('--walk-repeat', type=int, default=1,
+                        help='repetitions of homotopy and walk')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--snopt', action='store_true',
+                        help='solve with SNOPT instead of SLSQP')
+    parser.add_argument('--save', help='json file of the results')
+    parser.add_argument('--compare', help='json file of a previous run')
+    args = parser.parse_args()
+
+    algo = (algorithm.snopt(400, opt_tol=1e-4, feas_tol=1e-4) if args.snopt
+            else None)
+    results = run(args.models, args.benchmarks, args.repeat,
+                  args.walk_repeat, algo, args.seed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -4,22 +4,98 @@
  - homotopy from quadratic control to mass optimal
  - random walks from an initial trajectory
  - parallel generation
+ - append-only trajectory store (see trajectory_store)
+ - per solve metrics (see solve_log)
 
 @cesans 2016
 
 """
 from __future__ import print_function
 from random import random
+import random as rnd
 import sys
 import os
-from multiprocessing import Process
-import pickle
+import time
+from multiprocessing import Process, Queue, Value, Array, Lock, Pool
 from numpy import pi
 import numpy as np
 from numpy.linalg import norm
 
 from PyGMO import algorithm, population
 
+from shooting import counters as shooting_counters
+from newton_shooting import newton_shooting
+from trajectory_store import TrajectoryStoreWriter, store_size
+from warm_start import load_warm_start
+from solve_log import SolveLog
+
+
+# Shared (solves, failures) counters of the current worker, set by the pool
+_solver_counters = None
+
+# Cache of solved problems used as initial guesses (see set_warm_start)
+_warm_start = None
+
+# One problem per landing model in this process, re-parameterised by solve
+_problems = {}
+
+# Per solve metrics (a solve_log.SolveLog, see set_solve_log) and the
+# position of the current solve in the random walks
+_solve_log = None
+_walk_position = {'walk': -1, 'step': -1}
+
+
+def set_warm_start(cache):
+    """Enables (a warm_start.WarmStartCache) or disables (None) the warm
+    start of solve and random_walk from previously solved problems"""
+    global _warm_start
+    _warm_start = cache
+
+
+def set_solve_log(log):
+    """Enables (a solve_log.SolveLog) or disables (None) the metrics of
+    every solve"""
+    global _solve_log
+    _solve_log = log
+
+
+def _walk_scales(bounds, walk_bounds):
+    return [b[1] - b[0] for b in (walk_bounds or bounds)]
+
+
+def _get_problem(problem, state0, homotopy):
+    """Problem of the class `problem` for state0 and homotopy. The instance
+    is reused (set_parameters) by all the solves of the process, hence the
+    'prob' returned by solve is only valid until the next solve."""
+    prob = _problems.get(problem)
+    if prob is None or not hasattr(prob, 'set_parameters'):
+        prob = problem(state0=state0, homotopy=homotopy, pinpoint=True,)
+        _problems[problem] = prob
+    else:
+        prob.set_parameters(state0, homotopy)
+    return prob
+
+
+def _log_solve(problem, prob, homotopy, x, feasible, wall, work,
+               iterations=None):
+    try:
+        violation = norm(prob._compute_constraints_impl(x))
+    except Exception:
+        violation = float('nan')
+    _solve_log.write(model=problem.__name__, homotopy=homotopy,
+                     feasible=int(bool(feasible)), wall=round(wall, 6),
+                     iterations='' if iterations is None else iterations,
+                     violation=violation, **dict(_walk_position, **work))
+
+
+def _count_solve(feasible):
+    if _solver_counters is not None:
+        counters, worker_id = _solver_counters
+        with counters.get_lock():
+            counters[2 * worker_id] += 1
+            if not feasible:
+                counters[2 * worker_id + 1] += 1
+
 
 def solve(problem, state0, homotopy=0, algo=None,  x=None, display=True):
 #    algo = algorithm.scipy_slsqp(max_iter=30, acc=1E-4, epsilon=1e-6,
@@ -34,7 +110,11 @@ def solve(problem, state0, homotopy=0, algo=None,  x=None, display=True):
         # algo.screen_output = True
 
 
-    prob = problem(state0=state0, homotopy=homotopy, pinpoint=True,)
+    prob = _get_problem(problem, state0, homotopy)
+
+    if x is None and _warm_start is not None:
+        # Nearest solved problem as initial guess
+        x, _ = _warm_start.query(state0, homotopy)
 
 
 
@@ -44,6 +124,43 @@ def solve(problem, state0, homotopy=0, algo=None,  x=None, display=True):
         print('algo : ', algo)
         print('x : ', x)
 
+    t0 = time.time()
+    work = dict(shooting_counters)
+    iterations = None
+    if isinstance(algo, newton_shooting):
+        # Root finding on the constraints directly: no population, and the
+        # solver knows whether it converged (no feasibility re-shoots)
+        if x is None:
+            x = list(np.random.uniform(prob.lb, prob.ub))
+        x = champion = algo.solve(prob, x)
+        feasible = algo.converged
+        iterations = algo.iterations
+        if display:
+            print('iters  : ', algo.iterations, algo.message)
+    else:
+        x, feasible, champion = _evolve(prob, algo, x)
+
+    if display:
+        print('evx    : ', x)
+        print(feasible)
+    _count_solve(feasible)
+    work = dict((k, shooting_counters[k] - work[k]) for k in work)
+    if _solve_log is not None:
+        _log_solve(problem, prob, homotopy, champion, feasible,
+                   time.time() - t0, work, iterations)
+    if feasible and _warm_start is not None:
+        _warm_start.add(state0, homotopy, champion)
+#   if display:
+#       print( (u'\u2713' if feasible else u'\u2717') +
+#                ' (homotopy: {0})'.format(homotopy))
+
+    return {'x': champion, 'prob': prob, 'feasible': feasible,
+            'shoots': work['shoots']}
+
+
+def _evolve(prob, algo, x):
+    # Solves with a PyGMO algorithm, returns the last x, its feasibility and
+    # the champion of the population
     if x is None:
         pop = population(prob, 1)
     else:
@@ -67,18 +184,38 @@ def solve(problem, state0, homotopy=0, algo=None,  x=None, display=True):
     except ValueError:
         feasible=False
 
-    if display:
-        print('evx    : ', x)
-        print(feasible)
-#   if display:
-#       print( (u'\u2713' if feasible else u'\u2717') +
-#                ' (homotopy: {0})'.format(homotopy))
+    return x, feasible, pop.champion.x
 
-    return {'x': pop.champion.x, 'prob': prob, 'feasible': feasible}
+
+def _predict(alphas, xs, alpha, order=1):
+    """Extrapolates x(alpha) with the polynomial through the last order + 1
+    accepted points of the homotopy path (order 1: secant)"""
+    k = min(order + 1, len(xs))
+    x = np.zeros(len(xs[-1]))
+    for i in range(len(xs) - k, len(xs)):
+        w = 1.
+        for j in range(len(xs) - k, len(xs)):
+            if j != i:
+                w *= (alpha - alphas[j]) / (alphas[i] - alphas[j])
+        x += w * np.asarray(xs[i])
+    return x
 
 
 def homotopy_path(problem, state0, algo=None, start=(0, None), h_min=1e-4,
-                  h_max=0.5, h=0.1, display=True):
+                  h_max=0.5, h=0.1, display=True, order=1, target_shoots=None,
+                  max_solves=1000, checkpoint=None):
+    """Solves the problem for homotopy 1 following a path of solutions from
+    start[0].
+
+    Predictor-corrector: the initial guess at each homotopy value is
+    extrapolated from the last accepted solutions (order 0 reuses the last
+    one), and the step grows or shrinks with the work of the corrector
+    (shots per solve) w.r.t. target_shoots (by default the work of the first
+    step).
+
+    checkpoint(state, control, x, alpha) is called with the produce_data
+    output of each solution on the path, if given.
+    """
     
     sol = solve(problem, state0, start[0], algo, x=start[1], display=display)
 #    sol = solve(problem, state0, start[0], algo, x=ini_x, display=display)
@@ -90,33 +227,43 @@ def homotopy_path(problem, state0, algo=None, start=(0, None), h_min=1e-4,
         if display:
             print('\t > Homotopy path started with h: {0}'.format(h))
 
-    alpha = 0
-    trial_alpha = h
+    alpha = start[0]
+    trial_alpha = min(1, alpha + h)
     x = sol['x']
+    lb, ub = sol['prob'].lb, sol['prob'].ub
     h_min = 1e-12
     its = 0
     h_max=0.2
-    hpaths = []
-    state, control = sol['prob'].produce_data(x, 1000)
-    hpaths.append((state,control,x,0))
-    increase_fater = 5
-    inccount = 0
-    while h > h_min and its < 1000:
-        sol = solve(problem, state0, trial_alpha, algo, x=x, display=display)
+    if checkpoint:
+        state, control = sol['prob'].produce_data(x, 1000)
+        checkpoint(state, control, x, alpha)
+    alphas = [alpha]
+    xs = [np.asarray(x)]
+    while h > h_min and its < max_solves:
+        x_guess = np.clip(_predict(alphas, xs, trial_alpha, order), lb, ub)
+        sol = solve(problem, state0, trial_alpha, algo, x=list(x_guess),
+                    display=display)
         its +=1
         if sol['feasible']:
             x = sol['x']
             if trial_alpha == 1:
+                if _warm_start is not None:
+                    _warm_start.add_path(its + 1)
                 return sol,1
-            state, control = sol['prob'].produce_data(x, 1000)
-            hpaths.append((state,control,x,0,trial_alpha))
-            pickle.dump(hpaths,open('hpaths.pic','wb'))
-            inccount +=1
-            if inccount == 5:
-                h *= 2
-                inccount = 0
+            if checkpoint:
+                state, control = sol['prob'].produce_data(x, 1000)
+                checkpoint(state, control, x, trial_alpha)
+            alphas.append(trial_alpha)
+            xs.append(np.asarray(x))
+
+            # Step control on the work of the corrector
+            shoots = max(sol['shoots'], 1)
+            if target_shoots is None:
+                target_shoots = shoots
+            h *= min(2., max(0.5, float(target_shoots) / shoots))
             h = min(min(h, h_max), 1-trial_alpha)
-            print('Increasing h to: {}'.format(h))
+            if display:
+                print('\t > {} shoots, h: {}'.format(shoots, h))
             (alpha, trial_alpha) = (trial_alpha, trial_alpha+h)
             trial_alpha = min(1, trial_alpha)
         else:
@@ -135,6 +282,141 @@ def homotopy_path(problem, state0, algo=None, start=(0, None), h_min=1e-4,
     return sol, alpha
 
 
+# Problem and algorithm of a wavefront pool worker (set by _init_wavefront)
+_wavefront = {}
+
+
+def _init_wavefront(problem, algo):
+    # Pool initializer, also for the workers that are not forked
+    _wavefront['problem'] = problem
+    _wavefront['algo'] = algo
+
+
+def _wavefront_task(task):
+    state0, alpha, x, produce = task
+    sol = solve(_wavefront['problem'], state0, alpha, _wavefront['algo'], x=x,
+                display=False)
+    data = None
+    if sol['feasible'] and produce:
+        data = sol['prob'].produce_data(sol['x'], 1000)
+    return sol['feasible'], list(sol['x']), sol['shoots'], data
+
+
+def homotopy_wavefront(problem, states, algo=None, x0=None, n_processes=None,
+                       h=0.1, h_min=1e-4, h_max=0.2, order=1,
+                       max_stages=1000, display=True):
+    """Follows the homotopy from 0 to 1 for a batch of neighbouring initial
+    states at once.
+
+    At each stage all the states are solved in parallel, each one at the next
+    homotopy value of its own path from the extrapolation of the path (see
+    homotopy_path). The ones that fail are retried from the solution of the
+    nearest state that succeeded at the same homotopy value. The states that
+    succeed advance with the step of the wavefront, the ones that still fail
+    halve their own step (it grows back to the wavefront step as they
+    advance) and are retried at the next stage; below h_min they leave the
+    batch.
+
+    :param x0: initial guess of all the states at homotopy 0
+    :return: list with a dict per state: 'x' and 'alpha' of the last
+     solution found (x is None if none) and 'data', the produce_data output
+     if the state reached homotopy 1 (None otherwise)
+    """
+    states = [list(s) for s in states]
+    prob = problem(state0=states[0], homotopy=0, pinpoint=True)
+    lb, ub = prob.lb, prob.ub
+
+    # Neighbours in the normalised states
+    scales = np.ptp(np.asarray(states, dtype=float), axis=0)
+    scales[scales == 0] = 1.
+    normed = np.asarray(states, dtype=float) / scales
+
+    def nearest(i, solved):
+        d = np.sum((normed[solved] - normed[i])**2, axis=1)
+        return solved[int(np.argmin(d))]
+
+    paths = [([], []) for _ in states]
+    data = [None] * len(states)
+    active = list(range(len(states)))
+    # Step and next homotopy value of each state, at most h
+    steps = [h] * len(states)
+    trials = [0.] * len(states)
+    target_shoots = None
+
+    pool = Pool(n_processes, initializer=_init_wavefront,
+                initargs=(problem, algo))
+
+    def run(idx, guesses):
+        tasks = [(states[i], trials[i], guesses[i], trials[i] == 1)
+                 for i in idx]
+        return dict(zip(idx, pool.map(_wavefront_task, tasks)))
+
+    try:
+        for stage in range(max_stages):
+            if not active:
+                break
+            guesses = {}
+            for i in active:
+                if paths[i][0]:
+                    x = _predict(paths[i][0], paths[i][1], trials[i], order)
+                    guesses[i] = list(np.clip(x, lb, ub))
+                else:
+                    guesses[i] = x0
+            results = run(active, guesses)
+
+            solved = [i for i in active if results[i][0]]
+            failed = [i for i in active if not results[i][0]]
+            # Seeded from the closest solution at the same homotopy
+            seeds = {}
+            for i in failed:
+                same = [j for j in solved if trials[j] == trials[i]]
+                if same:
+                    seeds[i] = results[nearest(i, same)][1]
+            if seeds:
+                results.update(run(list(seeds), seeds))
+                failed = [i for i in failed if not results[i][0]]
+
+            if display:
+                print('\t > wavefront stage {} (homotopy {} to {}): {} solved, '
+                      '{} failed'.format(stage, min(trials[i] for i in active),
+                                         max(trials[i] for i in active),
+                                         len(active) - len(failed),
+                                         len(failed)))
+
+            advanced = [i for i in active if results[i][0]]
+            for i in advanced:
+                paths[i][0].append(trials[i])
+                paths[i][1].append(np.asarray(results[i][1]))
+                data[i] = results[i][3]
+            if advanced:
+                # Step control on the mean work of the correctors
+                shoots = max(np.mean([results[i][2] for i in advanced]), 1)
+                if target_shoots is None:
+                    target_shoots = shoots
+                h *= min(2., max(0.5, float(target_shoots) / shoots))
+                h = min(h, h_max)
+                for i in advanced:
+                    steps[i] = min(2. * steps[i], h, 1 - trials[i])
+
+            # Only the failures retry, with a smaller step, from their own
+            # last solution. They leave the batch at homotopy 0 or below h_min
+            for i in failed:
+                steps[i] *= 0.5
+            active = [i for i in active
+                      if (results[i][0] and trials[i] < 1) or
+                      (paths[i][0] and steps[i] > h_min)]
+            for i in active:
+                alpha = paths[i][0][-1]
+                trials[i] = min(1, alpha + steps[i])
+    finally:
+        pool.close()
+        pool.join()
+
+    return [{'x': list(p[1][-1]) if p[1] else None,
+             'alpha': p[0][-1] if p[0] else None,
+             'data': d} for p, d in zip(paths, data)]
+
+
 def random_state(ranges):
     state = []
     for r in ranges:
@@ -146,12 +428,13 @@ def random_state(ranges):
 def random_walk(problem, state0, bounds, walk_length=300, algo=None,
                 walk_stop_when_fail=False, initial_x='homotopy',
                 state_step=0.02, h_min=1e-4, h_max=0.5, h=0.1, display=True,
-                ini_trials=1, walk_bounds=None):
+                ini_trials=1, walk_bounds=None, checkpoint=None):
 
     if not walk_bounds:
         walk_bounds = bounds
     walk_trajs = []
     step_ranges = [(b[1]-b[0])*state_step for b in walk_bounds]
+    _walk_position['step'] = 0
 
     x = None
     if isinstance(initial_x, list) and not isinstance(initial_x, str):
@@ -173,8 +456,19 @@ def random_walk(problem, state0, bounds, walk_length=300, algo=None,
         x = sol['x']
 
     if initial_x is 'homotopy':
-        sol,alpha = homotopy_path(problem, state0, start=(0, x), algo=algo,
-                            h_min=h_min, h_max=h_max, h=h, display=display)
+        sol = {'feasible': False}
+        if _warm_start is not None:
+            # A solved neighbour at homotopy 1 avoids the homotopy path
+            x_neighbour, _ = _warm_start.query(state0, 1)
+            if x_neighbour is not None:
+                sol = solve(problem, state0, 1, algo, x=x_neighbour,
+                            display=display)
+                alpha = 1
+                if sol['feasible']:
+                    _warm_start.skip_path()
+        if not sol['feasible']:
+            sol,alpha = homotopy_path(problem, state0, start=(0, x), algo=algo,
+                                h_min=h_min, h_max=h_max, h=h, display=display)
     else:
         sol = solve(problem, state0, 1, x=x, algo=algo, display=display)
     if not sol['feasible']:
@@ -185,6 +479,8 @@ def random_walk(problem, state0, bounds, walk_length=300, algo=None,
     x = sol['x']
     state, control = sol['prob'].produce_data(x, 1000)
     walk_trajs.append((state, control, x))
+    if checkpoint:
+        checkpoint(state, control, x)
 
     while len(walk_trajs) < walk_length:
         state_tmp = [r*random()-r/2+x for r, x in zip(step_ranges, state0)]
@@ -196,12 +492,15 @@ def random_walk(problem, state0, bounds, walk_length=300, algo=None,
             print('out of bounds')
             break
 
+        _walk_position['step'] = len(walk_trajs)
         sol = solve(problem, state_tmp, alpha, algo, x=x, display=display)
 
         if sol['feasible']:
             x = sol['x']
             state, control = sol['prob'].produce_data(x, 1000)
             walk_trajs.append((state, control, x))
+            if checkpoint:
+                checkpoint(state, control, x)
             state0 = state_tmp
         else:
         
@@ -209,19 +508,20 @@ def random_walk(problem, state0, bounds, walk_length=300, algo=None,
             if walk_stop_when_fail:
                 break
         print('walk_step', len(walk_trajs))
-        pickle.dump(walk_trajs, open('current_walk.pic', 'wb'))
 
     return walk_trajs
 
 
 def random_walk_h0(problem, state0, bounds, walk_length=300, algo=None,
                    walk_stop_when_fail=False, state_step=0.02, display=True,
-                   ini_trials=1, walk_bounds=None, initial_random_walk=None):
+                   ini_trials=1, walk_bounds=None, initial_random_walk=None,
+                   checkpoint=None):
     if not walk_bounds:
         walk_bounds = bounds
 
     walk_trajs = []
     step_ranges = [(b[1]-b[0])*state_step for b in walk_bounds]
+    _walk_position['step'] = 0
     print('random walk ---> ini')
     x = None
     if initial_random_walk and initial_random_walk!='homotopy':
@@ -243,6 +543,8 @@ def random_walk_h0(problem, state0, bounds, walk_length=300, algo=None,
     x = sol['x']
     state, control = sol['prob'].produce_data(x, 1000)
     walk_trajs.append((state, control, x))
+    if checkpoint:
+        checkpoint(state, control, x)
     while len(walk_trajs) < walk_length:
         print(len(walk_trajs))
         state_tmp = [r*random()-r/2+x for r, x in zip(step_ranges, state0)]
@@ -251,12 +553,15 @@ def random_walk_h0(problem, state0, bounds, walk_length=300, algo=None,
             print(state_tmp, walk_bounds, 'outtt')
             
             break
+        _walk_position['step'] = len(walk_trajs)
         sol = solve(problem, state_tmp, 0, algo, x=x, display=display)
 
         if sol['feasible']:
             x = sol['x']
             state, control = sol['prob'].produce_data(x, 1000)
             walk_trajs.append((state, control, x))
+            if checkpoint:
+                checkpoint(state, control, x)
             state0 = state_tmp
         else:
             #   TODO  keep the same direction
@@ -266,80 +571,253 @@ def random_walk_h0(problem, state0, bounds, walk_length=300, algo=None,
     return walk_trajs
 
 
+def random_walk_wavefront(problem, state0, bounds, walk_length=300,
+                          algo=None, n_processes=None, state_step=0.02, h=0.1,
+                          display=True, walk_bounds=None, x0=None,
+                          checkpoint=None):
+    """Random walk whose steps are solved together, in parallel, along the
+    homotopy (see homotopy_wavefront). The steps are drawn beforehand."""
+    if not walk_bounds:
+        walk_bounds = bounds
+    step_ranges = [(b[1]-b[0])*state_step for b in walk_bounds]
+
+    states = [state0]
+    while len(states) < walk_length:
+        state_tmp = [r*random()-r/2+x for r, x in zip(step_ranges, states[-1])]
+        if not np.all([b[0] <= s <= b[1] for b, s
+                       in zip(walk_bounds, state_tmp)]):
+            break
+        states.append(state_tmp)
+
+    walk_trajs = []
+    for sol in homotopy_wavefront(problem, states, algo, x0=x0,
+                                  n_processes=n_processes, h=h,
+                                  display=display):
+        if sol['data'] is not None:
+            state, control = sol['data']
+            walk_trajs.append((state, control, sol['x']))
+            if checkpoint:
+                checkpoint(state, control, sol['x'])
+    return walk_trajs
+
+
+def _walk(problem, bounds, walk_length, algo, state_step, h_min, h_max, h,
+          stop_when_fail, display, initial_random_walk, walk_bounds, qc,
+          checkpoint=None, wavefront=None):
+    state0 = random_state(bounds)
+    if wavefront and not qc:
+        # Only an explicit initial guess is used: [algo, 'homotopy', x] or x
+        x0 = None
+        if isinstance(initial_random_walk, (list, tuple)):
+            if 'homotopy' not in initial_random_walk:
+                x0 = initial_random_walk
+            elif len(initial_random_walk) == 3:
+                x0 = initial_random_walk[2]
+        return random_walk_wavefront(problem, state0, bounds,
+                                     walk_length=walk_length, algo=algo,
+                                     n_processes=wavefront,
+                                     state_step=state_step, h=h,
+                                     display=display, walk_bounds=walk_bounds,
+                                     x0=x0, checkpoint=checkpoint)
+    if qc:
+        return random_walk_h0(problem, state0, bounds,
+                              walk_length=walk_length, algo=algo,
+                              state_step=state_step, display=display,
+                              walk_stop_when_fail=stop_when_fail,
+                              walk_bounds=walk_bounds,
+                              initial_random_walk=initial_random_walk,
+                              checkpoint=checkpoint)
+    return random_walk(problem, state0, bounds,
+                       walk_length=walk_length, algo=algo,
+                       state_step=state_step, h_min=h_min,
+                       h_max=h_max, h=h,
+                       walk_stop_when_fail=stop_when_fail,
+                       display=display, walk_bounds=walk_bounds,
+                       initial_x=initial_random_walk, checkpoint=checkpoint)
+
+
 def generate_random_walks(problem, trajs_n, bounds, th_id=0, dir='data',
                           walk_length=300, algo=None, state_step=0.02,
                           h_min=1e-4, h_max=0.5, h=0.1,
                           stop_when_fail=False, display=True,
                           initial_random_walk='homotopy', walk_bounds=None,
-                          qc=False):
-
-    curr_trajs = 0
-    walk_id = 0
-    if not os.path.exists(dir):
-        os.makedirs(dir)
+                          qc=False, warm_start=False, wavefront=None,
+                          log=False):
+    """Appends random walks to the trajectory store in dir until it has
+    trajs_n trajectories. With wavefront (a number of processes) the steps of
+    each walk are solved in parallel along the homotopy. With log the metrics
+    of every solve are appended to dir/solves_<th_id>.csv (see solve_log)."""
+
+    if warm_start:
+        set_warm_start(load_warm_start(dir, th_id,
+                                       _walk_scales(bounds, walk_bounds)))
+    if log:
+        set_solve_log(SolveLog(dir, th_id))
+
+    # Trajectories are appended to the shard of this thread as they are found
+    store = TrajectoryStoreWriter(dir, th_id)
+    index = store.index()
+    curr_trajs = len(store)
+    walk_id = int(index['walk'].max()) + 1 if len(index) else 0
 
     while curr_trajs < trajs_n:
         print(dir)
 
-        if os.path.isfile(dir + '/random_walk_' + str(th_id) + '_' +
-                          str(walk_id) + '.pic'):
-            ws = pickle.load(open(dir + '/random_walk_' + str(th_id) + '_' +
-                             str(walk_id) + '.pic', 'rb'))
-            walk_id += 1
-            curr_trajs += len(ws)
-            continue
-
-        state0 = random_state(bounds)
-
         walk_length = min(walk_length, trajs_n-curr_trajs)
         print(trajs_n, curr_trajs, walk_length)
-        if qc:
-            walk_trajs = random_walk_h0(problem, state0, bounds,
-                                        walk_length=walk_length, algo=algo,
-                                        state_step=state_step, display=display,
-                                        walk_stop_when_fail=stop_when_fail,
-                                        walk_bounds=walk_bounds,
-                                        initial_random_walk=initial_random_walk)
-
-        else:
-            walk_trajs = random_walk(problem, state0, bounds,
-                                     walk_length=walk_length, algo=algo,
-                                     state_step=state_step, h_min=h_min,
-                                     h_max=h_max, h=h,
-                                     walk_stop_when_fail=stop_when_fail,
-                                     display=display, walk_bounds=walk_bounds,
-                                     initial_x=initial_random_walk)
+        checkpoint = lambda state, control, x: store.append(state, control, x,
+                                                            walk_id)
+        _walk_position['walk'] = walk_id
+        walk_trajs = _walk(problem, bounds, walk_length, algo, state_step,
+                           h_min, h_max, h, stop_when_fail, display,
+                           initial_random_walk, walk_bounds, qc, checkpoint,
+                           wavefront)
 
         if(len(walk_trajs) > 0):
             curr_trajs += len(walk_trajs)
-            pickle.dump(walk_trajs, open(dir + '/random_walk_' + str(th_id) +
-                                         '_' + str(walk_id) + '.pic', 'wb'))
             walk_id += 1
+        if _warm_start is not None:
+            _warm_start.save()
+            print(_warm_start.summary())
+
+
+def _pool_worker(worker_id, seeds, results, claimed, n_trajs, lock,
+                 counters, walk_args, warm_start_dir=None, log_dir=None):
+    """Pulls random walk seeds until the global target is claimed and sends
+    every finished walk to the writer."""
+    global _solver_counters
+    _solver_counters = (counters, worker_id)
+    if warm_start_dir:
+        set_warm_start(load_warm_start(warm_start_dir, worker_id,
+                                       _walk_scales(walk_args[1],
+                                                    walk_args[11])))
+    if log_dir:
+        set_solve_log(SolveLog(log_dir, worker_id))
+    walk_length = walk_args[2]
+
+    while True:
+        # Claim the trajectories of the next walk against the global target
+        with lock:
+            claim = min(walk_length, n_trajs - claimed.value)
+            claimed.value += claim
+        if claim <= 0:
+            break
+
+        seed = seeds.get()
+        if seed is None:
+            break
+        walk_id, walk_seed = seed
+        _walk_position['walk'] = walk_id
+        rnd.seed(walk_seed)
+        np.random.seed(walk_seed % 2**32)
+
+        args = list(walk_args)
+        args[2] = claim
+        try:
+            walk_trajs = _walk(*args)
+        except Exception as e:
+            print('worker {}: walk {} failed ({})'.format(worker_id, walk_id, e))
+            walk_trajs = []
+
+        # Unused trajectories go back to the pool
+        with lock:
+            claimed.value -= claim - len(walk_trajs)
+        results.put((worker_id, walk_id, walk_trajs))
+
+        if _warm_start is not None:
+            _warm_start.save()
+            print('worker {}: {}'.format(worker_id, _warm_start.summary()))
+
+
+def _report(worker_trajs, counters, t0):
+    elapsed = max(time.time() - t0, 1e-9)
+    for i, n in enumerate(worker_trajs):
+        print('worker {}: {:.3f} trajs/s, {:.3f} failures/s ({} trajs, {} '
+              'solves)'.format(i, n / elapsed, counters[2 * i + 1] / elapsed,
+                               n, int(counters[2 * i])))
+    print('total: {} trajs, {:.3f} trajs/s'.format(sum(worker_trajs),
+                                                   sum(worker_trajs) / elapsed))
 
 
 def run_multithread(problem, n_trajs, n_threads, bounds, dir='data',
                     walk_length=300, state_step=0.02, h_min=1e-4, h_max=0.5,
                     h=0.1, walk_stop_when_fail=False, display=True,
                     initial_random_walk='homotopy', algo=None,
-                    walk_bounds=None, qc=False):
-
-    samples_per_thread = n_trajs/n_threads
+                    walk_bounds=None, qc=False, report_every=60,
+                    warm_start=False, log=False):
+    """Generates n_trajs trajectories with a pool of n_threads workers.
+
+    Workers pull random walk seeds from a queue, so a slow walk does not
+    leave the other workers idle, and the walks are appended by this process
+    to the trajectory store in dir as they arrive. Trajectories already in
+    the store count towards n_trajs. Throughput per worker is printed every report_every seconds.
+    With log every worker appends the metrics of its solves to
+    dir/solves_<worker>.csv (summary: python solve_log.py dir).
+    """
+    store = TrajectoryStoreWriter(dir, 'main')
+    done, walk_id = store_size(dir)
+    if done >= n_trajs:
+        return
+
+    walk_args = (problem, bounds, walk_length, algo, state_step, h_min,
+                 h_max, h, walk_stop_when_fail, display, initial_random_walk,
+                 walk_bounds, qc)
+
+    seeds = Queue()
+    results = Queue()
+    claimed = Value('l', 0, lock=False)
+    lock = Lock()
+    counters = Array('d', 2 * n_threads)
+    target = n_trajs - done
+
+    # Two pending seeds per worker, one more for every finished walk
+    master_seed = rnd.randrange(2**62)
+    next_seed = [walk_id]
+
+    def push_seed():
+        seeds.put((next_seed[0], master_seed + next_seed[0]))
+        next_seed[0] += 1
+    for _ in range(2 * n_threads):
+        push_seed()
 
     ps = []
     for i in range(n_threads):
-        p = Process(target=generate_random_walks,
-                    args=(problem, samples_per_thread, bounds, i, dir,
-                          walk_length, algo, state_step, h_min, h_max, h,
-                          walk_stop_when_fail, display,
-                          initial_random_walk, walk_bounds, qc))
+        p = Process(target=_pool_worker,
+                    args=(i, seeds, results, claimed, target, lock, counters,
+                          walk_args, dir if warm_start else None,
+                          dir if log else None))
         p.start()
         ps.append(p)
 
+    worker_trajs = [0] * n_threads
+    t0 = time.time()
+    last_report = t0
     try:
-       for p in ps:
-           p.join()
-    except:
-       p.terminate()   
+        while done < n_trajs:
+            try:
+                worker_id, wid, walk_trajs = results.get(timeout=report_every)
+            except Exception:
+                if not any(p.is_alive() for p in ps):
+                    break
+            else:
+                push_seed()
+                if len(walk_trajs) > 0:
+                    store.extend(walk_trajs, wid)
+                    done += len(walk_trajs)
+                    worker_trajs[worker_id] += len(walk_trajs)
+            if time.time() - last_report >= report_every:
+                _report(worker_trajs, counters, t0)
+                last_report = time.time()
+
+        for _ in ps:
+            seeds.put(None)
+        for p in ps:
+            p.join()
+    finally:
+        for p in ps:
+            if p.is_alive():
+                p.terminate()
+    _report(worker_trajs, counters, t0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+"""Per solve metrics of the data generation.
+
+Each worker appends one CSV row per call of generate_data.solve to
+solves_<worker>.csv in the data directory:
+
+ - model, walk, step: landing model, random walk id and position in the walk
+   (step 0 is the solve that starts the walk, -1 outside of a walk)
+ - homotopy, feasible: homotopy value of the solve and its outcome
+ - wall: wall time of the solve [s]
+ - iterations: solver iterations (Jacobians of newton_shooting), blank when
+   the solver does not report them (the PyGMO algorithms)
+ - shoots, gradients: constraints and gradient evaluations. SNOPT and SLSQP
+   difference the constraints themselves, their gradients are always 0
+ - rhs, steps: right hand side evaluations and integrator steps
+ - violation: norm of the constraints at the returned x
+
+Summary of a directory (where the generation time goes):
+
+    python solve_log.py data_dir
+
+"""
+from __future__ import print_function
+import csv
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+FIELDS = ['time', 'worker', 'model', 'walk', 'step', 'homotopy', 'feasible',
+          'wall', 'iterations', 'shoots', 'gradients', 'rhs', 'steps',
+          'violation']
+
+
+class SolveLog(object):
+    """Appends the solves of one worker to directory/solves_<worker>.csv"""
+
+    def __init__(self, directory, worker=0):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, 'solves_' + str(worker) + '.csv')
+        self.worker = worker
+        new = not os.path.isfile(self.path) or os.path.getsize(self.path) == 0
+        # Rows appended to a log of an older version keep its columns
+        self.fields = FIELDS
+        if not new:
+            with open(self.path) as fp:
+                self.fields = next(csv.reader(fp))
+        # Line buffered, a killed worker loses at most the current row
+        self._file = open(self.path, 'a', 1)
+        self._writer = csv.writer(self._file)
+        if new:
+            self._writer.writerow(FIELDS)
+
+    def write(self, **row):
+        row.setdefault('time', time.time())
+        row.setdefault('worker', self.worker)
+        self._writer.writerow([row.get(f, '') for f in self.fields])
+
+    def close(self):
+        self._file.close()
+
+
+def load(directory):
+    """All the solves logged in directory, as a dict of arrays (one per
+    field)"""
+    rows = []
+    for f in sorted(glob.glob(os.path.join(directory, 'solves_*.csv'))):
+        with open(f) as fp:
+            rows.extend(r for r in csv.DictReader(fp) if r.get('wall'))
+    log = {'model': np.array([r['model'] for r in rows], dtype=str)}
+    for f in FIELDS:
+        if f != 'model':
+            log[f] = np.array([float(r.get(f) or 'nan') for r in rows])
+    return log
+
+
+# Walk positions of the summary: walk start (homotopy) and later steps
+POSITIONS = [(0, 0), (1, 9), (10, 49), (50, np.inf)]
+
+
+def _table(log, groups, title):
+    total = max(np.sum(log['wall']), 1e-12)
+    print('{:<16} {:>7} {:>9} {:>9} {:>7} {:>8} {:>10} {:>10}'.format(
+        title, 'solves', 'feasible', 'wall [s]', 'share', 'shoots',
+        'rhs', 's/feasible'))
+    for name, idx in groups:
+        if not np.any(idx):
+            continue
+        wall = np.sum(log['wall'][idx])
+        feasible = np.sum(log['feasible'][idx] > 0)
+        print('{:<16} {:>7d} {:>9.2f} {:>9.1f} {:>7.1%} {:>8.1f} {:>10.0f} '
+              '{:>10.3f}'.format(name, int(np.sum(idx)),
+                                feasible / float(np.sum(idx)), wall,
+                                wall / total, np.mean(log['shoots'][idx]),
+                                np.mean(log['rhs'][idx]),
+                                wall / max(feasible, 1)))
+
+
+def summary(directory):
+    """Prints the generation time by model and by position in the walks"""
+    log = load(directory)
+    if not len(log['wall']):
+        print('no solves logged in', directory)
+        return log
+
+    models = sorted(set(log['model']))
+    _table(log, [(m, log['model'] == m) for m in models], 'model')
+    print()
+    step = log['step']
+    _table(log, [('outside', step < 0)] +
+           [(str(a) if a == b else '{}-{}'.format(a, b) if np.isfinite(b)
+             else '{}+'.format(a), (step >= a) & (step <= b))
+            for a, b in POSITIONS], 'walk step')
+    print()
+    homotopy = log['homotopy']
+    _table(log, [('QC (0)', homotopy == 0),
+                 ('path (0-1)', (homotopy > 0) & (homotopy < 1)),
+                 ('MOC (1)', homotopy == 1)], 'homotopy')
+    return log
+
+
+if __name__ == "__main__":
+    summary(sys.argv[1] if len(sys.argv) > 1 else 'data')
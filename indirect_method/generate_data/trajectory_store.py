@@ -0,0 +1,163 @@
+"""Append-only store of optimal trajectories.
+
+A store is a directory with
+
+ - store.json: manifest with the layout (state/control widths, decision
+   vector length, column names)
+ - <shard>.bin: raw float64 blocks, one (nodes x columns) block per
+   trajectory, [state | control] as returned by produce_data
+ - <shard>.idx: fixed-width index records (row offset, nodes, walk id,
+   decision vector x) in the same order as the blocks
+
+Each writer appends to its own shard, so several processes can write to the
+same store concurrently. The index record is written after its block, hence
+a reader never sees a partially written trajectory.
+
+deep_control.data.TrajectoryStore reads the store as memory-mapped arrays.
+
+"""
+import json
+import os
+
+import numpy as np
+
+MANIFEST = 'store.json'
+
+
+def index_dtype(n_x):
+    return np.dtype([('offset', '<i8'), ('nodes', '<i8'), ('walk', '<i8'),
+                     ('x', '<f8', (n_x,))])
+
+
+class TrajectoryStoreWriter(object):
+    """Appends trajectories to the shard `shard` of the store in `directory`"""
+
+    def __init__(self, directory, shard='0', columns=None):
+        self.directory = directory
+        self.shard = str(shard)
+        self.columns = columns
+        self.manifest = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        manifest_file = os.path.join(directory, MANIFEST)
+        if os.path.isfile(manifest_file):
+            self.manifest = json.load(open(manifest_file))
+        self._bin = os.path.join(directory, self.shard + '.bin')
+        self._idx = os.path.join(directory, self.shard + '.idx')
+        self._rows = 0
+        self._count = 0
+        if self.manifest and os.path.isfile(self._idx):
+            # An interrupted append may leave a partial record or block
+            record_size = index_dtype(self.manifest['n_x']).itemsize
+            size = os.path.getsize(self._idx)
+            if size % record_size:
+                with open(self._idx, 'r+b') as f:
+                    f.truncate(size - size % record_size)
+            index = self.index()
+            self._count = len(index)
+            if self._count:
+                self._rows = int(index['offset'][-1] + index['nodes'][-1])
+            self._truncate_data()
+
+    def _truncate_data(self):
+        # Drops a block whose index record was never written (interrupted)
+        size = self._rows * self.manifest['n_columns'] * 8
+        if os.path.isfile(self._bin) and os.path.getsize(self._bin) > size:
+            with open(self._bin, 'r+b') as f:
+                f.truncate(size)
+
+    def _create_manifest(self, state, control, x):
+        n_state = state.shape[1]
+        n_control = control.shape[1]
+        columns = self.columns
+        if columns is None:
+            columns = (['t'] + ['s' + str(i) for i in range(n_state - 1)] +
+                       ['u' + str(i) for i in range(n_control)])
+        manifest = {'version': 1,
+                    'n_state': n_state,
+                    'n_control': n_control,
+                    'n_columns': n_state + n_control,
+                    'n_x': len(x),
+                    'columns': list(columns)}
+
+        manifest_file = os.path.join(self.directory, MANIFEST)
+        if not os.path.isfile(manifest_file):
+            tmp = manifest_file + '.' + self.shard
+            json.dump(manifest, open(tmp, 'w'), indent=1)
+            os.rename(tmp, manifest_file)
+        self.manifest = json.load(open(manifest_file))
+
+    def __len__(self):
+        return self._count
+
+    def append(self, state, control, x, walk=-1):
+        """Appends one trajectory (as returned by produce_data) and its
+        decision vector"""
+        state = np.asarray(state, dtype='<f8')
+        control = np.asarray(control, dtype='<f8').reshape(len(state), -1)
+        if self.manifest is None:
+            self._create_manifest(state, control, x)
+
+        block = np.hstack((state, control))
+        if block.shape[1] != self.manifest['n_columns']:
+            raise ValueError('Trajectory with {} columns, the store has {}'
+                             .format(block.shape[1],
+                                     self.manifest['n_columns']))
+
+        record = np.zeros(1, dtype=index_dtype(self.manifest['n_x']))
+        record['offset'] = self._rows
+        record['nodes'] = len(block)
+        record['walk'] = walk
+        record['x'] = x
+
+        with open(self._bin, 'ab') as f:
+            f.write(np.ascontiguousarray(block).tobytes())
+        with open(self._idx, 'ab') as f:
+            f.write(record.tobytes())
+
+        self._rows += len(block)
+        self._count += 1
+
+    def extend(self, trajs, walk=-1):
+        """Appends a list of (state, control, x) tuples"""
+        for state, control, x in trajs:
+            self.append(state, control, x, walk)
+
+    def index(self):
+        if self.manifest is None or not os.path.isfile(self._idx):
+            return np.zeros(0, dtype=index_dtype(0))
+        return np.fromfile(self._idx, dtype=index_dtype(self.manifest['n_x']))
+
+
+def _indices(directory):
+    manifest_file = os.path.join(directory, MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return []
+    dtype = index_dtype(json.load(open(manifest_file))['n_x'])
+    indices = []
+    for f in sorted(os.listdir(directory)):
+        if f.endswith('.idx'):
+            raw = np.fromfile(os.path.join(directory, f), dtype=np.uint8)
+            raw = raw[:len(raw) - len(raw) % dtype.itemsize]
+            indices.append(raw.view(dtype))
+    return indices
+
+
+def store_size(directory):
+    """Number of trajectories and next free walk id of a store"""
+    indices = _indices(directory)
+    n = sum(len(index) for index in indices)
+    walks = [index['walk'].max() for index in indices if len(index)]
+    return n, int(max(walks) + 1) if walks else 0
+
+
+def convert_pickles(pickle_dir, directory, shard='pickles'):
+    """Imports the random_walk_*.pic files of previous runs into a store"""
+    import glob
+    import pickle
+    writer = TrajectoryStoreWriter(directory, shard)
+    for f in sorted(glob.glob(pickle_dir + '/random_walk_*.pic')):
+        walk = int(f[:-4].split('_')[-1])
+        writer.extend(pickle.load(open(f, 'rb')), walk)
+    return writer
@@ -0,0 +1,152 @@
+"""Nearest neighbour cache of solved problems, used to warm start solve().
+
+The solved (state0, homotopy, x) triples are indexed by a KD-tree over the
+normalised initial states (the homotopy is an extra, heavily weighted,
+coordinate so that neighbours at the same homotopy are preferred). The cache
+is saved as a .npz file and can be preloaded from the files of other runs or
+workers.
+
+"""
+import glob
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class WarmStartCache(object):
+    """
+    :param path: .npz file where the cache is saved (None: not persistent)
+    :param scales: normalisation of each state variable (e.g. the widths of
+     the sampling bounds)
+    :param radius: maximum (normalised) distance of a useful neighbour
+    :param homotopy_weight: scale of the homotopy coordinate
+    """
+
+    def __init__(self, path=None, scales=None, radius=0.1,
+                 homotopy_weight=10., preload=()):
+        self.path = path
+        self.scales = None if scales is None else self._fix_scales(scales)
+        self.radius = radius
+        self.homotopy_weight = homotopy_weight
+
+        self._states = []
+        self._homotopies = []
+        self._xs = []
+        self._keys = None
+        self._tree = None
+        self._n_indexed = 0
+
+        self.stats = {'queries': 0, 'hits': 0, 'homotopy_paths': 0,
+                      'homotopy_solves': 0, 'paths_skipped': 0,
+                      'solves_saved': 0.}
+
+        # Only the entries of path and the new ones are saved
+        for f in preload:
+            if f != path:
+                self.load(f)
+        self._first_own = len(self)
+        if path and os.path.isfile(path):
+            self.load(path)
+
+    @staticmethod
+    def _fix_scales(scales):
+        scales = np.abs(np.asarray(scales, dtype=np.float64))
+        scales[scales == 0] = 1.
+        return scales
+
+    def __len__(self):
+        return len(self._xs)
+
+    def _key(self, state0, homotopy):
+        if self.scales is None:
+            self.scales = self._fix_scales(state0)
+        return np.append(np.asarray(state0, dtype=np.float64) / self.scales,
+                         homotopy * self.homotopy_weight)
+
+    def add(self, state0, homotopy, x):
+        self._states.append(np.asarray(state0, dtype=np.float64))
+        self._homotopies.append(float(homotopy))
+        self._xs.append(np.asarray(x, dtype=np.float64))
+        key = self._key(state0, homotopy)
+        n = len(self)
+        if self._keys is None:
+            self._keys = np.empty((256, len(key)))
+        elif n > len(self._keys):
+            self._keys = np.vstack((self._keys, np.empty(self._keys.shape)))
+        self._keys[n - 1] = key
+
+        # The tree is rebuilt once the unindexed tail is large enough
+        if n - self._n_indexed > max(64, self._n_indexed // 10):
+            self._tree = cKDTree(self._keys[:n])
+            self._n_indexed = n
+
+    def query(self, state0, homotopy):
+        """Decision vector of the nearest solved problem (None if there is no
+        neighbour within the radius) and its (normalised) distance"""
+        self.stats['queries'] += 1
+        if len(self) == 0:
+            return None, np.inf
+
+        key = self._key(state0, homotopy)
+        best, best_d = None, np.inf
+        if self._tree is not None:
+            best_d, best = self._tree.query(key)
+        if len(self) > self._n_indexed:
+            tail = self._keys[self._n_indexed:len(self)]
+            d = np.sqrt(np.sum((tail - key)**2, axis=1))
+            i = np.argmin(d)
+            if d[i] < best_d:
+                best, best_d = self._n_indexed + i, d[i]
+
+        if best_d > self.radius:
+            return None, best_d
+        self.stats['hits'] += 1
+        return self._xs[best].copy(), best_d
+
+    def hit_rate(self):
+        return self.stats['hits'] / float(max(self.stats['queries'], 1))
+
+    def add_path(self, solves):
+        """Records a homotopy path that took `solves` calls to solve"""
+        self.stats['homotopy_paths'] += 1
+        self.stats['homotopy_solves'] += solves
+
+    def skip_path(self):
+        """Records a homotopy path avoided with a single solve, the saving
+        is estimated with the mean length of the paths solved so far"""
+        self.stats['paths_skipped'] += 1
+        if self.stats['homotopy_paths']:
+            mean = self.stats['homotopy_solves'] / float(self.stats['homotopy_paths'])
+            self.stats['solves_saved'] += mean - 1
+
+    def summary(self):
+        return ('warm start: {} entries, hit rate {:.2f}, {} homotopy paths '
+                'skipped, ~{:.0f} solves saved'.format(
+                    len(self), self.hit_rate(), self.stats['paths_skipped'],
+                    self.stats['solves_saved']))
+
+    def save(self, path=None):
+        path = path or self.path
+        own = slice(self._first_own, len(self))
+        if not path or len(self) == self._first_own:
+            return
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, states=np.array(self._states[own]),
+                 homotopies=np.array(self._homotopies[own]),
+                 xs=np.array(self._xs[own]))
+        os.rename(tmp, path)
+
+    def load(self, path):
+        data = np.load(path)
+        for state0, homotopy, x in zip(data['states'], data['homotopies'],
+                                       data['xs']):
+            self.add(state0, homotopy, x)
+
+
+def load_warm_start(directory, name, scales=None, **kwargs):
+    """Cache saved as directory/warm_start_<name>.npz, preloaded with all the
+    warm_start_*.npz files of the directory"""
+    files = sorted(glob.glob(os.path.join(directory, 'warm_start_*.npz')))
+    return WarmStartCache(os.path.join(directory, 'warm_start_' + str(name) +
+                                       '.npz'), scales, preload=files, **kwargs)
@@ -0,0 +1,271 @@
+"""
+Damped Newton / Levenberg-Marquardt solver of the shooting equations.
+
+The landing problems are root finding problems (the objective is constant,
+all the work is in the equality constraints), this solves them directly on
+_compute_constraints_impl instead of going through a general NLP optimiser:
+
+ - full Newton steps when the linearisation predicts the residual well,
+   Levenberg-Marquardt steps with a trust region (Nielsen's update of the
+   damping) otherwise
+ - analytic Jacobian (_compute_constraints_gradient_impl) or central
+   differences
+ - the squared constraints of a problem (listed in _squared_constraints) are
+   solved for their square root, whose Jacobian is not singular at the root
+ - the decision vector is kept within the problem bounds
+ - loose integration tolerance while far from the root (tolerance_schedule
+   of the problem), tightened as the violation drops: convergence is only
+   declared on a shot at the reference tolerance
+ - iterations, evaluations and residual history of the last solve
+
+It can replace the PyGMO algorithm (algo) of generate_data.solve,
+homotopy_path and the random walks, and has the evolve(pop) of a PyGMO
+algorithm for the scripts of the landing models.
+
+"""
+
+import numpy as np
+from numpy.linalg import LinAlgError, norm
+
+from shooting import (batch_wins, counters, finite_differences_jacobian,
+                      tolerance_for)
+
+
+class newton_shooting(object):
+    """
+    * max_iter: maximum number of iterations (Jacobian evaluations)
+    * tol: the solve converges when all |c| <= tol (None: c_tol of the problem)
+    * analytic: if True uses the analytic constraints gradient of the problem
+    * tau: initial damping, relative to the diagonal of J'J
+    * min_step: stops when the step is below min_step * (|x| + min_step)
+    * tiered: if True follows the tolerance_schedule of the problem
+    * screen_output: prints the residual at each iteration
+    """
+
+    def __init__(self, max_iter=100, tol=None, analytic=True, tau=1e-3,
+                 min_step=1e-12, tiered=True, screen_output=False):
+        self.max_iter = max_iter
+        self.tol = tol
+        self.analytic = analytic
+        self.tau = tau
+        self.min_step = min_step
+        self.tiered = tiered
+        self.screen_output = screen_output
+        self._reset()
+
+    def __repr__(self):
+        return ('Newton/LM shooting (max_iter: {}, tol: {}, analytic: {}, '
+                'tiered: {})'.format(self.max_iter, self.tol, self.analytic,
+                                     self.tiered))
+
+    def _reset(self):
+        # Report of the last solve
+        self.iterations = 0
+        self.evaluations = 0
+        self.history = []
+        self.converged = False
+        self.message = ''
+        # Integration tolerance of each residual of history (None: reference)
+        self.tolerances = []
+
+    def _constraints(self, prob, x):
+        self.evaluations += 1
+        try:
+            c = np.asarray(prob._compute_constraints_impl(list(x)), dtype=float)
+        except (ValueError, ArithmeticError):
+            return None
+        return c if np.all(np.isfinite(c)) else None
+
+    def _jacobian(self, prob, x):
+        J = None
+        if self.analytic and hasattr(prob, '_compute_constraints_gradient_impl'):
+            J = np.asarray(prob._compute_constraints_gradient_impl(list(x)),
+                           dtype=float)
+        if J is None or not np.all(np.isfinite(J)):
+            # Central differences, also when the variational shot fails
+            if J is None:
+                # A gradient evaluation, a failed analytic one is already
+                # counted by the problem
+                counters['gradients'] += 1
+            # The perturbed shots in lockstep where that is faster
+            fun_many = prob.shoot_many if batch_wins(prob, 2 * len(x)) else None
+            J = finite_differences_jacobian(
+                lambda y: prob._compute_constraints_impl(list(y)), x,
+                fun_many=fun_many)
+            self.evaluations += 2 * len(x)
+        return J
+
+    @staticmethod
+    def _residual(c, squared):
+        r = c.copy()
+        r[squared] = np.sqrt(np.maximum(c[squared], 0.))
+        return r
+
+    @staticmethod
+    def _residual_jacobian(J, r, squared):
+        # d sqrt(c) = dc / (2 sqrt(c)), the row vanishes at the root
+        J = J.copy()
+        for i in squared:
+            J[i] = J[i] / (2. * r[i]) if r[i] > 0 else 0.
+        return J
+
+    def _tol(self, prob):
+        if self.tol is not None:
+            return self.tol
+        return float(np.min(np.atleast_1d(prob.c_tol)))
+
+    def solve(self, prob, x):
+        """Solves the shooting equations of prob from x. Returns the last
+        accepted x, see converged, iterations and history for the outcome."""
+        self._reset()
+        schedule = getattr(prob, 'tolerance_schedule', None)
+        if not (self.tiered and schedule):
+            return self._solve(prob, x, False)
+        # Loosest tier first, the problem is always left at its reference
+        prob.shoot_tol = schedule[0][1]
+        try:
+            return self._solve(prob, x, True)
+        finally:
+            prob.shoot_tol = None
+
+    def _tighten(self, prob, c):
+        # Moves to the tier of the violation of c, never back to a looser one.
+        # Returns True if the tolerance changed
+        tier = tolerance_for(prob, np.max(np.abs(c)))
+        if prob.shoot_tol is None or (tier is not None and tier >= prob.shoot_tol):
+            return False
+        prob.shoot_tol = tier
+        return True
+
+    def _solve(self, prob, x, tiered):
+        lb, ub = np.asarray(prob.lb, dtype=float), np.asarray(prob.ub, dtype=float)
+        x = np.clip(np.asarray(x, dtype=float), lb, ub)
+        tol = self._tol(prob)
+        squared = list(getattr(prob, '_squared_constraints', ()))
+
+        c = self._constraints(prob, x)
+        if c is None:
+            self.message = 'the initial shot failed'
+            return list(x)
+        r = self._residual(c, squared)
+        self.history.append(norm(c))
+        self.tolerances.append(getattr(prob, 'shoot_tol', None))
+        if tiered:
+            self._tighten(prob, c)
+
+        mu, nu = None, 2.
+        J = None
+        good = False
+        stalled = False
+        while True:
+            # c was shot at a loose tolerance
+            loose = self.tolerances[-1] is not None
+            if np.max(np.abs(c)) <= tol and not loose:
+                self.converged = True
+                self.message = 'converged'
+                break
+            if loose and (stalled or np.max(np.abs(c)) <= tol):
+                # The acceptance check is a shot at the reference tolerance,
+                # also the way out of a loose tier where the steps stall
+                prob.shoot_tol = None
+                c = self._constraints(prob, x)
+                if c is None:
+                    self.message = 'the reference shot failed'
+                    break
+                r, J = self._residual(c, squared), None
+                self.history.append(norm(c))
+                self.tolerances.append(None)
+                if stalled:
+                    mu, nu, good, stalled = None, 2., False, False
+                continue
+            if self.iterations >= self.max_iter:
+                self.message = 'maximum number of iterations'
+                break
+            if J is None:
+                J = self._residual_jacobian(self._jacobian(prob, x), r, squared)
+                self.iterations += 1
+                A = np.dot(J.T, J)
+                g = np.dot(J.T, r)
+                # Marquardt scaling of the damping (mu is relative)
+                D = np.maximum(np.diag(A), 1e-12 * np.max(np.diag(A)))
+                if mu is None:
+                    mu = self.tau
+                # The full Newton (Gauss-Newton) step is tried first once
+                # the damped steps agree with the linear model
+                newton = good and mu <= self.tau
+
+            try:
+                if newton:
+                    dx = np.linalg.lstsq(J, -r, rcond=None)[0]
+                else:
+                    dx = np.linalg.solve(A + mu * np.diag(D), -g)
+            except LinAlgError:
+                dx = None
+            if dx is None or not np.all(np.isfinite(dx)):
+                if not newton:
+                    mu, nu = mu * nu, 2. * nu
+                newton = False
+                if mu > 1e20:
+                    # No finite step, e.g. a non finite Jacobian
+                    stalled = True
+                    if loose:
+                        continue
+                    self.message = 'no finite step'
+                    break
+                continue
+            x_new = np.clip(x + dx, lb, ub)
+            dx = x_new - x
+            if norm(dx) <= self.min_step * (norm(x) + self.min_step):
+                stalled = True
+                if loose:
+                    continue
+                self.message = 'step too small'
+                break
+
+            # Actual against predicted (linear model) reduction
+            c_new = self._constraints(prob, x_new)
+            predicted = np.dot(r, r) - np.sum((r + np.dot(J, dx))**2)
+            rho = -1.
+            if c_new is not None and predicted > 0:
+                r_new = self._residual(c_new, squared)
+                rho = (np.dot(r, r) - np.dot(r_new, r_new)) / predicted
+            if newton:
+                # Kept only if the linear model is good enough, the damped
+                # steps take over otherwise
+                rho = rho if rho > 0.25 else -1.
+                mu = mu / 3. if rho > 0 else mu
+            elif rho > 0:
+                mu *= max(1. / 3., 1. - (2. * rho - 1.)**3)
+            if rho > 0:
+                x, c, r, J = x_new, c_new, r_new, None
+                self.history.append(norm(c))
+                self.tolerances.append(getattr(prob, 'shoot_tol', None))
+                if tiered:
+                    # The next Jacobian and steps at the tighter tolerance,
+                    # c (error well below the new threshold) is kept
+                    self._tighten(prob, c)
+                nu = 2.
+                good = rho > 0.75
+                if self.screen_output:
+                    print('{:4d} {:12.5e} {:10.3e} {}'.format(
+                        self.iterations, self.history[-1], mu,
+                        'newton' if newton else 'lm'))
+            elif newton:
+                newton = False
+            else:
+                # Rejected, the trust region shrinks
+                mu, nu = mu * nu, 2. * nu
+                if mu > 1e20:
+                    stalled = True
+                    if loose:
+                        continue
+                    self.message = 'no descent step'
+                    break
+        return list(x)
+
+    def evolve(self, pop):
+        """PyGMO interface: solves from the first individual of pop and
+        stores the result back"""
+        x = self.solve(pop.problem, pop[0].cur_x)
+        pop.set_x(0, x)
+        return pop
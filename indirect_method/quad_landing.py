@@ -15,6 +15,13 @@ from numpy import linspace, vstack, hstack, isnan
 from numpy.linalg import norm
 from copy import deepcopy
 import sys
+import numpy as np
+
+# Same dynamics as the reaction wheel lander, only the parameters differ
+from rw_landing import _rhs_kernel, _jac_kernel
+from shooting import shoot_many, variational_shoot, hamiltonian_gradient
+from shooting import keep_shot, dense_shot, switched_shoot, reduced_odeint
+from shooting import counters, ShotCache, memoised_constraints
 
 class rw_landing(base):
     def __init__(
@@ -26,7 +33,10 @@ class rw_landing(base):
             c3 = 0.0698,
             g = 1.6229,
             homotopy = 0.,
-            pinpoint = False
+            pinpoint = False,
+            compiled = False,
+            switch_events = False,
+            reduced = False
             ):
         """
         USAGE: rw_landing(self, start, end, Isp, Tmax, mu):
@@ -39,6 +49,9 @@ class rw_landing(base):
         * g: planet gravity [m/s**2]
         * homotopy: homotopy parameter, 0->QC, 1->MOC
         * pinpoint: if True toggles the final constraint on the landing x
+        * compiled: if True integrates with the compiled right hand side and its analytic Jacobian
+        * switch_events: if True the bang-bang trajectories (homotopy 1) are integrated arc by arc, the switches being located as events
+        * reduced: if True only the costates without a closed form are integrated (lx, ly are constant, lvx, lvy linear in time)
         """
 
         super(rw_landing, self).__init__(7, 0, 1, 7, 0, 1e-5)
@@ -61,6 +74,9 @@ class rw_landing(base):
         self.c3 = c3 * self.T
         self.g = g / self.A
 
+        # Scales of the state variables (state / scales is non dimensional)
+        self._state_scales = np.array([self.R, self.R, self.V, self.V, 1., self.M])
+
         # We compute the initial and final state in the new units
         self.state0 = self._non_dim(self.state0_input)
         self.statet = self._non_dim(self.statet_input)
@@ -74,37 +90,97 @@ class rw_landing(base):
         self.homotopy = homotopy
         self.alpha = 1./150.
 
+        # Selects the compiled right hand side (the Python one is the reference)
+        self.compiled = compiled
+
+        # Integrates the bang-bang arcs separately (see shooting.switched_shoot)
+        self.switch_events = switch_events
+
+        # Integrates the costates lx, ly, lvx, lvy (indices below) in closed
+        # form (see shooting.reduced_odeint)
+        self.reduced = reduced
+        self._linear_costates = (6, 7, 8, 9)
+
+        # Last shots (constraints and trajectories), repeated x are not shot again
+        self.shot_cache = ShotCache()
+
+        # Integration tolerance while the constraints violation is above each
+        # threshold, 1e-13 below them (see shooting.tolerance_for)
+        self.tolerance_schedule = [(1e-2, 1e-9), (1e-4, 1e-11)]
+        # Tolerance of the current tier, None for the reference 1e-13
+        self.shoot_tol = None
+
+    def set_parameters(self, state0=None, homotopy=None):
+        """
+        Re-parameterises the problem in place, cheaper than building a new one
+
+        * state0: initial state, dimensional as in the constructor
+        * homotopy: homotopy parameter, 0->QC, 1->MOC
+        """
+        if state0 is not None:
+            self.state0_input = state0
+            self.state0 = self._non_dim(state0)
+        if homotopy is not None:
+            self.homotopy = homotopy
+        # The last shot (dense output) belongs to the old parameters
+        self._last_shot = None
+
     def _objfun_impl(self, x):
         return(1.,) # constraint satisfaction, no objfun
 
+    @memoised_constraints
     def _compute_constraints_impl(self, x):
         # Perform one forward shooting
+        counters['shoots'] += 1
         xf, info = self._shoot(x)
+        return self._final_constraints(xf[-1])
 
+    def _final_constraints(self, full_state):
         # Assembling the equality constraint vector
         ceq = list([0]*7)
 
         # Final conditions
         if self.pinpoint:
             #Pinpoint landing x is fixed lx is free
-            ceq[0] = (xf[-1][0] - self.statet[0] ) * 100
+            ceq[0] = (full_state[0] - self.statet[0] ) * 100
         else:
             #Transversality condition: x is free lx is 0
-            ceq[0] = xf[-1][6] * 100
+            ceq[0] = full_state[6] * 100
 
-        ceq[1] = (xf[-1][1] - self.statet[1] ) * 100
-        ceq[2] = (xf[-1][2] - self.statet[2] ) * 100
-        ceq[3] = (xf[-1][3] - self.statet[3] ) * 1000
-        ceq[4] = (xf[-1][4] - self.statet[4] ) * 1000
+        ceq[1] = (full_state[1] - self.statet[1] ) * 100
+        ceq[2] = (full_state[2] - self.statet[2] ) * 100
+        ceq[3] = (full_state[3] - self.statet[3] ) * 1000
+        ceq[4] = (full_state[4] - self.statet[4] ) * 1000
         
         # Transversality condition on mass (free)
-        ceq[5] = (xf[-1][11] * 10000) 
+        ceq[5] = (full_state[11] * 10000) 
 
         # Free time problem, Hamiltonian must be 0
-        ceq[6] = (self._hamiltonian(xf[-1]) * 10000) 
+        ceq[6] = (self._hamiltonian(full_state) * 10000) 
 
         return ceq
 
+    def _final_constraints_jacobian(self, full_state):
+        # Derivatives of _final_constraints w.r.t. the final full state
+        dceq = np.zeros((7, 12))
+        if self.pinpoint:
+            dceq[0, 0] = 100
+        else:
+            dceq[0, 6] = 100
+        dceq[1, 1] = 100
+        dceq[2, 2] = 100
+        dceq[3, 3] = 1000
+        dceq[4, 4] = 1000
+        dceq[5, 11] = 10000
+        dceq[6] = hamiltonian_gradient(self, full_state) * 10000
+        return dceq
+
+    def _compute_constraints_gradient_impl(self, x):
+        counters['gradients'] += 1
+        # One integration of the trajectory and of its variational equations
+        xf, dxf = variational_shoot(self, x, rtol=self.shoot_tol or 1e-13, atol=self.shoot_tol or 1e-13)
+        return np.dot(self._final_constraints_jacobian(xf), dxf)
+
     def _hamiltonian(self, full_state):
         state = full_state[:6]
         costate = full_state[6:]
@@ -203,6 +279,11 @@ class rw_landing(base):
         u2 = min(1, u2)
         return u1, u2
 
+    def _switching_function(self, full_state):
+        # Switching function of the mass optimal throttle (u1 = 1 where S < 0)
+        x, y, vx, vy, theta, m, lx, ly, lvx, lvy, ltheta, lm = full_state
+        return 1. - lm + (lvx * sin(theta) + lvy * cos(theta)) * self.c2 / m
+
     def _eom(self, full_state, t):
         # Applying Pontryagin minimum principle
         state = full_state[:6]
@@ -213,25 +294,94 @@ class rw_landing(base):
         dcostate = self._eom_costate(full_state, controls)
         return dstate + dcostate
 
+    def _eom_compiled(self, full_state, t, throttle=-1.):
+        return _rhs_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.c3, self.g, float(self.homotopy), self.alpha, throttle)
+
+    def _eom_jacobian(self, full_state, t, throttle=-1.):
+        return _jac_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.c3, self.g, float(self.homotopy), self.alpha, throttle)
+
+    def _rhs(self):
+        # Right hand side and Jacobian handed to the integrator
+        if self.compiled:
+            return self._eom_compiled, self._eom_jacobian
+        return lambda a,b: self._eom(a,b), None
+
+    def _pontryagin_minimum_principle_many(self, full_states):
+        # Vectorized _pontryagin_minimum_principle, columns u1, u2
+        x,y,vx,vy,theta,m,lx,ly,lvx,lvy,ltheta,lm = full_states.T
+        c1 = self.c1
+        c2 = self.c2
+        c3 = self.c3
+
+        lvdotitheta = lvx * np.sin(theta) + lvy * np.cos(theta)
+        if self.homotopy == 1:
+            u1 = np.where(1. - lm + lvdotitheta * c2 / m >= 0, 0., 1.)
+        else:
+            u1 = 1. / 2. / c1 * (lm - lvdotitheta * c2 / m - self.homotopy) / (1. - self.homotopy)
+            u1 = np.clip(u1, 0., 1.)
+        u2 = np.clip(-ltheta / 2. / c3 / self.alpha, -1., 1.)
+        return np.column_stack((u1, u2))
+
+    def _switching_function_many(self, full_states):
+        # Vectorized _switching_function
+        x,y,vx,vy,theta,m,lx,ly,lvx,lvy,ltheta,lm = full_states.T
+        return 1. - lm + (lvx * np.sin(theta) + lvy * np.cos(theta)) * self.c2 / m
+
+    def _hamiltonian_many(self, full_states):
+        # Vectorized _hamiltonian
+        c1 = self.c1
+        c2 = self.c2
+        c3 = self.c3
+        u1, u2 = self._pontryagin_minimum_principle_many(full_states).T
+        f_vett = self._eom_many(full_states)[:, :6]
+        cost = self.homotopy * c1 / c2 * u1 + (1 - self.homotopy) * c1**2 / c2 * u1**2 + self.alpha * c3**2 * u2**2
+        return np.sum(full_states[:, 6:] * f_vett, axis=1) + cost
+
+    def _eom_many(self, full_states):
+        # Vectorized _eom, one full state per row
+        x,y,vx,vy,theta,m,lx,ly,lvx,lvy,ltheta,lm = full_states.T
+        g = self.g
+        c1 = self.c1
+        c2 = self.c2
+        c3 = self.c3
+        st = np.sin(theta)
+        ct = np.cos(theta)
+
+        lvdotitheta = lvx * st + lvy * ct
+        lvdotitau = lvx * ct - lvy * st
+        u1, u2 = self._pontryagin_minimum_principle_many(full_states).T
+
+        zero = np.zeros_like(x)
+        return np.column_stack((vx, vy, c1 * u1 / m * st, c1 * u1 / m * ct - g, c3 * u2, - c1 / c2 * u1,
+                                zero, zero, - lx, - ly, - c1 / m * lvdotitau * u1, c1 / m**2 * lvdotitheta * u1))
+
+    def shoot_many(self, X):
+        # Integrates all the decision vectors (rows of X) at once, returns the constraints
+        tol = self.shoot_tol or 1e-13
+        return shoot_many(self, X, rtol=tol, atol=tol)
+
     def _shoot(self, x):
         # Numerical Integration
-        xf, info = odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), linspace(0, x[-1],100), rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
+        eom, jac = self._rhs()
+        tol = self.shoot_tol or 1e-13
+        tspan = linspace(0, x[-1],100)
+        if self.homotopy == 1 and self.switch_events:
+            xf, info = switched_shoot(self, x, tspan, rtol=tol, atol=tol, mxstep=2000)
+        elif self.reduced:
+            xf, info = reduced_odeint(self, self.state0 + list(x[:-1]), tspan, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        else:
+            xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        keep_shot(self, x, tspan, xf, info)
         return xf, info
 
     def _simulate(self, x, tspan):
         # Numerical Integration
-        xf, info = odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), tspan, rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
+        eom, jac = self._rhs()
+        xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
         return xf, info
 
     def _non_dim(self, state):
-        xnd = deepcopy(state)
-        xnd[0] /= self.R
-        xnd[1] /= self.R
-        xnd[2] /= self.V
-        xnd[3] /= self.V
-        xnd[4] /= 1.
-        xnd[5] /= self.M
-        return xnd
+        return (np.asarray(state, dtype=float) / self._state_scales).tolist()
 
     def _dim_back(self, state):
         xd = deepcopy(state)
@@ -252,29 +402,12 @@ class rw_landing(base):
         # Producing the data
         tspan = linspace(0, x[-1], 100)
         full_state, info = self._simulate(x, tspan)
+        controls = self._pontryagin_minimum_principle_many(full_state)
+        ux = controls[:, 0] * np.sin(full_state[:, 4])
+        uy = controls[:, 0] * np.cos(full_state[:, 4])
         # Putting dimensions back
-        res = list()
-        controls = list()
-        ux = list(); uy=list()
-        for line in full_state:
-            print(line)
-            res.append(self._dim_back(line[:6]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            ux.append(controls[-1][0] * sin(line[4]))
-            uy.append(controls[-1][0] * cos(line[4]))
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        theta = list()
-        m = list()
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            theta.append(state[4])
-            m.append(state[5])
+        x, y, vx, vy, theta, m = self._dim_back(full_state[:, :6].T)
+        tspan = tspan * self.T
 
         fig = plt.figure()
         ax = fig.gca()
@@ -293,10 +426,10 @@ class rw_landing(base):
         axarr[2,0].plot(tspan, theta)
         axarr[2,0].set_xlabel('t'); axarr[2,0].set_ylabel('theta');
 
-        axarr[0,1].plot(tspan, [controls[ix][0] for ix in range(len(controls))],'r')
+        axarr[0,1].plot(tspan, controls[:, 0],'r')
         axarr[0,1].set_ylabel('u1')
         axarr[0,1].set_xlabel('t')
-        axarr[1,1].plot(tspan, [controls[ix][1] for ix in range(len(controls))],'k')
+        axarr[1,1].plot(tspan, controls[:, 1],'k')
         axarr[1,1].set_ylabel('u2')
         axarr[1,1].set_xlabel('t')
 
@@ -328,45 +461,14 @@ class rw_landing(base):
 
     def produce_data(self, x, npoints):
 
-        # Producing the data
+        # Producing the data (dense output of the shot, no new integration)
         tspan = linspace(0, x[-1], npoints)
-        full_state, info = self._simulate(x, tspan)
+        full_state = dense_shot(self, x, tspan, rtol=1e-13, atol=1e-13)
+        controls = self._pontryagin_minimum_principle_many(full_state)
         # Putting dimensions back
-        res = list()
-        controls = list()
-        u1 = list(); u2 = list()
-        for line in full_state:
-            res.append(self._dim_back(line[:6]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            u1.append(controls[-1][0])
-            u2.append(controls[-1][1])
-        u1 = vstack(u1)
-        u2 = vstack(u2)
-
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        theta = list()
-        m = list()
-
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            theta.append(state[4])
-            m.append(state[5])
-
-        tspan = vstack(tspan)
-        x = vstack(x)
-        y = vstack(y)
-        vx = vstack(vx)
-        vy = vstack(vy)
-        theta =vstack(theta)
-        m = vstack(m)
-
-        return (hstack((tspan, x, y, vx, vy, theta, m)), hstack((u1, u2)))
+        state = self._dim_back(full_state[:, :6].T).T
+
+        return (hstack((vstack(tspan * self.T), state)), controls)
 
 
 
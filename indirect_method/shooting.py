@@ -0,0 +1,675 @@
+"""
+Shared machinery for the shooting problems defined in the landing models.
+
+ - optional numba compilation of the right hand sides
+ - consistency checks of the compiled kernels against the Python reference
+ - batched (lockstep) shooting of many decision vectors
+ - shooting with the variational equations (analytic constraints gradient)
+ - event driven shooting of the bang-bang problem (switch times)
+ - optional multiple shooting (segments integrated in lockstep)
+ - dense output of the last shot (produce_data without re-integration)
+ - bounded cache of the shots (constraints and trajectories) of a problem
+ - integration tolerance tiers (loose shots far from feasibility)
+ - reduced formulation (costates known in closed form are not integrated)
+
+"""
+
+from collections import OrderedDict
+from functools import wraps
+
+from numpy import linspace, zeros
+from scipy.integrate import odeint, solve_ivp
+from scipy.interpolate import CubicHermiteSpline
+from scipy.optimize import brentq
+import numpy as np
+
+# Shots (constraints evaluations), gradients, right hand side evaluations and
+# integrator steps of this process, a measure of the work of a solve
+counters = {'shoots': 0, 'gradients': 0, 'rhs': 0, 'steps': 0}
+
+
+def count_work(nfe, nst):
+    # Adds the work of an integration to counters
+    counters['rhs'] += int(nfe)
+    counters['steps'] += int(nst)
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """Fallback when numba is not available: the kernels run as plain
+        Python functions."""
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+def finite_differences_jacobian(fun, y, eps=1e-7, fun_many=None):
+    """Central differences Jacobian of fun (R^n -> R^m) at y. fun_many, if
+    given, evaluates fun on all the rows of a matrix at once (shoot_many)
+    and is called once with the 2n perturbed points."""
+    y = np.asarray(y, dtype=float)
+    h = eps * np.maximum(1., np.abs(y))
+    if fun_many is not None:
+        Y = np.vstack((y + np.diag(h), y - np.diag(h)))
+        F = np.asarray(fun_many(Y), dtype=float)
+        return ((F[:len(y)] - F[len(y):]) / 2. / h[:, None]).T
+    J = zeros((len(np.atleast_1d(fun(y))), len(y)))
+    for j in range(len(y)):
+        yp = y.copy()
+        ym = y.copy()
+        yp[j] += h[j]
+        ym[j] -= h[j]
+        J[:, j] = (np.atleast_1d(fun(yp)) - np.atleast_1d(fun(ym))) / 2. / h[j]
+    return J
+
+
+def check_compiled(prob, x, npoints=20):
+    """Checks the compiled kernels of a landing problem against the pure
+    Python reference.
+
+    The states are sampled along the trajectory defined by the decision
+    vector x. Returns the maximum absolute error of the compiled right hand
+    side and of the analytic Jacobian (against central differences of the
+    reference right hand side).
+    """
+    compiled = prob.compiled
+    prob.compiled = False
+    try:
+        full_states, info = prob._simulate(x, linspace(0, x[-1], npoints))
+    finally:
+        prob.compiled = compiled
+
+    rhs_err = 0.
+    jac_err = 0.
+    for full_state in full_states:
+        ref = np.asarray(prob._eom(full_state, 0.))
+        fast = prob._eom_compiled(full_state, 0.)
+        rhs_err = max(rhs_err, np.max(np.abs(ref - fast)))
+
+        ref_jac = finite_differences_jacobian(lambda y: prob._eom(y, 0.),
+                                              full_state)
+        jac = prob._eom_jacobian(full_state, 0.)
+        jac_err = max(jac_err, np.max(np.abs(ref_jac - jac)))
+
+    return {'rhs': rhs_err, 'jacobian': jac_err}
+
+
+# Dormand-Prince 5(4) tableau
+_DP_A = [[],
+         [1. / 5.],
+         [3. / 40., 9. / 40.],
+         [44. / 45., -56. / 15., 32. / 9.],
+         [19372. / 6561., -25360. / 2187., 64448. / 6561., -212. / 729.],
+         [9017. / 3168., -355. / 33., 46732. / 5247., 49. / 176., -5103. / 18656.],
+         [35. / 384., 0., 500. / 1113., 125. / 192., -2187. / 6784., 11. / 84.]]
+_DP_E = [71. / 57600., 0., -71. / 16695., 71. / 1920., -17253. / 339200., 22. / 525., -1. / 40.]
+
+
+def integrate_many(fun, Y0, t1=1., rtol=1e-10, atol=1e-10, h0=1e-3,
+                   max_step=np.inf, max_steps=100000, switching=None,
+                   switch_tol=1e-9):
+    """Integrates the autonomous system dY/dt = fun(Y) from 0 to t1 for all
+    the rows of Y0 at once (embedded Dormand-Prince 5(4), shared step).
+
+    The step is accepted only if the error estimate of every row is within
+    tolerance. With switching (S(Y), one value per row, whose zeros are the
+    discontinuities of fun) a step where S changes sign in some row is cut
+    to end within switch_tol * t1 past the first zero, the shared step never
+    spans a switch. Returns the final states and a dict with the number of
+    steps and of (vectorized) right hand side evaluations.
+    """
+    Y = np.array(Y0, dtype=float)
+    K = [fun(Y)] + [None] * 6
+    info = {'nst': 0, 'nfe': 1, 'success': True}
+    t = 0.
+    h = min(h0, max_step, t1)
+    if switching is not None:
+        S = switching(Y)
+    # Step size before it was cut at a switch
+    h_free = None
+    while t < t1:
+        if info['nst'] >= max_steps or h < 1e-14 * t1:
+            info['success'] = False
+            break
+        h = min(h, t1 - t)
+        for i in range(1, 7):
+            dY = K[0] * _DP_A[i][0]
+            for j in range(1, i):
+                dY = dY + K[j] * _DP_A[i][j]
+            K[i] = fun(Y + h * dY)
+        info['nfe'] += 6
+        # The last stage is evaluated at the 5th order solution (FSAL)
+        Ynew = Y + h * dY
+
+        err = K[0] * _DP_E[0]
+        for j in range(2, 7):
+            err = err + K[j] * _DP_E[j]
+        scale = atol + rtol * np.maximum(np.abs(Y), np.abs(Ynew))
+        err_norm = np.max(np.abs(h * err) / scale)
+
+        if err_norm <= 1. and switching is not None:
+            S_new = switching(Ynew)
+            crossed = np.sign(S_new) != np.sign(S)
+            if np.any(crossed):
+                # First zero, linear in the step (secant iterations)
+                theta = np.min(S[crossed] / (S[crossed] - S_new[crossed]))
+                if (1. - theta) * h > switch_tol * t1:
+                    h_free = h_free or h
+                    h = theta * h + 0.5 * switch_tol * t1
+                    continue
+            S = S_new
+        if err_norm <= 1.:
+            t += h
+            Y = Ynew
+            K[0] = K[6]
+            info['nst'] += 1
+            if h_free is not None:
+                # Past the switch, back to the step before it
+                h, h_free = h_free, None
+                continue
+        if np.isfinite(err_norm):
+            h *= min(5., max(0.2, 0.9 * (err_norm + 1e-16) ** -0.2))
+        else:
+            h *= 0.2
+        h = min(h, max_step)
+    return Y, info
+
+
+def _switching_many(prob):
+    # Switching function of the rows of integrate_many, the throttle is only
+    # discontinuous in the bang-bang problem
+    return prob._switching_function_many if prob.homotopy == 1 else None
+
+
+# Rows from which shoot_many beats as many serial shots. Measured on the
+# landing models at homotopy 0 (crossover between 16 and 40 rows), at
+# homotopy 1 the switches of the rows cut the shared step and the serial
+# shots (odeint, switched_shoot) are faster at any size
+BATCH_ROWS = 32
+
+
+def batch_wins(prob, rows):
+    """True if shoot_many is expected to be faster than serial shots of prob
+    for rows decision vectors (smooth controls and enough rows)"""
+    return (hasattr(prob, 'shoot_many') and prob.homotopy < 1 and
+            getattr(prob, 'segments', 1) == 1 and rows >= BATCH_ROWS)
+
+
+def shoot_many(prob, X, rtol=1e-13, atol=1e-13, max_step=np.inf):
+    """Integrates the decision vectors in the rows of X in lockstep and
+    returns the corresponding constraint vectors (one per row).
+
+    Each trajectory is integrated in the normalised time tau = t / tf, so
+    that trajectories with different final times share the same steps. See
+    batch_wins for when it pays off.
+    """
+    X = np.atleast_2d(np.asarray(X, dtype=float))
+    counters['shoots'] += len(X)
+    tf = X[:, -1:]
+    Y0 = np.hstack((np.tile(prob.state0, (len(X), 1)), X[:, :-1]))
+    Yf, info = integrate_many(lambda Y: tf * prob._eom_many(Y), Y0,
+                              rtol=rtol, atol=atol,
+                              max_step=max_step / np.max(tf),
+                              switching=_switching_many(prob))
+    count_work(info['nfe'] * len(X), info['nst'])
+    if not info['success']:
+        Yf[:] = np.nan
+    return np.array([prob._final_constraints(yf) for yf in Yf])
+
+
+class _WorkLimit(Exception):
+    # The right hand side evaluations of _variational_arcs ran out
+    pass
+
+
+def _variational_arcs(prob, y, phi, tf, rtol, atol, max_step, max_rhs=20000,
+                      max_switches=50):
+    """Integrates the full state y and its transition matrix phi (2n x m)
+    over [0, tf]. Returns the final y, phi and throttle (None on failure,
+    also beyond max_rhs right hand side evaluations or max_switches switches,
+    as odeint's mxstep bounds _shoot)."""
+    n = len(prob.state0)
+    m = phi.shape[1]
+    nfe = [0]
+
+    def rhs(t, z, throttle):
+        nfe[0] += 1
+        if nfe[0] > max_rhs:
+            raise _WorkLimit()
+        y = z[:2 * n]
+        phi = z[2 * n:].reshape(2 * n, m)
+        dphi = np.dot(prob._eom_jacobian(y, t, throttle), phi)
+        return np.concatenate((prob._eom_compiled(y, t, throttle), dphi.ravel()))
+
+    def switching(t, z):
+        return prob._switching_function(z[:2 * n])
+    switching.terminal = True
+
+    z = np.concatenate((y, phi.ravel()))
+    t = 0.
+    throttle = -1.
+    events = None
+    if prob.homotopy == 1:
+        throttle = 0. if switching(t, z) >= 0 else 1.
+        events = [switching]
+
+    switches = 0
+    while t < tf:
+        if events:
+            # Thrust arcs end when S becomes positive, coasting arcs when negative
+            switching.direction = 1. if throttle == 1. else -1.
+        before = nfe[0]
+        try:
+            sol = solve_ivp(lambda t, z: rhs(t, z, throttle), (t, tf), z,
+                            method='LSODA', events=events, rtol=rtol,
+                            atol=atol, max_step=max_step)
+        except _WorkLimit:
+            count_work(max_rhs - before, 0)
+            return None
+        count_work(sol.nfev, len(sol.t) - 1)
+        if sol.status == -1:
+            return None
+        z = sol.y[:, -1]
+        if sol.status == 0:
+            break
+
+        # Switching: the throttle flips and the transition matrix jumps
+        switches += 1
+        if switches > max_switches:
+            return None
+        t = sol.t[-1]
+        y = z[:2 * n]
+        phi = z[2 * n:].reshape(2 * n, m)
+        f_minus = prob._eom_compiled(y, t, throttle)
+        throttle = 1. - throttle
+        f_plus = prob._eom_compiled(y, t, throttle)
+        dS = finite_differences_jacobian(prob._switching_function, y)[0]
+        phi = phi + np.outer(f_plus - f_minus, np.dot(dS, phi)) / np.dot(dS, f_minus)
+        z = np.concatenate((y, phi.ravel()))
+
+    return z[:2 * n], z[2 * n:].reshape(2 * n, m), throttle
+
+
+def variational_shoot(prob, x, rtol=1e-13, atol=1e-13, max_step=np.inf):
+    """Integrates the trajectory defined by x together with its state
+    transition matrix w.r.t. the initial costates (variational equations).
+
+    For the bang-bang problem (homotopy == 1) the integration proceeds arc by
+    arc with a fixed throttle, and the transition matrix jumps at each zero of
+    the switching function (saltation matrix).
+
+    Returns the final full state and its Jacobian w.r.t. the decision vector
+    (2n x n+1, the last column being the derivative w.r.t. the final time).
+    """
+    n = len(prob.state0)
+    tf = x[-1]
+    phi0 = np.vstack((zeros((n, n)), np.eye(n)))
+    arcs = _variational_arcs(prob, np.concatenate((prob.state0, list(x[:-1]))),
+                             phi0, tf, rtol, atol, max_step)
+    if arcs is None:
+        return np.nan * zeros(2 * n), np.nan * zeros((2 * n, n + 1))
+    yf, phi, throttle = arcs
+    return yf, np.column_stack((phi, prob._eom_compiled(yf, tf, throttle)))
+
+
+def reduced_indices(prob):
+    """Components of the full state integrated by the reduced formulation,
+    all but the closed form costates prob._linear_costates"""
+    return [i for i in range(2 * len(prob.state0))
+            if i not in prob._linear_costates]
+
+
+def reduced_odeint(prob, y0, tspan, **kwargs):
+    """odeint of the reduced formulation from the full state y0 at tspan[0].
+
+    The costates of the positions are constant and those of the velocities
+    linear in time, lvx = lvx0 - lx0 (t - t0) and lvy = lvy0 - ly0 (t - t0)
+    (indices lx, ly, lvx, lvy in prob._linear_costates): only the other
+    components go through the integrator, on the right hand side and
+    Jacobian of prob._rhs. Returns the full states at tspan and the odeint
+    info (full_output must be set for the info).
+    """
+    eom, jac = prob._rhs()
+    ix, iy, ivx, ivy = prob._linear_costates
+    idx = np.array(reduced_indices(prob))
+    y0 = np.asarray(y0, dtype=float)
+    t0 = tspan[0]
+    full = y0.copy()
+    lv0, l0 = y0[[ivx, ivy]], y0[[ix, iy]]
+    lv = np.array([ivx, ivy])
+
+    def full_state(y, t):
+        full[idx] = y
+        full[lv] = lv0 - l0 * (t - t0)
+        return full
+
+    def rhs(y, t):
+        return np.asarray(eom(full_state(y, t), t), dtype=float)[idx]
+
+    def rhs_jacobian(y, t):
+        # The closed form costates do not depend on the integrated components
+        return np.asarray(jac(full_state(y, t), t))[np.ix_(idx, idx)]
+
+    out = odeint(rhs, y0[idx], tspan, Dfun=rhs_jacobian if jac else None,
+                 **kwargs)
+    ys, info = out if kwargs.get('full_output') else (out, None)
+    tspan = np.asarray(tspan, dtype=float)
+    full_states = np.tile(y0, (len(tspan), 1))
+    full_states[:, idx] = ys
+    full_states[:, ivx] = y0[ivx] - y0[ix] * (tspan - t0)
+    full_states[:, ivy] = y0[ivy] - y0[iy] * (tspan - t0)
+    if info is None:
+        return full_states
+    return full_states, info
+
+
+def _segment_starts(prob, x, segments):
+    # Multiple shooting decision vector: [costates0, full states at the
+    # start of the segments 1..K-1, tf]
+    n = len(prob.state0)
+    starts = np.reshape(np.asarray(x[n:-1], dtype=float), (segments - 1, 2 * n))
+    return np.vstack((np.concatenate((prob.state0, x[:n])), starts))
+
+
+def multiple_shoot(prob, x, segments, rtol=1e-13, atol=1e-13, max_step=np.inf):
+    """Constraints of the multiple shooting formulation: the final
+    constraints of the last segment followed by the defects (end of a
+    segment - start of the next one). The K segments, of duration tf / K,
+    are integrated in lockstep (integrate_many)."""
+    starts = _segment_starts(prob, x, segments)
+    tau = x[-1] / float(segments)
+    ends, info = integrate_many(lambda Y: tau * prob._eom_many(Y), starts,
+                                rtol=rtol, atol=atol, max_step=max_step / tau,
+                                switching=_switching_many(prob))
+    count_work(info['nfe'] * segments, info['nst'])
+    if not info['success']:
+        ends[:] = np.nan
+    return list(prob._final_constraints(ends[-1])) + list((ends[:-1] - starts[1:]).ravel())
+
+
+def multiple_shoot_gradient(prob, x, segments, rtol=1e-13, atol=1e-13,
+                            max_step=np.inf):
+    """Jacobian of multiple_shoot, from the variational equations of each
+    segment (block structure: each segment depends on its start and tf)"""
+    n = len(prob.state0)
+    starts = _segment_starts(prob, x, segments)
+    tau = x[-1] / float(segments)
+    n_final = len(prob._final_constraints(starts[0]))
+    J = zeros((n_final + 2 * n * (segments - 1), len(x)))
+    for k, start in enumerate(starts):
+        if k == 0:
+            phi0, cols = np.eye(2 * n)[:, n:], slice(0, n)
+        else:
+            phi0, cols = np.eye(2 * n), slice(n + 2 * n * (k - 1), n + 2 * n * k)
+        arcs = _variational_arcs(prob, start, phi0, tau, rtol, atol, max_step)
+        if arcs is None:
+            return np.nan * J
+        yf, phi, throttle = arcs
+        dtf = prob._eom_compiled(yf, tau, throttle) / segments
+        if k < segments - 1:
+            rows = slice(n_final + 2 * n * k, n_final + 2 * n * (k + 1))
+            J[rows, cols] = phi
+            J[rows, -1] = dtf
+            J[rows, n + 2 * n * k:n + 2 * n * (k + 1)] = - np.eye(2 * n)
+        else:
+            dceq = prob._final_constraints_jacobian(yf)
+            J[:n_final, cols] = np.dot(dceq, phi)
+            J[:n_final, -1] = np.dot(dceq, dtf)
+    return J
+
+
+def multiple_shoot_trajectory(prob, x, tspan, segments, **kwargs):
+    """Full states at the times tspan of the multiple shooting solution x,
+    each segment integrated (odeint) from its own start"""
+    starts = _segment_starts(prob, x, segments)
+    tau = x[-1] / float(segments)
+    eom, jac = prob._rhs()
+    full_states = np.empty((len(tspan), starts.shape[1]))
+    segment = np.minimum((np.asarray(tspan) / tau).astype(int), segments - 1)
+    for k, start in enumerate(starts):
+        inside = segment == k
+        if inside.any():
+            t = np.concatenate(([k * tau], np.asarray(tspan)[inside]))
+            full_states[inside] = odeint(eom, start, t, Dfun=jac, **kwargs)[1:]
+    return full_states
+
+
+def multiple_shooting_guess(prob, x, segments):
+    """Multiple shooting decision vector from the single shooting one x
+    (the segment starts are taken along the trajectory of x)"""
+    n = len(prob.state0)
+    tspan = np.linspace(0, x[-1], segments + 1)[:-1]
+    eom, jac = prob._rhs()
+    y0 = np.concatenate((prob.state0, np.asarray(x[:-1], dtype=float)))
+    ys = odeint(eom, y0, tspan, Dfun=jac, rtol=1e-10, atol=1e-10, mxstep=5000)
+    return list(x[:n]) + list(ys[1:].ravel()) + [x[-1]]
+
+
+def switched_shoot(prob, x, tspan, rtol=1e-13, atol=1e-13, max_switches=50,
+                   **kwargs):
+    """Shot of the bang-bang problem (homotopy == 1) with the switches of the
+    throttle located as events.
+
+    Each arc is integrated by odeint with a fixed throttle, hence a smooth
+    right hand side, instead of stepping through the discontinuities of the
+    controls. The arc is continued past its end: the first node where the
+    switching function has the wrong sign brackets the switch, whose time is
+    found (brentq) on that interval. The next arc starts there with the
+    other throttle. After max_switches the throttle is left to the right
+    hand side (chattering).
+
+    Returns the full states at tspan and a dict with the switch times.
+    """
+    y = np.concatenate((prob.state0, np.asarray(x[:-1], dtype=float)))
+    full_states = np.empty((len(tspan), len(y)))
+    full_states[0] = y
+    throttle = 0. if prob._switching_function(y) >= 0 else 1.
+    t = tspan[0]
+    k = 1
+    switch_times = []
+
+    def arc(y, ts, throttle):
+        ys, info = odeint(prob._eom_compiled, y, ts, args=(throttle,),
+                          Dfun=prob._eom_jacobian, rtol=rtol, atol=atol,
+                          full_output=1, **kwargs)
+        count_work(info['nfe'][-1], info['nst'][-1])
+        return ys
+
+    while k < len(tspan):
+        ts = np.concatenate(([t], tspan[k:]))
+        if len(switch_times) >= max_switches:
+            throttle = -1.
+        ys = arc(y, ts, throttle)
+        if throttle == -1.:
+            full_states[k:] = ys[1:]
+            break
+        # Thrust arcs end where S >= 0, coasting arcs where S < 0
+        S = prob._switching_function_many(ys[1:])
+        ended = np.flatnonzero((S < 0) != (throttle == 1.))
+        if not len(ended):
+            full_states[k:] = ys[1:]
+            break
+
+        j = ended[0]
+        full_states[k:k + j] = ys[1:j + 1]
+        ta, ya = ts[j], ys[j]
+        S_arc = lambda t: prob._switching_function(arc(ya, [ta, t], throttle)[-1])
+        if prob._switching_function(ya) * S[j] < 0:
+            t = brentq(S_arc, ta, ts[j + 1], xtol=1e-15, rtol=4 * np.finfo(float).eps)
+        else:
+            t = ta
+        y = arc(ya, [ta, t], throttle)[-1]
+        switch_times.append(t)
+        throttle = 1. - throttle
+        k += j
+    return full_states, {'switch_times': switch_times}
+
+
+class ShotCache(object):
+    """Bounded (least recently used) cache of the shots of a landing problem:
+    the constraints of x and, if trajectories, the nodes of its trajectory
+    (see dense_shot).
+
+    The key is the exact bytes of x, the initial state and the homotopy, so a
+    re-parameterised problem does not see the shots of the old parameters.
+    Copies of the problem (e.g. the one of a PyGMO population) share the
+    cache.
+    """
+
+    def __init__(self, size=8, trajectories=True):
+        self.size = size
+        self.trajectories = trajectories
+        self.hits = 0
+        self.misses = 0
+        self._shots = OrderedDict()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return len(self._shots)
+
+    @staticmethod
+    def _key(prob, x):
+        return (np.asarray(x, dtype=float).tobytes(),
+                np.asarray(prob.state0, dtype=float).tobytes(),
+                float(prob.homotopy), getattr(prob, 'shoot_tol', None))
+
+    def get(self, prob, x, field):
+        """Cached field ('constraints' or 'shot') of x, None on a miss"""
+        key = self._key(prob, x)
+        entry = self._shots.get(key)
+        if entry is None or entry.get(field) is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Most recently used last
+        self._shots[key] = self._shots.pop(key)
+        return entry[field]
+
+    def put(self, prob, x, **fields):
+        key = self._key(prob, x)
+        entry = self._shots.pop(key, {})
+        entry.update(fields)
+        self._shots[key] = entry
+        while len(self._shots) > self.size:
+            self._shots.popitem(last=False)
+
+    def clear(self):
+        self._shots.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
+
+def memoised_constraints(method):
+    """Decorates _compute_constraints_impl: the constraints of an x already
+    shot come from the shot_cache of the problem"""
+    @wraps(method)
+    def wrapper(prob, x):
+        cache = getattr(prob, 'shot_cache', None)
+        if cache is None:
+            return method(prob, x)
+        ceq = cache.get(prob, x, 'constraints')
+        if ceq is None:
+            ceq = method(prob, x)
+            cache.put(prob, x, constraints=tuple(ceq))
+        return list(ceq)
+    return wrapper
+
+
+def keep_shot(prob, x, tspan, full_states, info=None):
+    """Stores the nodes of the shot of x, used by dense_shot, and counts the
+    work of odeint (info, its full output)"""
+    if getattr(prob, 'shoot_tol', None) is None:
+        # Only the shots at the reference tolerance are worth interpolating
+        prob._last_shot = (np.array(x, dtype=float), tspan, full_states)
+        cache = getattr(prob, 'shot_cache', None)
+        if cache is not None and cache.trajectories:
+            cache.put(prob, x, shot=(tspan, full_states))
+    if info and 'nfe' in info:
+        count_work(info['nfe'][-1], info['nst'][-1])
+
+
+def tolerance_for(prob, violation):
+    """Integration tolerance of the tier of the constraints violation
+    (max |c|) in prob.tolerance_schedule, a list of (threshold, tol) by
+    decreasing threshold. None (the reference tolerance of the problem) below
+    the last threshold or without a schedule."""
+    for threshold, tol in getattr(prob, 'tolerance_schedule', None) or ():
+        if violation > threshold:
+            return tol
+    return None
+
+
+def _kept_shot(prob, x):
+    # Nodes of the shot of x from the cache or the last shot, None if x must
+    # be shot again
+    cache = getattr(prob, 'shot_cache', None)
+    if cache is not None and cache.trajectories:
+        return cache.get(prob, x, 'shot')
+    shot = getattr(prob, '_last_shot', None)
+    if shot is not None and np.array_equal(shot[0], np.asarray(x, dtype=float)):
+        return shot[1:]
+    return None
+
+
+def dense_shot(prob, x, tspan, tol=1e-8, rtol=1e-12, atol=1e-12):
+    """Full states of the trajectory of x at the times tspan (within [0, tf]).
+
+    The nodes of the shot of x (see keep_shot) are interpolated with cubic
+    Hermite polynomials, using the equations of motion at the nodes as
+    derivatives, so the solution the solver accepted is not integrated again
+    (x is shot once if it is not cached). The derivatives jump where
+    the controls switch or saturate: the intervals whose midpoint defect
+    (|f(y) - y'| h, relative to the state magnitude) exceeds tol are
+    integrated from their first node instead.
+    """
+    shot = _kept_shot(prob, x)
+    if shot is None:
+        prob._shoot(x)
+        shot = prob._last_shot[1:]
+    nodes, states = shot
+    tspan = np.clip(np.asarray(tspan, dtype=float), nodes[0], nodes[-1])
+    spline = CubicHermiteSpline(nodes, states, prob._eom_many(states))
+    full_states = spline(tspan)
+
+    mid = (nodes[1:] + nodes[:-1]) / 2.
+    defect = np.abs(prob._eom_many(spline(mid)) - spline(mid, 1))
+    defect *= np.diff(nodes).reshape(-1, 1) / (1. + np.abs(states).max(axis=0))
+    eom, jac = prob._rhs()
+    # Times closer to the node than this keep the spline value (exact at the
+    # node), odeint rejects a first output time too close to the start
+    close = 1e-10 * (nodes[-1] - nodes[0])
+    for i in np.flatnonzero(defect.max(axis=1) > tol):
+        inside = (tspan > nodes[i] + close) & (tspan < nodes[i + 1])
+        if inside.any():
+            t = np.concatenate(([nodes[i]], tspan[inside]))
+            full_states[inside] = odeint(eom, states[i], t, Dfun=jac,
+                                         rtol=rtol, atol=atol, mxstep=2000)[1:]
+    return full_states
+
+
+def hamiltonian_gradient(prob, full_state):
+    """Gradient of the Hamiltonian w.r.t. the full state. Since the controls
+    minimise H, dH/dx = - dl/dt and dH/dl = dx/dt."""
+    n = len(prob.state0)
+    f = np.asarray(prob._eom(full_state, 0.))
+    return np.concatenate((- f[n:], f[:n]))
+
+
+def check_gradient(prob, x, eps=1e-7):
+    """Maximum absolute difference between the analytic constraints gradient
+    and central differences of _compute_constraints_impl"""
+    G = np.asarray(prob._compute_constraints_gradient_impl(x))
+    G_fd = zeros(G.shape)
+    for j in range(len(x)):
+        h = eps * max(1., abs(x[j]))
+        xp = np.array(x, dtype=float)
+        xm = np.array(x, dtype=float)
+        xp[j] += h
+        xm[j] -= h
+        G_fd[:, j] = (np.asarray(prob._compute_constraints_impl(xp)) -
+                      np.asarray(prob._compute_constraints_impl(xm))) / 2. / h
+    return np.max(np.abs(G - G_fd))
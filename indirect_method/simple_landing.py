@@ -17,6 +17,100 @@ import sys
 
 import numpy as np
 
+from shooting import njit, shoot_many, variational_shoot, hamiltonian_gradient
+from shooting import keep_shot, dense_shot, switched_shoot, reduced_odeint
+from shooting import counters, ShotCache, memoised_constraints
+
+
+@njit(cache=True, error_model='numpy')
+def _rhs_kernel(full_state, c1, c2, g, homotopy, throttle):
+    """Compiled state + costate right hand side (same as simple_landing._eom).
+    A throttle >= 0 replaces the bang-bang switching (homotopy == 1) on a known arc."""
+    x, y, vx, vy, m, lx, ly, lvx, lvy, lm = full_state
+
+    # Pontryagin minimum principle
+    lv_norm = np.sqrt(lvx**2 + lvy**2)
+    stheta = - lvx / lv_norm
+    ctheta = - lvy / lv_norm
+    if homotopy == 1:
+        S = 1. - lm - lv_norm / m * c2
+        u = 0. if S >= 0 else 1.
+        if throttle >= 0:
+            u = throttle
+    else:
+        u = 1. / 2. / c1 / (1 - homotopy) * (lm + lv_norm * c2 / m - homotopy)
+        u = min(max(u, 0.), 1.)
+
+    dy = np.empty(10)
+    dy[0] = vx
+    dy[1] = vy
+    dy[2] = c1 * u / m * stheta
+    dy[3] = c1 * u / m * ctheta - g
+    dy[4] = - c1 * u / c2
+    dy[5] = 0.
+    dy[6] = 0.
+    dy[7] = - lx
+    dy[8] = - ly
+    dy[9] = c1 * u / m**2 * (lvx * stheta + lvy * ctheta)
+    return dy
+
+
+@njit(cache=True, error_model='numpy')
+def _jac_kernel(full_state, c1, c2, g, homotopy, throttle):
+    """Analytic Jacobian of _rhs_kernel w.r.t. the full state"""
+    x, y, vx, vy, m, lx, ly, lvx, lvy, lm = full_state
+
+    lv_norm = np.sqrt(lvx**2 + lvy**2)
+    stheta = - lvx / lv_norm
+    ctheta = - lvy / lv_norm
+
+    # Derivatives of the thrust direction
+    dst = np.zeros(10)
+    dct = np.zeros(10)
+    lv3 = lv_norm**3
+    dst[7] = - lvy**2 / lv3
+    dst[8] = lvx * lvy / lv3
+    dct[7] = lvx * lvy / lv3
+    dct[8] = - lvx**2 / lv3
+
+    # Throttle and its derivatives (zero when saturated or bang-bang)
+    du = np.zeros(10)
+    if homotopy == 1:
+        S = 1. - lm - lv_norm / m * c2
+        u = 0. if S >= 0 else 1.
+        if throttle >= 0:
+            u = throttle
+    else:
+        k = 1. / 2. / c1 / (1 - homotopy)
+        u = k * (lm + lv_norm * c2 / m - homotopy)
+        if u > 0. and u < 1.:
+            du[4] = - k * lv_norm * c2 / m**2
+            du[7] = k * c2 / m * lvx / lv_norm
+            du[8] = k * c2 / m * lvy / lv_norm
+            du[9] = k
+        u = min(max(u, 0.), 1.)
+
+    J = np.zeros((10, 10))
+    J[0, 2] = 1.
+    J[1, 3] = 1.
+    for j in range(10):
+        J[2, j] = c1 / m * (du[j] * stheta + u * dst[j])
+        J[3, j] = c1 / m * (du[j] * ctheta + u * dct[j])
+        J[4, j] = - c1 / c2 * du[j]
+    J[2, 4] -= c1 * u / m**2 * stheta
+    J[3, 4] -= c1 * u / m**2 * ctheta
+    J[7, 5] = -1.
+    J[8, 6] = -1.
+
+    # dlm = - c1 u lv_norm / m**2
+    J[9, 4] = 2. * c1 * u * lv_norm / m**3
+    for j in range(10):
+        J[9, j] -= c1 / m**2 * du[j] * lv_norm
+    J[9, 7] -= c1 * u / m**2 * lvx / lv_norm
+    J[9, 8] -= c1 * u / m**2 * lvy / lv_norm
+    return J
+
+
 class simple_landing(base):
     def __init__(
             self,
@@ -26,7 +120,10 @@ class simple_landing(base):
             c2 = 311. * 9.81,
             g = 1.6229,
             homotopy = 0.,
-            pinpoint = False
+            pinpoint = False,
+            compiled = False,
+            switch_events = False,
+            reduced = False
             ):
         """
         USAGE: reachable(self, start, end, Isp, Tmax, mu):
@@ -38,6 +135,9 @@ class simple_landing(base):
         * g: planet gravity [m/s**2]
         * homotopy: homotopy parameter, 0->QC, 1->MOC
         * pinpoint: if True toggles the final constraint on the landing x
+        * compiled: if True integrates with the compiled right hand side and its analytic Jacobian
+        * switch_events: if True the bang-bang trajectories (homotopy 1) are integrated arc by arc, the switches being located as events
+        * reduced: if True only the costates without a closed form are integrated (lx, ly are constant, lvx, lvy linear in time)
         """
 
         super(simple_landing, self).__init__(6, 0, 1, 6, 0, 1e-5)
@@ -59,6 +159,9 @@ class simple_landing(base):
         self.c2 = c2 / self.V
         self.g = g / self.A
 
+        # Scales of the state variables (state / scales is non dimensional)
+        self._state_scales = np.array([self.R, self.R, self.V, self.V, self.M])
+
         # We compute the initial and final state in the new units
         self.state0 = self._non_dim(self.state0_input)
         self.statet = self._non_dim(self.statet_input)
@@ -69,39 +172,101 @@ class simple_landing(base):
         # Activates a pinpoint landing
         self.pinpoint = pinpoint
 
+        # Constraints that are squares (see newton_shooting)
+        self._squared_constraints = (4, 5) if pinpoint else (0, 4, 5)
+
         # Stores the homotopy parameter, 0->QC, 1->MOC
         self.homotopy = homotopy
 
+        # Selects the compiled right hand side (the Python one is the reference)
+        self.compiled = compiled
+
+        # Integrates the bang-bang arcs separately (see shooting.switched_shoot)
+        self.switch_events = switch_events
+
+        # Integrates the costates lx, ly, lvx, lvy (indices below) in closed
+        # form (see shooting.reduced_odeint)
+        self.reduced = reduced
+        self._linear_costates = (5, 6, 7, 8)
+
+        # Last shots (constraints and trajectories), repeated x are not shot again
+        self.shot_cache = ShotCache()
+
+        # Integration tolerance while the constraints violation is above each
+        # threshold, 1e-13 below them (see shooting.tolerance_for)
+        self.tolerance_schedule = [(1e-2, 1e-9), (1e-4, 1e-11)]
+        # Tolerance of the current tier, None for the reference 1e-13
+        self.shoot_tol = None
+
+    def set_parameters(self, state0=None, homotopy=None):
+        """
+        Re-parameterises the problem in place, cheaper than building a new one
+
+        * state0: initial state, dimensional as in the constructor
+        * homotopy: homotopy parameter, 0->QC, 1->MOC
+        """
+        if state0 is not None:
+            self.state0_input = state0
+            self.state0 = self._non_dim(state0)
+        if homotopy is not None:
+            self.homotopy = homotopy
+        # The last shot (dense output) belongs to the old parameters
+        self._last_shot = None
+
     def _objfun_impl(self, x):
         return(1.,) # constraint satisfaction, no objfun
 
+    @memoised_constraints
     def _compute_constraints_impl(self, x):
         # Perform one forward shooting
+        counters['shoots'] += 1
         xf, info = self._shoot(x)
+        return self._final_constraints(xf[-1])
 
+    def _final_constraints(self, full_state):
         # Assembling the equality constraint vector
         ceq = list([0]*6)
 
         # Final conditions
         if self.pinpoint:
             #Pinpoint landing x is fixed lx is free
-            ceq[0] = (xf[-1][0] - self.statet[0] )
+            ceq[0] = (full_state[0] - self.statet[0] )
         else:
             #Transversality condition: x is free lx is 0
-            ceq[0] = xf[-1][5] ** 2
+            ceq[0] = full_state[5] ** 2
 
-        ceq[1] = (xf[-1][1] - self.statet[1] )
-        ceq[2] = (xf[-1][2] - self.statet[2] )
-        ceq[3] = (xf[-1][3] - self.statet[3] )
+        ceq[1] = (full_state[1] - self.statet[1] )
+        ceq[2] = (full_state[2] - self.statet[2] )
+        ceq[3] = (full_state[3] - self.statet[3] )
         
         # Transversality condition on mass (free)
-        ceq[4] = xf[-1][9] ** 2
+        ceq[4] = full_state[9] ** 2
 
         # Free time problem, Hamiltonian must be 0
-        ceq[5] = self._hamiltonian(xf[-1]) ** 2
+        ceq[5] = self._hamiltonian(full_state) ** 2
 
         return ceq
 
+    def _final_constraints_jacobian(self, full_state):
+        # Derivatives of _final_constraints w.r.t. the final full state
+        dceq = np.zeros((6, 10))
+        if self.pinpoint:
+            dceq[0, 0] = 1.
+        else:
+            dceq[0, 5] = 2. * full_state[5]
+        dceq[1, 1] = 1.
+        dceq[2, 2] = 1.
+        dceq[3, 3] = 1.
+        dceq[4, 9] = 2. * full_state[9]
+        dceq[5] = 2. * self._hamiltonian(full_state) * hamiltonian_gradient(self, full_state)
+        return dceq
+
+    def _compute_constraints_gradient_impl(self, x):
+        counters['gradients'] += 1
+        # One integration of the trajectory and of its variational equations
+        xf, dxf = variational_shoot(self, x, rtol=self.shoot_tol or 1e-13, atol=self.shoot_tol or 1e-13)
+        return np.dot(self._final_constraints_jacobian(xf), dxf)
+
     def _hamiltonian(self, full_state):
         state = full_state[:5]
         costate = full_state[5:]
@@ -184,6 +349,11 @@ class simple_landing(base):
             u = max(u,0.)
         return [u, stheta, ctheta]
 
+    def _switching_function(self, full_state):
+        # Switching function of the mass optimal throttle (u = 1 where S < 0)
+        x,y,vx,vy,m,lx,ly,lvx,lvy,lm = full_state
+        return 1. - lm - sqrt(lvx**2 + lvy**2) / m * self.c2
+
     def _eom(self, full_state, t):
         # Applying Pontryagin minimum principle
         state = full_state[:5]
@@ -194,24 +364,87 @@ class simple_landing(base):
         dcostate = self._eom_costate(full_state, controls)
         return dstate + dcostate
 
+    def _eom_compiled(self, full_state, t, throttle=-1.):
+        return _rhs_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.g, float(self.homotopy), throttle)
+
+    def _eom_jacobian(self, full_state, t, throttle=-1.):
+        return _jac_kernel(np.asarray(full_state, dtype=float), self.c1, self.c2, self.g, float(self.homotopy), throttle)
+
+    def _rhs(self):
+        # Right hand side and Jacobian handed to the integrator
+        if self.compiled:
+            return self._eom_compiled, self._eom_jacobian
+        return lambda a,b: self._eom(a,b), None
+
+    def _pontryagin_minimum_principle_many(self, full_states):
+        # Vectorized _pontryagin_minimum_principle, columns u, stheta, ctheta
+        x,y,vx,vy,m,lx,ly,lvx,lvy,lm = full_states.T
+        c1 = self.c1
+        c2 = self.c2
+
+        lv_norm = np.sqrt(lvx**2 + lvy**2)
+        stheta = - lvx / lv_norm
+        ctheta = - lvy / lv_norm
+        if self.homotopy == 1:
+            u = np.where(1. - lm - lv_norm / m * c2 >= 0, 0., 1.)
+        else:
+            u = 1. / 2. / c1 / (1 - self.homotopy) * (lm + lv_norm * c2 / m - self.homotopy)
+            u = np.clip(u, 0., 1.)
+        return np.column_stack((u, stheta, ctheta))
+
+    def _switching_function_many(self, full_states):
+        # Vectorized _switching_function
+        x,y,vx,vy,m,lx,ly,lvx,lvy,lm = full_states.T
+        return 1. - lm - np.sqrt(lvx**2 + lvy**2) / m * self.c2
+
+    def _hamiltonian_many(self, full_states):
+        # Vectorized _hamiltonian
+        c1 = self.c1
+        c2 = self.c2
+        u = self._pontryagin_minimum_principle_many(full_states)[:, 0]
+        f_vett = self._eom_many(full_states)[:, :5]
+        cost = self.homotopy * c1 / c2 * u + (1 - self.homotopy) * c1**2 / c2 * u**2
+        return np.sum(full_states[:, 5:] * f_vett, axis=1) + cost
+
+    def _eom_many(self, full_states):
+        # Vectorized _eom, one full state per row
+        x,y,vx,vy,m,lx,ly,lvx,lvy,lm = full_states.T
+        c1 = self.c1
+        c2 = self.c2
+        g = self.g
+        u, stheta, ctheta = self._pontryagin_minimum_principle_many(full_states).T
+
+        zero = np.zeros_like(x)
+        return np.column_stack((vx, vy, c1 * u / m * stheta, c1 * u / m * ctheta - g, - c1 * u / c2,
+                                zero, zero, - lx, - ly, c1 * u / m**2 * (lvx * stheta + lvy * ctheta)))
+
+    def shoot_many(self, X):
+        # Integrates all the decision vectors (rows of X) at once, returns the constraints
+        tol = self.shoot_tol or 1e-13
+        return shoot_many(self, X, rtol=tol, atol=tol)
+
     def _shoot(self, x):
         # Numerical Integration
-        xf, info = odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), linspace(0, x[-1],100), rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
+        eom, jac = self._rhs()
+        tol = self.shoot_tol or 1e-13
+        tspan = linspace(0, x[-1],100)
+        if self.homotopy == 1 and self.switch_events:
+            xf, info = switched_shoot(self, x, tspan, rtol=tol, atol=tol, mxstep=2000)
+        elif self.reduced:
+            xf, info = reduced_odeint(self, self.state0 + list(x[:-1]), tspan, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        else:
+            xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        keep_shot(self, x, tspan, xf, info)
         return xf, info
 
     def _simulate(self, x, tspan):
         # Numerical Integration
-        xf, info = odeint(lambda a,b: self._eom(a,b), self.state0 + list(x[:-1]), tspan, rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
+        eom, jac = self._rhs()
+        xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
         return xf, info
 
     def _non_dim(self, state):
-        xnd = deepcopy(state)
-        xnd[0] /= self.R
-        xnd[1] /= self.R
-        xnd[2] /= self.V
-        xnd[3] /= self.V
-        xnd[4] /= self.M
-        return xnd
+        return (np.asarray(state, dtype=float) / self._state_scales).tolist()
 
     def _dim_back(self, state):
         xd = deepcopy(state)
@@ -231,26 +464,12 @@ class simple_landing(base):
         # Producing the data
         tspan = linspace(0, x[-1], 100)
         full_state, info = self._simulate(x, tspan)
+        controls = self._pontryagin_minimum_principle_many(full_state)
+        ux = controls[:, 0] * controls[:, 1]
+        uy = controls[:, 0] * controls[:, 2]
         # Putting dimensions back
-        res = list()
-        controls = list()
-        ux = list(); uy=list()
-        for line in full_state:
-            res.append(self._dim_back(line[:5]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            ux.append(controls[-1][0]*controls[-1][1])
-            uy.append(controls[-1][0]*controls[-1][2])
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        m = list()
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            m.append(state[4])
+        x, y, vx, vy, m = self._dim_back(full_state[:, :5].T)
+        tspan = tspan * self.T
 
         fig = plt.figure()
         ax = fig.gca()
@@ -268,13 +487,13 @@ class simple_landing(base):
 
         axarr[2,0].plot(tspan, m)
 
-        axarr[0,1].plot(tspan, [controls[ix][0] for ix in range(len(controls))],'r')
+        axarr[0,1].plot(tspan, controls[:, 0],'r')
         axarr[0,1].set_ylabel('u')
         axarr[0,1].set_xlabel('t')
-        axarr[1,1].plot(tspan, [atan2(controls[ix][1], controls[ix][2]) for ix in range(len(controls))],'k')
+        axarr[1,1].plot(tspan, np.arctan2(controls[:, 1], controls[:, 2]),'k')
         axarr[1,1].set_ylabel('theta')
         axarr[1,1].set_xlabel('t')
-        axarr[2,1].plot(tspan, [controls[ix][2] for ix in range(len(controls))],'k')
+        axarr[2,1].plot(tspan, controls[:, 2],'k')
 
 
         plt.ion()
@@ -303,42 +522,14 @@ class simple_landing(base):
 
     def produce_data(self, x, npoints):
 
-        # Producing the data
-        tspan = linspace(0, x[-1], 100)
-        full_state, info = self._simulate(x, tspan)
+        # Producing the data (dense output of the shot, no new integration)
+        tspan = linspace(0, x[-1], npoints)
+        full_state = dense_shot(self, x, tspan, rtol=1e-13, atol=1e-13)
+        u, stheta, ctheta = self._pontryagin_minimum_principle_many(full_state).T
         # Putting dimensions back
-        res = list()
-        controls = list()
-        u1 = list(); u2 = list()
-        for line in full_state:
-            res.append(self._dim_back(line[:5]))
-            controls.append(self._pontryagin_minimum_principle(line))
-            u1.append(controls[-1][0])
-            u2.append(atan2(controls[-1][1], controls[-1][2]))
-        u1 = np.vstack(u1)
-        u2 = np.vstack(u2)
-
-        tspan = [it * self.T for it in tspan]
-
-        x = list(); y=list()
-        vx = list(); vy = list()
-        m = list()
-
-        for state in res:
-            x.append(state[0])
-            y.append(state[1])
-            vx.append(state[2])
-            vy.append(state[3])
-            m.append(state[4])
-
-        tspan = np.vstack(tspan)
-        x = np.vstack(x)
-        y = np.vstack(y)
-        vx = np.vstack(vx)
-        vy = np.vstack(vy)
-        m = np.vstack(m)
-
-        return (np.hstack((tspan, x, y, vx, vy, m)), np.hstack((u1, u2)))
+        state = self._dim_back(full_state[:, :5].T).T
+
+        return (np.column_stack((tspan * self.T, state)), np.column_stack((u, np.arctan2(stheta, ctheta))))
 
 if __name__ == "__main__":
     from PyGMO import *
@@ -0,0 +1,655 @@
+"""
+Declarative definition of the landing models.
+
+A model is defined once, symbolically (see SIMPLE and RW): states and their
+units, parameters, bounded controls, unit vector controls, dynamics, running
+cost (with the homotopy term) and final conditions. The rest is derived with
+sympy:
+
+ - the costate equations, dl/dt = - dH/dx
+ - the optimal control law (Pontryagin minimum principle): unit vector
+   controls opposite to their coefficient in H, bounded controls from
+   dH/du = 0 (clipped to their bounds) where H is quadratic in them and
+   bang-bang on the sign of dH/du where it is linear (homotopy 1)
+ - the source of the right hand side, of its analytic Jacobian, of the
+   Hamiltonian and of the control law, compiled with numba when available
+   (shooting.njit), plus vectorised versions for the dense output
+ - a PyGMO problem with the interface of the hand-written models: shooting,
+   variational gradient, switched and reduced shooting, shot cache,
+   tolerance tiers and produce_data
+
+Adding a vehicle is a definition and a two line class:
+
+    class simple_symbolic(symbolic_landing):
+        definition = SIMPLE
+
+The controls of a term must not be coupled (each dH/du depends on its own
+control only). The gimbal limited thrust of tv_landing and falcon_landing is
+not of this form, those stay hand-written. The module needs sympy, the kernels
+of a model are built on the first instance of its class (a few seconds).
+
+"""
+from __future__ import division
+
+from PyGMO.problem._base import base
+from scipy.integrate import odeint
+from numpy import linspace
+import numpy as np
+
+from shooting import njit, shoot_many, variational_shoot, hamiltonian_gradient
+from shooting import keep_shot, dense_shot, switched_shoot, reduced_odeint
+from shooting import counters, ShotCache, memoised_constraints
+
+import sympy
+from sympy.printing.numpy import NumPyPrinter
+
+# Non dimensional units: lengths R, speeds V and masses M, hence the
+# accelerations A, times T and forces F
+UNITS = {'R': 1000., 'V': 100., 'M': 10000.}
+
+# Each entry of a definition:
+#  - states: (name, unit), the costates are named l + name, positive: the
+#    states known to be positive (simpler control laws)
+#  - parameters: (name, default dimensional value, unit)
+#  - controls: (name, lower bound, upper bound)
+#  - directions: (sine, cosine, magnitude) unit vector controls, scaled by the
+#    non negative control magnitude
+#  - dynamics, cost: expressions of the above and of homotopy
+#  - final: (state, condition, weight) with the condition 'fixed' (state at
+#    the target), 'free' (transversality, costate 0) or 'pinpoint' (fixed
+#    for a pinpoint landing, free otherwise), hamiltonian: weight of H = 0
+#    (free final time), squared: if True the free and H conditions are squared
+#  - state0, statet: default initial and target states (dimensional)
+#  - tf_bounds: bounds of the final time [s]
+SIMPLE = {
+    'name': 'simple',
+    'states': [('x', 'R'), ('y', 'R'), ('vx', 'V'), ('vy', 'V'), ('m', 'M')],
+    'positive': ['m'],
+    'parameters': [('c1', 44000., 'F'), ('c2', 311. * 9.81, 'V'),
+                   ('g', 1.6229, 'A')],
+    'controls': [('u', 0., 1.)],
+    'directions': [('stheta', 'ctheta', 'u')],
+    'dynamics': ['vx', 'vy', 'c1 * u / m * stheta', 'c1 * u / m * ctheta - g',
+                 '- c1 * u / c2'],
+    'cost': 'homotopy * c1 / c2 * u + (1 - homotopy) * c1**2 / c2 * u**2',
+    'final': [('x', 'pinpoint', 1.), ('y', 'fixed', 1.), ('vx', 'fixed', 1.),
+              ('vy', 'fixed', 1.), ('m', 'free', 1.)],
+    'hamiltonian': 1.,
+    'squared': True,
+    'state0': [0., 1000., 20., -5., 10000.],
+    'statet': [0., 0., 0., 0, 9758.695805],
+    'tf_bounds': (1e-3, 100.),
+    'c_tol': 1e-5,
+}
+
+RW = {
+    'name': 'rw',
+    'states': [('x', 'R'), ('y', 'R'), ('vx', 'V'), ('vy', 'V'),
+               ('theta', '1'), ('m', 'M')],
+    'positive': ['m'],
+    'parameters': [('c1', 44000., 'F'), ('c2', 311. * 9.81, 'V'),
+                   ('c3', 0.0698, '1 / T'), ('g', 1.6229, 'A'),
+                   ('alpha', 1. / 150., '1')],
+    'controls': [('u1', 0., 1.), ('u2', -1., 1.)],
+    'directions': [],
+    'dynamics': ['vx', 'vy', 'c1 * u1 / m * sin(theta)',
+                 'c1 * u1 / m * cos(theta) - g', 'c3 * u2', '- c1 / c2 * u1'],
+    'cost': 'homotopy * c1 / c2 * u1 + (1 - homotopy) * c1**2 / c2 * u1**2 '
+            '+ alpha * c3**2 * u2**2',
+    'final': [('x', 'pinpoint', 100.), ('y', 'fixed', 100.),
+              ('vx', 'fixed', 100.), ('vy', 'fixed', 1000.),
+              ('theta', 'fixed', 1000.), ('m', 'free', 10000.)],
+    'hamiltonian': 10000.,
+    'squared': False,
+    'state0': [0., 1000., 20., -5., 0., 10000.],
+    'statet': [0., 0., 0., 0., 0., 9758.695805],
+    'tf_bounds': (1e-3, 200.),
+    'c_tol': 1e-5,
+}
+
+
+def _units(expression):
+    # Value of a unit expression of R, V, M, A, T, F
+    scales = dict(UNITS)
+    scales['A'] = scales['V']**2 / scales['R']
+    scales['T'] = scales['R'] / scales['V']
+    scales['F'] = scales['M'] * scales['A']
+    return float(sympy.sympify(expression).subs(scales))
+
+
+class _Source(object):
+    # Lines of a generated kernel
+
+    def __init__(self, vector):
+        self.vector = vector
+        self.lines = []
+        self._printer = NumPyPrinter()
+
+    def add(self, line, indent=1):
+        self.lines.append('    ' * indent + line)
+
+    def assign(self, names, exprs, indent=1):
+        # names = exprs, with the common subexpressions computed once
+        temps, exprs = sympy.cse(list(exprs),
+                                 symbols=sympy.numbered_symbols('_t'))
+        for t, e in temps:
+            self.add('{} = {}'.format(t, self.code(e)), indent)
+        for name, e in zip(names, exprs):
+            self.add('{} = {}'.format(name, self.code(e)), indent)
+
+    def code(self, expr):
+        return self._printer.doprint(expr)
+
+    def clip(self, name, lower, upper, indent):
+        if self.vector:
+            self.add('{0} = numpy.clip({0}, {1!r}, {2!r})'.format(
+                name, lower, upper), indent)
+        else:
+            self.add('{0} = min(max({0}, {1!r}), {2!r})'.format(
+                name, lower, upper), indent)
+
+    def bang(self, name, switching, lower, upper, indent):
+        if self.vector:
+            self.add('{} = numpy.where({} >= 0, {!r}, {!r})'.format(
+                name, switching, lower, upper), indent)
+        else:
+            self.add('{} = {!r} if {} >= 0 else {!r}'.format(
+                name, lower, switching, upper), indent)
+
+
+class SymbolicModel(object):
+    """Equations and numeric kernels of a model definition (see SIMPLE)"""
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.name = definition['name']
+        self.states = [s for s, _ in definition['states']]
+        self.costates = ['l' + s for s in self.states]
+        self.parameters = [p for p, _, _ in definition['parameters']]
+        self.controls = [tuple(c) for c in definition['controls']]
+        self.directions = [tuple(d) for d in definition['directions']]
+        self.state_scales = np.array([_units(u) for _, u in definition['states']])
+        self.parameter_scales = np.array([_units(u) for _, _, u in definition['parameters']])
+        self.defaults = [v for _, v, _ in definition['parameters']]
+        self._derive()
+        self._generate()
+
+    def _symbols(self):
+        names = (self.states + self.costates + [c[0] for c in self.controls] +
+                 [n for d in self.directions for n in d[:2]] + ['homotopy'])
+        sym = dict((n, sympy.Symbol(n, real=True)) for n in names)
+        positive = self.parameters + list(self.definition.get('positive', ()))
+        sym.update((p, sympy.Symbol(p, positive=True)) for p in positive)
+        return sym
+
+    def _derive(self):
+        d = self.definition
+        sym = self._symbols()
+        ns = dict(sym)
+        ns.update(sin=sympy.sin, cos=sympy.cos, sqrt=sympy.sqrt, exp=sympy.exp)
+        self.symbols = sym
+        self.y = [sym[n] for n in self.states + self.costates]
+        n = len(self.states)
+
+        # Hamiltonian and costate equations (controls as symbols)
+        f = [sympy.sympify(e, locals=ns) for e in d['dynamics']]
+        self.H = (sum(sym[l] * fi for l, fi in zip(self.costates, f)) +
+                  sympy.sympify(d['cost'], locals=ns))
+        self.F = f + [- sympy.diff(self.H, sym[s]) for s in self.states]
+
+        # Unit vector controls, opposite to their coefficient in H
+        self.direction_laws = []
+        H = self.H
+        for s, c, magnitude in self.directions:
+            a, b = sympy.diff(H, sym[s]), sympy.diff(H, sym[c])
+            if (a.has(sym[s], sym[c]) or b.has(sym[s], sym[c]) or
+                    a.subs(sym[magnitude], 0) != 0 or
+                    b.subs(sym[magnitude], 0) != 0):
+                raise ValueError('H must be linear in the direction {}, {} '
+                                 'and proportional to {}'.format(s, c, magnitude))
+            a, b = a.subs(sym[magnitude], 1), b.subs(sym[magnitude], 1)
+            norm = sympy.sqrt(sympy.factor_terms(a**2 + b**2))
+            self.direction_laws += [(s, - a / norm), (c, - b / norm)]
+        H = H.subs([(sym[name], law) for name, law in self.direction_laws])
+
+        # Bounded controls: stationary (clipped) or bang-bang, at homotopy < 1
+        # and at homotopy 1
+        others = [sym[c[0]] for c in self.controls]
+        self.control_laws = {'smooth': [], 'mass': []}
+        for name, lower, upper in self.controls:
+            Hu = sympy.diff(H, sym[name])
+            if any(Hu.has(o) for o in others if o != sym[name]):
+                raise ValueError('the control {} is coupled to the others'.format(name))
+            for key, Hu_h in (('smooth', Hu), ('mass', Hu.subs(sym['homotopy'], 1))):
+                if sympy.diff(Hu_h, sym[name]) == 0:
+                    self.control_laws[key].append((name, 'bang', sympy.simplify(Hu_h)))
+                    continue
+                sol = sympy.solve(Hu_h, sym[name])
+                if len(sol) != 1:
+                    raise ValueError('no unique stationary {}'.format(name))
+                self.control_laws[key].append((name, 'smooth', sympy.simplify(sol[0])))
+        bang = [law for law in self.control_laws['mass'] if law[1] == 'bang']
+        self.switching = bang[0] if bang else None
+
+        # Costates in closed form (see shooting.reduced_odeint): lx, ly
+        # constant and lvx, lvy linear in time
+        dl = self.F[n:]
+        constant = [i for i in range(n) if dl[i] == 0]
+        pairs = [(i, j) for i in constant for j in range(n)
+                 if j != i and sympy.simplify(dl[j] + sym[self.costates[i]]) == 0]
+        self.linear_costates = None
+        if len(pairs) == 2:
+            (i1, j1), (i2, j2) = pairs
+            self.linear_costates = (n + i1, n + i2, n + j1, n + j2)
+
+    def _header(self, src, name, args):
+        src.add('def {}({}):'.format(name, ', '.join(args)), 0)
+        src.add('{}, = full_state{}'.format(', '.join(self.states + self.costates),
+                                             '.T' if src.vector else ''))
+        if self.parameters:
+            src.add('{}, = p'.format(', '.join(self.parameters)))
+
+    def _control_lines(self, src, throttle, derivatives):
+        # The controls (and with derivatives their gradients _dw_<name> w.r.t.
+        # the full state, zero where saturated or bang-bang)
+        N = len(self.y)
+        if self.direction_laws:
+            src.assign([name for name, _ in self.direction_laws],
+                       [law for _, law in self.direction_laws])
+            if derivatives:
+                for name, law in self.direction_laws:
+                    src.add('_dw_{} = numpy.zeros({})'.format(name, N))
+                    grads = [(j, sympy.diff(law, yj)) for j, yj in enumerate(self.y)]
+                    grads = [(j, g) for j, g in grads if g != 0]
+                    src.assign(['_dw_{}[{}]'.format(name, j) for j, _ in grads],
+                               [g for _, g in grads])
+        if not self.controls:
+            return
+        bounds = dict((c[0], c[1:]) for c in self.controls)
+        src.add('if homotopy == 1:')
+        for key, indent in (('mass', 2), ('smooth', 2)):
+            if key == 'smooth':
+                src.add('else:')
+            for name, kind, expr in self.control_laws[key]:
+                lower, upper = bounds[name]
+                if derivatives:
+                    src.add('_dw_{} = numpy.zeros({})'.format(name, N), indent)
+                if kind == 'bang':
+                    src.assign(['_s_' + name], [expr], indent)
+                    src.bang(name, '_s_' + name, lower, upper, indent)
+                    if throttle and self.switching and name == self.switching[0]:
+                        src.add('if throttle >= 0:', indent)
+                        src.add('{} = throttle'.format(name), indent + 1)
+                    continue
+                src.assign([name], [expr], indent)
+                if derivatives:
+                    grads = [(j, sympy.diff(expr, yj)) for j, yj in enumerate(self.y)]
+                    grads = [(j, g) for j, g in grads if g != 0]
+                    src.add('if {!r} < {} < {!r}:'.format(lower, name, upper), indent)
+                    src.assign(['_dw_{}[{}]'.format(name, j) for j, _ in grads],
+                               [g for _, g in grads], indent + 1)
+                src.clip(name, lower, upper, indent)
+
+    def _outputs(self, src, name, exprs):
+        if src.vector:
+            src.add('{} = numpy.empty(numpy.shape({}) + ({},))'.format(
+                name, self.states[0], len(exprs)))
+            src.assign(['{}[..., {}]'.format(name, i) for i in range(len(exprs))], exprs)
+        else:
+            src.add('{} = numpy.empty({})'.format(name, len(exprs)))
+            src.assign(['{}[{}]'.format(name, i) for i in range(len(exprs))], exprs)
+        src.add('return ' + name)
+
+    def _control_symbols(self):
+        return ([self.symbols[c[0]] for c in self.controls] +
+                [self.symbols[name] for name, _ in self.direction_laws])
+
+    def _kernel_sources(self, vector):
+        sources = {}
+        args = ['full_state', 'p', 'homotopy']
+
+        src = _Source(vector)
+        self._header(src, '_rhs', args + ['throttle'])
+        self._control_lines(src, not vector, False)
+        self._outputs(src, '_dy', self.F)
+        sources['rhs'] = src
+
+        src = _Source(vector)
+        self._header(src, '_controls', args + ['throttle'])
+        self._control_lines(src, not vector, False)
+        self._outputs(src, '_w', self._control_symbols())
+        sources['controls'] = src
+
+        src = _Source(vector)
+        self._header(src, '_hamiltonian', args)
+        self._control_lines(src, False, False)
+        src.assign(['_H'], [self.H])
+        src.add('return _H')
+        sources['hamiltonian'] = src
+
+        if self.switching:
+            src = _Source(vector)
+            self._header(src, '_switching', ['full_state', 'p'])
+            src.assign(['_S'], [self.switching[2]])
+            src.add('return _S')
+            sources['switching'] = src
+
+        if not vector:
+            # J = dF/dy + sum over the controls w of dF/dw dw/dy
+            N = len(self.y)
+            src = _Source(vector)
+            self._header(src, '_jacobian', args + ['throttle'])
+            self._control_lines(src, True, True)
+            src.add('_J = numpy.zeros(({0}, {0}))'.format(N))
+            entries = [(i, j, sympy.diff(Fi, yj)) for i, Fi in enumerate(self.F)
+                       for j, yj in enumerate(self.y)]
+            entries = [e for e in entries if e[2] != 0]
+            src.assign(['_J[{}, {}]'.format(i, j) for i, j, _ in entries],
+                       [e for _, _, e in entries])
+            for w in self._control_symbols():
+                rows = [(i, sympy.diff(Fi, w)) for i, Fi in enumerate(self.F)]
+                rows = [r for r in rows if r[1] != 0]
+                src.assign(['_c{}'.format(i) for i, _ in rows], [e for _, e in rows])
+                for i, _ in rows:
+                    src.add('_J[{0}] += _c{0} * _dw_{1}'.format(i, w))
+            src.add('return _J')
+            sources['jacobian'] = src
+        return sources
+
+    def _generate(self):
+        # Scalar kernels, compiled and Python (suffix _python, the reference),
+        # and vectorised Python ones (suffix _many)
+        self.source = {}
+        self.kernels = {}
+        for vector in (False, True):
+            for name, src in self._kernel_sources(vector).items():
+                key = name + ('_many' if vector else '')
+                code = 'from __future__ import division\n' + '\n'.join(src.lines) + '\n'
+                namespace = {'numpy': np}
+                exec(compile(code, '<{} {}>'.format(self.name, key), 'exec'), namespace)
+                fun = namespace['_' + name]
+                self.source[key] = code
+                self.kernels[key + '_python'] = fun
+                self.kernels[key] = fun if vector else njit(error_model='numpy')(fun)
+
+
+_models = {}
+
+
+def symbolic_model(definition):
+    """The SymbolicModel of definition, built once per process"""
+    if definition['name'] not in _models:
+        _models[definition['name']] = SymbolicModel(definition)
+    return _models[definition['name']]
+
+
+class symbolic_landing(base):
+    """
+    Landing problem of the symbolic definition of the class (see SIMPLE),
+    subclasses set the class attribute definition
+
+    * state0: initial state in the units of the definition (None: its default)
+    * statet: target state (None: the default of the definition)
+    * homotopy: homotopy parameter, 0->QC, 1->MOC
+    * pinpoint: if True the 'pinpoint' final conditions are fixed, free otherwise
+    * compiled: if True integrates with the compiled right hand side and its analytic Jacobian
+    * switch_events: if True the bang-bang trajectories (homotopy 1) are integrated arc by arc, the switches being located as events
+    * reduced: if True only the costates without a closed form are integrated
+    * parameters: dimensional values of the parameters of the definition (default: its values)
+    """
+    definition = None
+
+    def __init__(
+            self,
+            state0 = None,
+            statet = None,
+            homotopy = 0.,
+            pinpoint = False,
+            compiled = False,
+            switch_events = False,
+            reduced = False,
+            **parameters
+            ):
+        model = symbolic_model(self.definition)
+        d = self.definition
+        n = len(model.states)
+        super(symbolic_landing, self).__init__(n + 1, 0, 1, len(d['final']) + 1, 0, d['c_tol'])
+
+        unknown = set(parameters) - set(model.parameters)
+        if unknown:
+            raise ValueError('unknown parameters: {}'.format(sorted(unknown)))
+        if reduced and model.linear_costates is None:
+            raise ValueError('no costates in closed form, reduced is not available')
+        if switch_events and model.switching is None:
+            raise ValueError('no bang-bang control, switch_events is not available')
+
+        # We store the raw inputs for convenience
+        self.state0_input = d['state0'] if state0 is None else state0
+        self.statet_input = d['statet'] if statet is None else statet
+        self.parameters_input = [parameters.get(p, v) for p, v in zip(model.parameters, model.defaults)]
+
+        # Non dimensional parameters and state scales (state / scales is non dimensional)
+        self.T = _units('T')
+        self._p = np.asarray(self.parameters_input, dtype=float) / model.parameter_scales
+        self._state_scales = model.state_scales
+
+        # We compute the initial and final state in the new units
+        self.state0 = self._non_dim(self.state0_input)
+        self.statet = self._non_dim(self.statet_input)
+
+        # We set the bounds (these will only be used to initialize the population)
+        tf_min, tf_max = d['tf_bounds']
+        self.set_bounds([-1.] * n + [tf_min / self.T], [1.] * n + [tf_max / self.T])
+
+        # Activates a pinpoint landing
+        self.pinpoint = pinpoint
+
+        # Constraints that are squares (see newton_shooting)
+        free = [i for i, (_, kind, _) in enumerate(d['final'])
+                if kind == 'free' or (kind == 'pinpoint' and not pinpoint)]
+        self._squared_constraints = tuple(free + [len(d['final'])]) if d['squared'] else ()
+
+        # Stores the homotopy parameter, 0->QC, 1->MOC
+        self.homotopy = homotopy
+
+        # Selects the compiled right hand side (the Python one is the reference)
+        self.compiled = compiled
+
+        # Integrates the bang-bang arcs separately (see shooting.switched_shoot)
+        self.switch_events = switch_events
+
+        # Integrates the costates in closed form (see shooting.reduced_odeint)
+        self.reduced = reduced
+        self._linear_costates = model.linear_costates
+
+        # Last shots (constraints and trajectories), repeated x are not shot again
+        self.shot_cache = ShotCache()
+
+        # Integration tolerance while the constraints violation is above each
+        # threshold, 1e-13 below them (see shooting.tolerance_for)
+        self.tolerance_schedule = [(1e-2, 1e-9), (1e-4, 1e-11)]
+        # Tolerance of the current tier, None for the reference 1e-13
+        self.shoot_tol = None
+
+    @property
+    def model(self):
+        return symbolic_model(self.definition)
+
+    def set_parameters(self, state0=None, homotopy=None):
+        """
+        Re-parameterises the problem in place, cheaper than building a new one
+
+        * state0: initial state, dimensional as in the constructor
+        * homotopy: homotopy parameter, 0->QC, 1->MOC
+        """
+        if state0 is not None:
+            self.state0_input = state0
+            self.state0 = self._non_dim(state0)
+        if homotopy is not None:
+            self.homotopy = homotopy
+        # The last shot (dense output) belongs to the old parameters
+        self._last_shot = None
+
+    def _objfun_impl(self, x):
+        return(1.,) # constraint satisfaction, no objfun
+
+    @memoised_constraints
+    def _compute_constraints_impl(self, x):
+        # Perform one forward shooting
+        counters['shoots'] += 1
+        xf, info = self._shoot(x)
+        return self._final_constraints(xf[-1])
+
+    def _final_conditions(self):
+        # (constraint, state index, fixed, weight) of the final conditions
+        states = self.model.states
+        for i, (name, kind, weight) in enumerate(self.definition['final']):
+            fixed = kind == 'fixed' or (kind == 'pinpoint' and self.pinpoint)
+            yield i, states.index(name), fixed, weight
+
+    def _final_constraints(self, full_state):
+        # Assembling the equality constraint vector
+        n = len(self.state0)
+        squared = self.definition['squared']
+        ceq = list([0] * (len(self.definition['final']) + 1))
+        for i, k, fixed, w in self._final_conditions():
+            if fixed:
+                ceq[i] = (full_state[k] - self.statet[k]) * w
+            else:
+                # Transversality condition: the state is free, its costate 0
+                ceq[i] = (full_state[n + k] * w) ** 2 if squared else full_state[n + k] * w
+
+        # Free time problem, Hamiltonian must be 0
+        H = self._hamiltonian(full_state) * self.definition['hamiltonian']
+        ceq[-1] = H ** 2 if squared else H
+        return ceq
+
+    def _final_constraints_jacobian(self, full_state):
+        # Derivatives of _final_constraints w.r.t. the final full state
+        n = len(self.state0)
+        squared = self.definition['squared']
+        dceq = np.zeros((len(self.definition['final']) + 1, 2 * n))
+        for i, k, fixed, w in self._final_conditions():
+            if fixed:
+                dceq[i, k] = w
+            else:
+                dceq[i, n + k] = 2. * w**2 * full_state[n + k] if squared else w
+        wh = self.definition['hamiltonian']
+        dH = wh * hamiltonian_gradient(self, full_state)
+        dceq[-1] = 2. * wh * self._hamiltonian(full_state) * dH if squared else dH
+        return dceq
+
+    def _compute_constraints_gradient_impl(self, x):
+        counters['gradients'] += 1
+        # One integration of the trajectory and of its variational equations
+        xf, dxf = variational_shoot(self, x, rtol=self.shoot_tol or 1e-13, atol=self.shoot_tol or 1e-13)
+        return np.dot(self._final_constraints_jacobian(xf), dxf)
+
+    def _hamiltonian(self, full_state):
+        return float(self.model.kernels['hamiltonian_python'](np.asarray(full_state, dtype=float), self._p, float(self.homotopy)))
+
+    def _hamiltonian_many(self, full_states):
+        # Vectorized _hamiltonian
+        return self.model.kernels['hamiltonian_many'](full_states, self._p, float(self.homotopy))
+
+    def _pontryagin_minimum_principle(self, full_state):
+        # Bounded controls then unit vector controls, in the order of the definition
+        return self.model.kernels['controls_python'](np.asarray(full_state, dtype=float), self._p, float(self.homotopy), -1.)
+
+    def _pontryagin_minimum_principle_many(self, full_states):
+        # Vectorized _pontryagin_minimum_principle, one column per control
+        return self.model.kernels['controls_many'](full_states, self._p, float(self.homotopy), -1.)
+
+    def _switching_function(self, full_state):
+        # Switching function of the bang-bang control (its upper bound where S < 0)
+        return float(self.model.kernels['switching_python'](np.asarray(full_state, dtype=float), self._p))
+
+    def _switching_function_many(self, full_states):
+        # Vectorized _switching_function
+        return self.model.kernels['switching_many'](full_states, self._p)
+
+    def _eom(self, full_state, t):
+        return self.model.kernels['rhs_python'](np.asarray(full_state, dtype=float), self._p, float(self.homotopy), -1.)
+
+    def _eom_compiled(self, full_state, t, throttle=-1.):
+        return self.model.kernels['rhs'](np.asarray(full_state, dtype=float), self._p, float(self.homotopy), throttle)
+
+    def _eom_jacobian(self, full_state, t, throttle=-1.):
+        return self.model.kernels['jacobian'](np.asarray(full_state, dtype=float), self._p, float(self.homotopy), throttle)
+
+    def _rhs(self):
+        # Right hand side and Jacobian handed to the integrator
+        if self.compiled:
+            return self._eom_compiled, self._eom_jacobian
+        return lambda a,b: self._eom(a,b), None
+
+    def _eom_many(self, full_states):
+        # Vectorized _eom, one full state per row
+        return self.model.kernels['rhs_many'](full_states, self._p, float(self.homotopy), -1.)
+
+    def shoot_many(self, X):
+        # Integrates all the decision vectors (rows of X) at once, returns the constraints
+        tol = self.shoot_tol or 1e-13
+        return shoot_many(self, X, rtol=tol, atol=tol)
+
+    def _shoot(self, x):
+        # Numerical Integration
+        eom, jac = self._rhs()
+        tol = self.shoot_tol or 1e-13
+        tspan = linspace(0, x[-1],100)
+        if self.homotopy == 1 and self.switch_events:
+            xf, info = switched_shoot(self, x, tspan, rtol=tol, atol=tol, mxstep=2000)
+        elif self.reduced:
+            xf, info = reduced_odeint(self, self.state0 + list(x[:-1]), tspan, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        else:
+            xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=tol, atol=tol, full_output=1, mxstep=2000)
+        keep_shot(self, x, tspan, xf, info)
+        return xf, info
+
+    def _simulate(self, x, tspan):
+        # Numerical Integration
+        eom, jac = self._rhs()
+        xf, info = odeint(eom, self.state0 + list(x[:-1]), tspan, Dfun=jac, rtol=1e-13, atol=1e-13, full_output=1, mxstep=2000)
+        return xf, info
+
+    def _non_dim(self, state):
+        return (np.asarray(state, dtype=float) / self._state_scales).tolist()
+
+    def _dim_back(self, state):
+        return np.asarray(state, dtype=float) * self._state_scales.reshape((-1,) + (1,) * (np.ndim(state) - 1))
+
+    def human_readable_extra(self):
+        model = self.model
+        s = "\n\tSymbolic model: " + model.name + "\n"
+        s = s + "\tStarting state: " + str(self.state0_input) + "\n"
+        s = s + "\tTarget state: " + str(self.statet_input) + "\n"
+        for p, v in zip(model.parameters, self.parameters_input):
+            s = s + "\t" + p + ": " + str(v) + "\n"
+        s = s + "\tHomotopy parameter: " + str(self.homotopy)
+        s = s + "\tPinpoint?: " + str(self.pinpoint)
+        return s
+
+    def produce_data(self, x, npoints):
+
+        # Producing the data (dense output of the shot, no new integration)
+        tspan = linspace(0, x[-1], npoints)
+        full_state = dense_shot(self, x, tspan, rtol=1e-13, atol=1e-13)
+        controls = self._pontryagin_minimum_principle_many(full_state)
+        # Unit vector controls as their angle
+        k = len(self.model.controls)
+        angles = [np.arctan2(controls[:, k + 2 * i], controls[:, k + 2 * i + 1])
+                  for i in range(len(self.model.directions))]
+        # Putting dimensions back
+        state = self._dim_back(full_state[:, :len(self.state0)].T).T
+
+        return (np.column_stack((tspan * self.T, state)), np.column_stack([controls[:, :k]] + angles))
+
+
+class simple_symbolic(symbolic_landing):
+    """simple_landing from its symbolic definition SIMPLE"""
+    definition = SIMPLE
+
+
+class rw_symbolic(symbolic_landing):
+    """rw_landing from its symbolic definition RW"""
+    definition = RW
@@ -0,0 +1,113 @@
+"""Checks of the landing models against their reference shots, on the
+initial states and solutions of the benchmarks (generate_data/benchmark.py).
+
+    python -m pytest indirect_method
+
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from numpy import linspace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'generate_data'))
+from benchmark import MODELS, _case
+from shooting import check_compiled, check_gradient, multiple_shooting_guess
+
+MODEL_NAMES = sorted(MODELS)
+
+
+def _problem(model, homotopy, **kwargs):
+    # Problem of the benchmark and its solution at homotopy (0: QC guess)
+    cls, state0, x_qc, x_moc, _ = _case(model)
+    prob = cls(state0=state0, homotopy=homotopy, pinpoint=True, **kwargs)
+    return prob, np.asarray(x_moc if homotopy == 1 else x_qc, dtype=float)
+
+
+def _max_error(a, b):
+    return np.max(np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float)))
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_shoot_many(model, homotopy):
+    # The lockstep shots of neighbouring decision vectors against the serial ones
+    prob, x = _problem(model, homotopy)
+    X = x * (1. + 1e-4 * np.random.RandomState(0).randn(8, len(x)))
+    reference = [prob._compute_constraints_impl(list(xi)) for xi in X]
+    assert _max_error(prob.shoot_many(X), reference) < 0.1 * np.min(prob.c_tol)
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_compiled(model, homotopy):
+    # Compiled right hand side against the Python one, analytic Jacobian
+    # against central differences
+    prob, x = _problem(model, homotopy, compiled=True)
+    errors = check_compiled(prob, list(x))
+    assert errors['rhs'] < 1e-10
+    assert errors['jacobian'] < 1e-6
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_gradient(model, homotopy):
+    # Variational gradient (saltation at the switches) against central
+    # differences of tight shots
+    prob, x = _problem(model, homotopy)
+    prob.shoot_tol = 1e-11
+    scale = np.max(np.abs(prob._compute_constraints_gradient_impl(list(x))))
+    assert check_gradient(prob, list(x)) < 1e-4 * scale
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_reduced(model, homotopy):
+    prob, x = _problem(model, homotopy)
+    reduced, _ = _problem(model, homotopy, reduced=True)
+    assert (_max_error(reduced._compute_constraints_impl(list(x)),
+                       prob._compute_constraints_impl(list(x))) <
+            1e-2 * np.min(prob.c_tol))
+
+
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_switched(model):
+    prob, x = _problem(model, 1)
+    switched, _ = _problem(model, 1, switch_events=True)
+    assert (_max_error(switched._compute_constraints_impl(list(x)),
+                       prob._compute_constraints_impl(list(x))) <
+            1e-2 * np.min(prob.c_tol))
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_multiple_shooting(model, homotopy):
+    # The segments started on the single shooting trajectory: same final
+    # constraints and no defects
+    prob, x = _problem(model, homotopy)
+    try:
+        multiple, _ = _problem(model, homotopy, segments=4)
+    except TypeError:
+        pytest.skip('no multiple shooting in ' + model)
+    c = np.asarray(prob._compute_constraints_impl(list(x)))
+    c_multiple = multiple._compute_constraints_impl(
+        multiple_shooting_guess(multiple, list(x), 4))
+    assert _max_error(c_multiple[:len(c)], c) < 1e-2 * np.min(prob.c_tol)
+    assert _max_error(c_multiple[len(c):], 0.) < 1e-2 * np.min(prob.c_tol)
+
+
+@pytest.mark.parametrize('homotopy', [0, 1])
+@pytest.mark.parametrize('model', MODEL_NAMES)
+def test_produce_data(model, homotopy):
+    # Dense output of the shot against a fresh integration, relative to the
+    # range of each state
+    prob, x = _problem(model, homotopy)
+    tspan = linspace(0, x[-1], 1000)
+    states, _ = prob.produce_data(list(x), 1000)
+    full_states = prob._simulate(list(x), tspan)[0]
+    reference = np.asarray(prob._dim_back(full_states[:, :len(prob.state0)].T)).T
+    assert _max_error(states[:, 0], tspan * prob.T) < 1e-12
+    scale = 1. + np.max(np.abs(reference), axis=0)
+    assert np.max(np.abs(states[:, 1:] - reference) / scale) < 1e-4
@@ -0,0 +1,98 @@
+"""Checks of the symbolic models (symbolic_model.py) against the hand-written
+ones they reproduce, skipped without sympy.
+
+    python -m pytest indirect_method/test_symbolic_model.py
+
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('sympy')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'generate_data'))
+import generate_data
+from benchmark import _case
+from newton_shooting import newton_shooting
+from symbolic_model import rw_symbolic, simple_symbolic
+
+SYMBOLIC = {'simple': simple_symbolic, 'rw': rw_symbolic}
+
+
+def _problems(model, homotopy, **kwargs):
+    # Hand-written and symbolic problems of the benchmark, and the QC guess or
+    # the mass optimal solution
+    cls, state0, x_qc, x_moc, _ = _case(model)
+    x = x_moc if homotopy == 1 else x_qc
+    return (cls(state0=state0, homotopy=homotopy, **kwargs),
+            SYMBOLIC[model](state0=state0, homotopy=homotopy, **kwargs), x)
+
+
+def _max_error(a, b):
+    return np.max(np.abs(np.asarray(a, dtype=float) - np.asarray(b, dtype=float)))
+
+
+def _tolerance(prob):
+    # The bang-bang shots only agree to the location of the switches
+    return 1e-2 * np.min(prob.c_tol) if prob.homotopy == 1 else 1e-10
+
+
+@pytest.mark.parametrize('pinpoint', [True, False])
+@pytest.mark.parametrize('homotopy', [0, 0.5, 1])
+@pytest.mark.parametrize('model', sorted(SYMBOLIC))
+def test_equations(model, homotopy, pinpoint):
+    hand, symbolic, x = _problems(model, homotopy, pinpoint=pinpoint)
+    y = hand.state0 + list(x[:-1])
+    assert _max_error(symbolic._eom(y, 0.), hand._eom(y, 0.)) < 1e-12
+    assert (_max_error(symbolic._eom_jacobian(y, 0.), hand._eom_jacobian(y, 0.)) <
+            1e-12)
+    assert (tuple(symbolic._squared_constraints) ==
+            tuple(getattr(hand, '_squared_constraints', ())))
+
+
+@pytest.mark.parametrize('pinpoint', [True, False])
+@pytest.mark.parametrize('homotopy', [0, 0.5, 1])
+@pytest.mark.parametrize('model', sorted(SYMBOLIC))
+def test_constraints(model, homotopy, pinpoint):
+    hand, symbolic, x = _problems(model, homotopy, pinpoint=pinpoint)
+    assert (_max_error(symbolic._compute_constraints_impl(x),
+                       hand._compute_constraints_impl(x)) < _tolerance(hand))
+    gradient = np.asarray(hand._compute_constraints_gradient_impl(x))
+    assert (_max_error(symbolic._compute_constraints_gradient_impl(x), gradient) <
+            1e-4 * np.max(np.abs(gradient)))
+
+
+@pytest.mark.parametrize('option', ['switch_events', 'reduced', 'compiled'])
+@pytest.mark.parametrize('model', sorted(SYMBOLIC))
+def test_shooting_options(model, option):
+    hand, symbolic, x = _problems(model, 1, pinpoint=True, **{option: True})
+    assert (_max_error(symbolic._compute_constraints_impl(x),
+                       hand._compute_constraints_impl(x)) < _tolerance(hand))
+
+
+@pytest.mark.parametrize('model', sorted(SYMBOLIC))
+def test_produce_data(model):
+    hand, symbolic, x = _problems(model, 1, pinpoint=True)
+    states, _ = hand.produce_data(x, 200)
+    symbolic_states, _ = symbolic.produce_data(x, 200)
+    assert np.max(np.abs(symbolic_states - states) / (1. + np.abs(states))) < 1e-7
+
+
+@pytest.mark.parametrize('model', sorted(SYMBOLIC))
+def test_homotopy_path(model):
+    # Newton QC solve and homotopy path to the mass optimal solution
+    cls, state0, x_qc, _, _ = _case(model)
+    solutions = []
+    for problem in (cls, SYMBOLIC[model]):
+        algo = newton_shooting()
+        sol = generate_data.solve(problem, state0, 0, algo, x=x_qc, display=False)
+        assert sol['feasible']
+        sol, alpha = generate_data.homotopy_path(problem, state0, algo,
+                                                 start=(0, sol['x']),
+                                                 display=False)
+        assert alpha == 1
+        solutions.append(sol['x'])
+    assert _max_error(solutions[1], solutions[0]) < 1e-8